@@ -38,6 +38,9 @@ def prepare_data(bags, arena, smoothstr, smooth, medfilt, gts, min_experiment_du
 
     found_gts = []
 
+    #load (and cache) all bag files in parallel first
+    list(madplot.cache_bagfiles(bags, arena, smooth=smooth))
+
     pooldf = DataFrame()
     for bag in bags:
         df = madplot.load_bagfile_single_dataframe(bag, arena,
@@ -27,6 +27,7 @@ import roslib; roslib.load_manifest('flymad')
 import flymad.flymad_analysis_dan as flymad_analysis
 import flymad.flymad_plot as flymad_plot
 import flymad.madplot as madplot
+import flymad.spatial as spatial
 
 try:
     from strawlab_mpl.spines import spine_placer
@@ -153,20 +154,8 @@ def prepare_data(path, only_laser, resample_bin, gts):
 
         #CALCULATE DISTANCE FROM TARGETs, KEEP MINIMUM AS dtarget
         if targets is not None:
-            dist = pd.DataFrame.copy(df, deep=True)
-            dist['x0'] = df['x'] - targets.ix[0,'x']
-            dist['y0'] = df['y'] - targets.ix[0,'y']
-            dist['x1'] = df['x'] - targets.ix[1,'x']
-            dist['y1'] = df['y'] - targets.ix[1,'y']
-            dist['x2'] = df['x'] - targets.ix[2,'x']
-            dist['y2'] = df['y'] - targets.ix[2,'y']
-            dist['x3'] = df['x'] - targets.ix[3,'x']
-            dist['y3'] = df['y'] - targets.ix[3,'y']
-            dist['d0'] = ((dist['x0'])**2 + (dist['y0'])**2)**0.5
-            dist['d1'] = ((dist['x1'])**2 + (dist['y1'])**2)**0.5
-            dist['d2'] = ((dist['x2'])**2 + (dist['y2'])**2)**0.5
-            dist['d3'] = ((dist['x3'])**2 + (dist['y3'])**2)**0.5
-            df['dtarget'] = dist.ix[:,'d0':'d3'].min(axis=1)               
+            df['dtarget'] = spatial.distance_to_points(df['x'].values, df['y'].values,
+                                                       targets[['x','y']].values)[0]
         else:
             df['dtarget'] = 0
 
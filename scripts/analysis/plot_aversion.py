@@ -26,6 +26,10 @@ def prepare_data(arena, path, smoothstr, smooth):
     pooled_off = {k:[] for k in "axbhwq"}
     pooled_lon = {k:[] for k in "axbhwq"}
 
+    #load (and cache) all bag files in parallel first
+    list(madplot.cache_bagfiles([madplot.get_path(path,dat,exp["bag"]) for exp in fly_data],
+                                arena, smooth=smooth))
+
     for exp in fly_data:
 
         geom, dfs = madplot.load_bagfile(
@@ -23,6 +23,7 @@ import roslib; roslib.load_manifest('flymad')
 import flymad.flymad_analysis_dan as flymad_analysis
 import flymad.flymad_plot as flymad_plot
 import flymad.madplot as madplot
+import flymad.laser_epochs as laser_epochs
 
 from strawlab_mpl.spines import spine_placer, auto_reduce_spine_bounds
 
@@ -42,8 +43,6 @@ EXPERIMENT_DURATION = 200.0
 
 def prepare_data(path, resample_bin, gts):
 
-    LASER_THORAX_MAP = {True:THORAX,False:HEAD}
-
     #PROCESS SCORE FILES:
     pooldf = pd.DataFrame()
     for df,metadata in flymad_analysis.load_courtship_csv(path):
@@ -65,22 +64,13 @@ def prepare_data(path, resample_bin, gts):
             continue
         print "\t%ss experiment" % duration
 
-        #make new columns that indicates HEAD/THORAX targeting
-        thorax = True
-        laser_state = False
-
-        trg = []
-        for i0,i1 in madplot.pairwise(df.iterrows()):
-            t0idx,t0row = i0
-            t1idx,t1row = i1
-            if t1row['laser_state'] >= 0.5 and t0row['laser_state'] == 0:
-                thorax ^= True
-                laser_state = True
-            elif t0row['laser_state'] >= 0.5 and t1row['laser_state'] == 0:
-                laser_state = False
-            trg.append(OFF if not laser_state else LASER_THORAX_MAP[thorax])
-        trg.append(OFF)
-        df['ttm'] = trg
+        #make new columns that indicates HEAD/THORAX targeting. the
+        #first laser epoch targets the head, then they alternate. (the
+        #value for each row is that of the following row)
+        epochs = laser_epochs.LaserEpochs.from_values(df['laser_state'].values)
+        trg = np.where(epochs.get_trials() % 2 == 0, HEAD, THORAX)
+        trg[~epochs.on] = OFF
+        df['ttm'] = np.r_[trg[1:], OFF]
 
         #resample into 5S bins
         df = df.resample(resample_bin, fill_method='ffill')
@@ -94,8 +84,8 @@ def prepare_data(path, resample_bin, gts):
         df['ttm'][df['ttm'] < 0] = HEAD
         df['ttm'][df['ttm'] > 0] = THORAX
 
-        dlaser = np.gradient( (df['laser_state'].values > 0).astype(int) ) > 0
-        t0idx = np.argmax(dlaser)
+        onsets = laser_epochs.get_gradient_onsets(df['laser_state'].values > 0)
+        t0idx = onsets[0] if len(onsets) else 0
         t0 = tb[t0idx-1]
         df['t'] = tb - t0
 
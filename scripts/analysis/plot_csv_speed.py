@@ -22,6 +22,8 @@ import roslib; roslib.load_manifest('flymad')
 import flymad.flymad_analysis_dan as flymad_analysis
 import flymad.flymad_plot as flymad_plot
 import flymad.madplot as madplot
+import flymad.csv_pipeline as csv_pipeline
+import flymad.pipeline as pipeline
 
 #need to support numpy datetime64 types for resampling in pandas
 assert np.version.version in ("1.7.1", "1.6.1")
@@ -29,22 +31,13 @@ assert pd.version.version in ("0.11.0" ,  "0.12.0")
 
 EXPERIMENT_DURATION = 70.0
 
-def prepare_data(path, arena, smoothstr, smooth, medfilt, gts):
+def prepare_data(csvfiles, arena, smoothstr, smooth, medfilt, gts):
 
     pooldf = DataFrame()
-    for csvfile in sorted(glob.glob(path + "/*.csv")):
-        cache_args = os.path.basename(csvfile), arena, smoothstr
-        cache_fname = csvfile+'.madplot-cache'
-
-        results = madplot.load_bagfile_cache(cache_args, cache_fname)
+    for csvfile,results in csv_pipeline.preprocess_csvs(csvfiles, arena, smooth):
         if results is None:
-            results = flymad_analysis.load_and_smooth_csv(csvfile, arena, smooth)
-            if results is not None:
-                #update the cache
-                madplot.save_bagfile_cache(results, cache_args, cache_fname)
-            else:
-                print "skipping", csvfile
-                continue
+            print "skipping", csvfile
+            continue
 
         df,dt,experimentID,date,time,genotype,laser,repID = results
 
@@ -196,7 +189,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('path', nargs=1, help='path to csv files')
     parser.add_argument('--show', action='store_true', default=False)
-    parser.add_argument('--only-plot', action='store_true', default=False)
+    parser.add_argument('--only-plot', action='store_true', default=False,
+                        help='plot the last prepared data, without checking the csv files')
     parser.add_argument('--no-smooth', action='store_false', dest='smooth', default=True)
     parser.add_argument('--calibration-dir', help='calibration directory containing yaml files', required=True)
 
@@ -213,14 +207,17 @@ if __name__ == "__main__":
 
     note = "%s %s\n%r\nmedfilt %s" % (arena.unit, smoothstr, arena, medfilt)
 
-    cache_fname = os.path.join(path,'speed.madplot-cache')
-    cache_args = (path, arena, smoothstr, args.smooth, medfilt, GENOTYPES)
+    #only recomputed if a csv file, an argument or prepare_data changes
+    pipe = pipeline.Pipeline(os.path.join(path,'speed.pipeline-cache'))
+    prepare = pipe.stage(version=1)(prepare_data)
+    csvfiles = pipeline.files(sorted(glob.glob(path + "/*.csv")))
+    prepare_args = (csvfiles, arena, smoothstr, args.smooth, medfilt, GENOTYPES)
     data = None
     if args.only_plot:
-        data = madplot.load_bagfile_cache(cache_args, cache_fname)
+        #the last result, without re-reading the csv files
+        data = prepare.get_latest(*prepare_args)
     if data is None:
-        data = prepare_data(path, arena, smoothstr, args.smooth, medfilt, GENOTYPES)
-        madplot.save_bagfile_cache(data, cache_args, cache_fname)
+        data = prepare(*prepare_args).get()
 
     fname_prefix = flymad_plot.get_plotpath(path,'csv_speed')
     madplot.view_pairwise_stats_plotly(data, [EXP_GENOTYPE,
@@ -4,7 +4,6 @@ import math
 import os.path
 import cPickle
 import argparse
-import multiprocessing
 import glob
 
 import numpy as np
@@ -41,8 +40,7 @@ def prepare_data(path):
         dat = json.load(open(path))
         fname = os.path.splitext(os.path.basename(path))[0]
 
-    jobs = {}
-    pool = multiprocessing.Pool()
+    bpaths = {}
 
     for k in dat:
         if k.startswith("_"):
@@ -56,14 +54,11 @@ def prepare_data(path):
                     print "WARNING: Trial missing label"
 
             for bname in bags:
-                bpath = madplot.get_path(path, dat, bname)
-                jobs[bname] = pool.apply_async(
-                                    madplot.load_bagfile,
-                                    (bpath, arena),
-                                    {'smooth':smooth_trajectories})
+                bpaths[madplot.get_path(path, dat, bname)] = bname
 
-    pool.close()
-    pool.join()
+    jobs = {}
+    for bpath,bdat in madplot.load_bagfiles(bpaths.keys(), arena, smooth=smooth_trajectories):
+        jobs[bpaths[bpath]] = bdat
 
     for k in dat:
         if k.startswith("_"):
@@ -76,7 +71,7 @@ def prepare_data(path):
             data = []
             for bname in bags:
                 print "merge", bname, "to trial", trialn
-                bdat = jobs[bname].get()
+                bdat = jobs[bname]
                 data.append( bdat )
 
 #                dt = bdat[1]['t_dt'].values
@@ -11,6 +11,7 @@ import roslib; roslib.load_manifest('flymad')
 import rosbag
 import flymad.trackingparams
 import flymad.madplot as madplot
+import flymad.frameindex
 
 import generate_mw_ttm_movies
 
@@ -29,10 +30,13 @@ def load_bagfile_get_laseron(arena, score, smooth):
     scored_ix = [t_df.index[0]]
     scored_v = [AS_MAP[FWD]]
 
-    for idx,row in pd.read_csv(score.csv).iterrows():
-        matching = t_df[t_df['t_framenumber'] == int(row['framenumber'])]
-        if len(matching) == 1:
-            scored_ix.append(matching.index[0])
+    score_df = pd.read_csv(score.csv)
+    fnidx = flymad.frameindex.FramenumberIndex(t_df['t_framenumber'])
+    match_pos = fnidx.get_unique_positions(score_df['framenumber'].values)
+
+    for (idx,row),pos in zip(score_df.iterrows(),match_pos):
+        if pos != flymad.frameindex.NO_MATCH:
+            scored_ix.append(t_df.index[pos])
             scored_v.append(AS_MAP[row['as']])
 
     s = pd.Series(scored_v,index=scored_ix)
@@ -64,7 +68,14 @@ def prepare_data(arena, path, smoothstr, smooth, genotype):
     for gt in GENOTYPES:
         bag_re = generate_mw_ttm_movies.get_bag_re(gt)
         targets = {}
-        for pair in generate_mw_ttm_movies.get_matching_fmf_and_bag(gt, path):
+        pairs = generate_mw_ttm_movies.get_matching_fmf_and_bag(gt, path)
+
+        #load (and cache) all bag files in parallel first
+        scored = [pair.bag for pair in pairs if os.path.isfile(
+                    os.path.join(os.path.dirname(pair.fmf),'mp4s',os.path.basename(pair.fmf))+'.mp4.csv')]
+        list(madplot.cache_bagfiles(scored, arena, smooth=smooth))
+
+        for pair in pairs:
             mp4dir = os.path.join(os.path.dirname(pair.fmf), 'mp4s')
             mp4 = os.path.join(mp4dir, os.path.basename(pair.fmf))+'.mp4'
             csv = mp4+'.csv'
@@ -11,7 +11,6 @@ import collections
 import glob
 import pprint, copy
 import datetime
-import math
 import cPickle as pickle
 
 import roslib; roslib.load_manifest('flymad')
@@ -19,6 +18,7 @@ import rosbag
 import flymad.flymad_plot as flymad_plot
 import flymad.flymad_analysis_dan as flymad_analysis
 import flymad.madplot as madplot
+import flymad.orientation as orientation
 
 import pandas as pd
 import numpy as np
@@ -37,67 +37,6 @@ import scipy.interpolate
 R2D = 180/np.pi
 CACHE_FNAME = 'optodata.pkl'
 
-def wrap_dtheta_plus_minus(dtheta, around=np.pi):
-    """
-    wraps an angle over the interval [-around,around)
-
-    e.g. wrap_dtheta_plus_minus(dt, np.pi) returns an angle
-    wrapped [-pi,pi)
-    """
-
-    if (dtheta>0):
-        return math.fmod(dtheta+around, 2.0*around) - around
-    else:
-        return math.fmod(dtheta-around, 2.0*around) + around
-
-def calc_dtheta(df):
-    #naieve method for calculating dtheta assuming wraparound.
-
-    dtheta = []
-    dtheta_idx = []
-
-    for i0,i1 in madplot.pairwise(df.iterrows()):
-        t0idx,t0row = i0
-        t1idx,t1row = i1
-        t0 = t0row['theta']
-        t1 = t1row['theta']
-
-        dt = (t1-t0)
-        #dtheta ranges from -pi/2.0 -> pi/2.0
-        dt = wrap_dtheta_plus_minus(dt, around=np.pi/2.0)
-
-        dtheta.append(dt)
-        dtheta_idx.append(t0idx)
-
-    return pd.Series(dtheta,index=dtheta_idx)
-
-def choose_orientations_primitive(theta):
-    """
-    Remove head/tail ambiguity.
-
-    Assumes theta is == orientation modulo pi, in other words,
-    that the orientation is ambiguous with respect to head/tail.
-    """
-    theta_prev = theta[0]
-    result = [theta_prev]
-    diffs = np.array([-3*np.pi,-2*np.pi,-np.pi,0,np.pi,2*np.pi,3*np.pi])
-    PI2 = 2*np.pi
-    for i, ambiguous_angle in enumerate( theta[1:] ):
-        possible_angles = diffs + ambiguous_angle
-        rotation_distance = abs( theta_prev - possible_angles)
-        diff_idx = np.argmin(rotation_distance)
-
-        # update for next
-        theta_prev = ambiguous_angle+diffs[diff_idx]
-        if theta_prev < 0:
-            theta_prev = theta_prev + PI2
-        elif theta_prev >= PI2:
-            theta_prev = theta_prev - PI2
-        result.append( theta_prev )
-    result = np.array(result)
-    assert len(result)==len(theta)
-    return result
-
 def supplement_times(df):
     """create new column ('time_since_start') in DataFrame df"""
     times = df['t_ts'].values
@@ -106,106 +45,6 @@ def supplement_times(df):
     t0 = times[good_cond][0]
     df['time_since_start'] = df['t_ts']-t0
 
-def supplement_angles(df,
-                      cutoff_hz=5.0,
-                      filter_order=8,
-                      method='downsampled',
-                      downsample_sec=1.0,
-                      ):
-    """create new column ('angular_velocity') in DataFrame df
-
-    if cutoff_hz==0, no lowpass filtering is done.
-
-    Assumes df['theta'] is == orientation modulo pi, in other words,
-    that the orientation is ambiguous with respect to head/tail.
-
-    Methods:
-         'raw' - central difference on raw theta values
-         'lowpassed' - central difference on lowpassed theta values
-         'downsampled' - central difference on downsampled theta values
-    """
-    stamps = df['t_ts'].values
-    bad_cond1 = np.isnan(stamps)
-    bad_cond2 = np.isnan(df['theta'].values)
-
-    bad_cond = bad_cond1 | bad_cond2
-
-    good_cond = ~bad_cond
-    goodstamps = stamps[good_cond]
-    dgoodstamps = goodstamps[1:]-goodstamps[:-1]
-    if 1:
-        # check assumptions about pandas
-        bad_cond2 = np.isnan(df['theta'].values)
-        assert bad_cond.ndim == bad_cond2.ndim
-        assert bad_cond.shape == bad_cond2.shape
-        assert np.allclose( bad_cond, bad_cond2 )
-
-        assert np.alltrue(dgoodstamps > 0)
-
-    # unwrap theta, dealing with nans
-    good_theta = df['theta'].values[good_cond]
-    good_theta_chosen = choose_orientations_primitive(good_theta)
-    good_theta_unwrapped = np.unwrap(good_theta_chosen)
-
-    dt = np.mean(dgoodstamps)
-
-    if cutoff_hz != 0:
-        sample_rate_hz = 1.0/dt
-        nyquist_rate_hz = sample_rate_hz*0.5
-
-        filt_b, filt_a = scipy.signal.butter(filter_order,
-                                             cutoff_hz/nyquist_rate_hz)
-        lowpassed = scipy.signal.filtfilt(filt_b, filt_a,
-                                          good_theta_unwrapped)
-
-    # calculate angular velocity using central difference
-    if method=='raw':
-        delta_theta = np.gradient(good_theta_unwrapped)
-        angular_velocity = delta_theta/dt
-    elif method=='lowpassed':
-        delta_theta = np.gradient(lowpassed)
-        angular_velocity = delta_theta/dt
-    elif method=='downsampled':
-        # downsample theta
-        n_samps = int(np.round(downsample_sec/dt))
-        downdt = n_samps*dt
-        downtime = goodstamps[::n_samps]
-        downtheta = lowpassed[::n_samps]
-        if 1:
-            # linear interpolation of downsampled theta
-            interp = scipy.interpolate.interp1d( downtime, downtheta,
-                                                 bounds_error=False,
-                                                 fill_value=np.nan,
-                                                 )
-            linear_theta_values = interp( goodstamps )
-            delta_theta = np.gradient(linear_theta_values)
-
-        downvel = np.gradient( downtheta )/downdt
-        interp = scipy.interpolate.interp1d( downtime, downvel,
-                                             bounds_error=False,
-                                             fill_value=np.nan,
-                                             )
-        angular_velocity = interp( goodstamps )
-
-    # now fill dataframe with computed values
-    tmp = np.nan*np.ones( (len(df,) ))
-    tmp[good_cond] = good_theta_chosen
-    df['theta_wrapped'] = tmp
-    tmp = np.nan*np.ones( (len(df,) ))
-    tmp[good_cond] = good_theta_unwrapped
-    df['theta_unwrapped'] = tmp
-    tmp = np.nan*np.ones( (len(df,) ))
-    tmp[good_cond] = lowpassed
-    df['theta_unwrapped_lowpass'] = tmp
-    if method=='downsampled':
-        tmp = np.nan*np.ones( (len(df,) ))
-        tmp[good_cond] = linear_theta_values
-        df['theta_unwrapped_downsampled'] = tmp
-    tmp = np.nan*np.ones( (len(df,) ))
-    tmp[good_cond] = angular_velocity
-    df['angular_velocity'] = tmp
-
-
 def prepare_data(arena, path, smoothstr, smooth):
 
     path = os.path.abspath(path)
@@ -232,6 +71,11 @@ def prepare_data(arena, path, smoothstr, smooth):
         pattern = os.path.join(path, GENOTYPES[gt])
         bags = glob.glob(pattern)
 
+        #load (and cache) all bag files in parallel first
+        list(madplot.cache_bagfiles(bags, arena,
+                                    extra_topics={'/rotator/velocity':['data']},
+                                    smooth=smooth))
+
         for bag in bags:
 
             df = madplot.load_bagfile_single_dataframe(
@@ -240,7 +84,7 @@ def prepare_data(arena, path, smoothstr, smooth):
                         extra_topics={'/rotator/velocity':['data']},
                         smooth=smooth
             )
-            supplement_angles(df)
+            orientation.supplement_angles(df)
             supplement_times(df)
 
             if 1:
@@ -252,7 +96,8 @@ def prepare_data(arena, path, smoothstr, smooth):
                 for obj_id, group in df.groupby('tobj_id'):
                     if np.isnan(obj_id):
                         continue
-                    dts.append( calc_dtheta(group) )
+                    dts.append( pd.Series(orientation.calc_dtheta(group['theta'].values),
+                                          index=group.index[:-1]) )
 
                 #join the dthetas vertically (axis=0) and insert as a column into
                 #the full dataframe
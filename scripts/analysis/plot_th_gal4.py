@@ -28,6 +28,7 @@ import argparse
 
 import roslib; roslib.load_manifest('flymad')
 import flymad.madplot as madplot
+import flymad.frameindex
 from flymad.th_experiments import DOROTHEA_NAME_RE_BASE
 
 DOROTHEA_NAME_REGEXP = re.compile(r'^' + DOROTHEA_NAME_RE_BASE + '.mp4.csv$')
@@ -67,16 +68,20 @@ def load_bagfile_get_laseron(arena, score, smooth):
 
     score_df = pd.read_csv(score.csv)
 
-    for idx,row in score_df.iterrows():
+    #find the tracked row for every scored frame in one pass
+    fnidx = flymad.frameindex.FramenumberIndex(t_df['t_framenumber'])
+    match_pos, match_n = fnidx.locate(score_df['framenumber'].values)
+
+    for (idx,row),pos,n in zip(score_df.iterrows(),match_pos,match_n):
         csv_row_frame = row['framenumber']
         if np.isnan(csv_row_frame):
             continue
 
-        matching = t_df[t_df['t_framenumber'] == int(csv_row_frame)]
-        if len(matching) ==1:
+        if n == 1:
+            matching_ix = t_df.index[pos]
 
             # proboscis ---------------
-            proboscis_scored_ix.append(matching.index[0])
+            proboscis_scored_ix.append(matching_ix)
             rowval = row['as']
             if rowval=='a':
                 proboscis_scored_v.append( PROBOSCIS )
@@ -90,7 +95,7 @@ def load_bagfile_get_laseron(arena, score, smooth):
 
 
             # wing ---------------
-            wing_scored_ix.append(matching.index[0])
+            wing_scored_ix.append(matching_ix)
             rowval = row['zx']
             if rowval=='z':
                 wing_scored_v.append( WING_MOVEMENTS )
@@ -103,7 +108,7 @@ def load_bagfile_get_laseron(arena, score, smooth):
                 raise ValueError('unknown row value: %r'%rowval)
 
             # jump ---------------
-            jump_scored_ix.append(matching.index[0])
+            jump_scored_ix.append(matching_ix)
             rowval = row['cv']
             if rowval=='c':
                 jump_scored_v.append( JUMPING )
@@ -116,7 +121,7 @@ def load_bagfile_get_laseron(arena, score, smooth):
                 raise ValueError('unknown row value: %r'%rowval)
 
             # abdomen ---------------
-            abdomen_scored_ix.append(matching.index[0])
+            abdomen_scored_ix.append(matching_ix)
             rowval = row['qw']
             if rowval=='q':
                 abdomen_scored_v.append( ABDOMENING )
@@ -127,10 +132,10 @@ def load_bagfile_get_laseron(arena, score, smooth):
                 abdomen_scored_v.append(np.nan)
             else:
                 raise ValueError('unknown row value: %r'%rowval)
-        elif len(matching)==0:
+        elif n == 0:
             continue
         else:
-            print "len(matching)",len(matching)
+            print "len(matching)",n
             # why would we ever get here?
             1/0
 
@@ -237,6 +242,7 @@ def prepare_data( arena, dirname, bag_dirname, smooth ):
     csv_files = glob.glob( os.path.join(dirname,'csvs','*.csv') )
     if len(csv_files)==0:
         raise ValueError('%r matched no .csv files'%csv_files)
+    scored = []
     for csv_filename in csv_files:
         matchobj = DOROTHEA_NAME_REGEXP.match(os.path.basename(csv_filename))
         if matchobj is None:
@@ -258,8 +264,13 @@ def prepare_data( arena, dirname, bag_dirname, smooth ):
             print 'FAILED TO FIND BAG FOR CSV',csv_filename
             raise
 
+        scored.append( (csv_filename, parsed_data, bag_filename) )
 
+    #load (and cache) all bag files in parallel first
+    list(madplot.cache_bagfiles([bag_filename for _,_,bag_filename in scored],
+                                arena, smooth=smooth))
 
+    for csv_filename, parsed_data, bag_filename in scored:
 #        l_df, t_df, h_df, geom = madplot.load_bagfile(bag_filename, arena, smooth=smooth)
         score = Scored(bag_filename, csv_filename)
         try:
@@ -11,7 +11,6 @@ import operator
 import multiprocessing
 import sys
 
-import motmot.FlyMovieFormat.FlyMovieFormat as fmf
 import pandas as pd
 import numpy as np
 
@@ -20,6 +19,7 @@ import benu.utils
 
 import roslib; roslib.load_manifest('flymad')
 import flymad.madplot as madplot
+import flymad.fmf as fmf
 
 Cut = collections.namedtuple('Cut', 'start end dest')
 
@@ -36,9 +36,11 @@ if __name__ == "__main__":
         parser.error('must be a directory')
 
     bags = glob.glob(os.path.join(path, "*.bag"))
-    fmffile = fmf.FlyMovie(glob.glob(os.path.join(path, "*.fmf"))[0])
+    fmffname = glob.glob(os.path.join(path, "*.fmf"))[0]
+    fmffile = fmf.FMFReader(fmffname, readahead=0)
 
-    ts = fmffile.get_all_timestamps().tolist()
+    ts = fmffile.get_all_timestamps()
+    fmffile.close()
 
     arena = madplot.Arena(False)
 
@@ -61,32 +63,17 @@ if __name__ == "__main__":
 
         cuts.append( Cut(start,stop,os.path.abspath(destfmf)) )
 
-    #many iterations, yuck. meh.
-    while cuts:
-        try:
-            cut = cuts.pop(0)
-        except IndexError:
-            continue
-
-        startt = endt = None
-        for t in ts:
-            if startt is None and t >= cut.start:
-                startt = t
-            if endt is None and startt is not None and t >= cut.end:
-                endt = t
-                break
-
-        if endt is not None:
+    #the first frame at or after the start and end of each cut, all cuts
+    #are then copied in one pass over the fmf
+    starts = np.searchsorted(ts, [c.start for c in cuts], side='left')
+    ends = np.searchsorted(ts, [c.end for c in cuts], side='left')
+
+    todo = []
+    for cut,starti,endi in zip(cuts,starts,ends):
+        if endi < len(ts):
             print "cut", cut
-            dest = fmf.FlyMovieSaver(
-                            cut.dest,
-                            format=fmffile.format,
-                            bits_per_pixel=fmffile.bits_per_pixel)
-            for i in range(ts.index(startt),ts.index(endt)):
-                frame, timestamp = fmffile.get_frame(i)
-                dest.add_frame(frame,timestamp)
-            dest.close()
+            todo.append( (starti,endi,cut.dest) )
         else:
             print "no cut found for",cut.dest
 
-
+    fmf.cut_fmf(fmffname, todo)
@@ -30,6 +30,7 @@ import roslib; roslib.load_manifest('flymad')
 import flymad.vlc as vlc
 import flymad.conv as bagconv
 import flymad.filename_regexes as filename_regexes
+import flymad.catalog
 
 # Create a single vlc.Instance() to be shared by (possible) multiple players.
 instance = vlc.Instance("--no-snapshot-preview --snapshot-format png")
@@ -402,6 +403,8 @@ if __name__ == '__main__':
                 help='extract the framenumber from the video instead')
     parser.add_argument('--no-merge-bags', action='store_true',
                 help='dont attempt to merge with bag files')
+    parser.add_argument('--catalog', type=str, default=None,
+                help='sqlite file to keep the index of bag files in (default: in memory)')
     parser.add_argument('--max-trial', type=int, default=1000,
                 help='maximum trial number to score')
     parser.add_argument('--set-title', action='store_true',
@@ -454,7 +457,10 @@ if __name__ == '__main__':
     else:
         sys.exit(1)
 
-    inputbags = glob.glob(os.path.join(bagdir,"*.bag"))
+    catalog = flymad.catalog.Catalog(args.catalog if args.catalog else ':memory:')
+    if os.path.isdir(bagdir):
+        catalog.scan(bagdir, ('bag',))
+    inputbags = catalog.get_files('bag', bagdir, include_invalid=True)
     if len(inputbags)==0:
         print 'no bag files found in %r' % bagdir
 
@@ -492,20 +498,9 @@ if __name__ == '__main__':
 
             bname = None
             if inputbags:
-                best_diff = np.inf
-                for bag in inputbags:
-                    try:
-                        bagtime = filename_regexes.parse_date(bag)
-                    except filename_regexes.RegexError, e:
-                        print "error: incorrectly named bag file?", bag
-                        continue
-                    this_diff = abs(time.mktime(bagtime)-time.mktime(mp4time))
-                    if this_diff < best_diff:
-                        bname = bag
-                        best_diff = this_diff
-                    else:
-                        continue
-                assert best_diff < 10.0
+                bag = catalog.find_nearest('bag', time.mktime(mp4time), 10.0, bagdir)
+                assert bag is not None
+                bname = bag.path
                 assert os.path.exists(bname)
 
         assert os.path.exists(fname)
@@ -1,4 +1,3 @@
-import motmot.FlyMovieFormat.FlyMovieFormat as fmf
 import collections
 import numpy as np
 import warnings
@@ -13,6 +12,10 @@ import roslib; roslib.load_manifest('rosbag')
 import rospy
 import rosbag
 
+roslib.load_manifest('flymad')
+import flymad.fmf as fmf
+import flymad.framesched as framesched
+
 def scale(w, h, x, y, maximum=True):
     # see http://code.activestate.com/recipes/577575-scale-rectangle-while-keeping-aspect-ratio/
     nw = y * w / h
@@ -35,8 +38,8 @@ class DateFormatter:
         return str(datetime.datetime.fromtimestamp(x,self.tz))
 
 def composite_fmfs(widef,zoomf,rosbagf,imagepath,fps=15):
-    wide = fmf.FlyMovie(widef)
-    zoom = fmf.FlyMovie(zoomf)
+    wide = fmf.open_movie(widef)
+    zoom = fmf.open_movie(zoomf)
     bag = rosbag.Bag(rosbagf)
 
     wide_ts = wide.get_all_timestamps()
@@ -114,6 +117,21 @@ def composite_fmfs(widef,zoomf,rosbagf,imagepath,fps=15):
     tz = pytz.timezone( tzname )
     pretty_time = DateFormatter(tz)
 
+    #the messages are in the order they were recorded, which is not always
+    #that of their header stamps, so sort (stably) for the lookups below
+    raw2d = raw2d[np.argsort(raw2d['stamp'], kind='mergesort')]
+    for obj_id in objs:
+        objs[obj_id] = objs[obj_id][np.argsort(objs[obj_id]['stamp'], kind='mergesort')]
+
+    #the (time sorted) messages at or before each output frame, looked up
+    #for all frames at once
+    vel_idxs = framesched.asof_positions(micro_vels['t'], times)
+    pos_idxs = framesched.asof_positions(micro_position_echos['t'], times)
+    obj_idxs = dict((obj_id, framesched.asof_positions(objs[obj_id]['stamp'], times))
+                    for obj_id in objs)
+    raw2d_start = np.searchsorted(raw2d['stamp'], times - 50*rate, side='right')
+    raw2d_stop = np.searchsorted(raw2d['stamp'], times, side='right')
+
     progress = get_progress_bar("frame", len(times))
 
     for out_fno, cur_time in enumerate(times):
@@ -125,9 +143,8 @@ def composite_fmfs(widef,zoomf,rosbagf,imagepath,fps=15):
         wide_frame, this_wide_ts = wide.get_frame_at_or_before_timestamp(cur_time)
         zoom_frame, this_zoom_ts = zoom.get_frame_at_or_before_timestamp(cur_time)
 
-        #cond = (cur_time - rate < raw2d['stamp']) & (raw2d['stamp'] <= cur_time)
-        cond = (cur_time - 50*rate < raw2d['stamp']) & (raw2d['stamp'] <= cur_time)
-        this_raw2d = raw2d[cond]
+        #(cur_time - 50*rate < raw2d['stamp']) & (raw2d['stamp'] <= cur_time)
+        this_raw2d = raw2d[raw2d_start[out_fno]:raw2d_stop[out_fno]]
 
         save_fname_path = os.path.join(imagepath,'out%06d.png' % out_fno)
         final_w = 1024
@@ -150,9 +167,8 @@ def composite_fmfs(widef,zoomf,rosbagf,imagepath,fps=15):
         dev_w, dev_h = scale( w, h, max_panel_w, max_panel_h )
         device_rect = (margin, margin, dev_w, dev_h)
 
-        idxs = np.nonzero(micro_vels['t'] <= cur_time)[0]
-        if len(idxs):
-            last_idx = idxs[-1]
+        last_idx = vel_idxs[out_fno]
+        if last_idx >= 0:
             row = micro_vels[last_idx]
             velA = row['A']
             velB = row['B']
@@ -162,9 +178,8 @@ def composite_fmfs(widef,zoomf,rosbagf,imagepath,fps=15):
             velB = None
             vel_age = None
 
-        idxs = np.nonzero(micro_position_echos['t'] <= cur_time)[0]
-        if len(idxs):
-            last_idx = idxs[-1]
+        last_idx = pos_idxs[out_fno]
+        if last_idx >= 0:
             row = micro_position_echos[last_idx]
             posA = row['A']
             posB = row['B']
@@ -217,9 +232,7 @@ def composite_fmfs(widef,zoomf,rosbagf,imagepath,fps=15):
                               this_raw2d['y'],
                               color_rgba=(0,1,0,0.3), radius=2.0 )
                 for obj_id in valid_obj_ids:
-                    stamps = objs[ obj_id ]['stamp']
-                    cond = stamps <= cur_time
-                    last_idx = np.nonzero(cond)[0][-1]
+                    last_idx = obj_idxs[obj_id][out_fno]
                     r = objs[obj_id][last_idx]
                     canv.scatter( [r['x']], [r['y']],
                                   color_rgba=(1,0,1,0.4), radius=1.5 )
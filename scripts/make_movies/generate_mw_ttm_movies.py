@@ -21,12 +21,14 @@ import benu.utils
 import roslib; roslib.load_manifest('flymad')
 import rosbag
 import flymad.madplot as madplot
+import flymad.framesched
+import flymad.filename_regexes as filename_regexes
 
 USE_MULTIPROCESSING = True
 
 Pair = collections.namedtuple('Pair', 'fmf bag maxt')
 
-FMF_DATE_FMT = "%Y%m%d_%H%M%S.fmf"
+FMF_DATE_FMT = "%Y%m%d_%H%M%S"
 
 assert benu.__version__ >= "0.1.0"
 
@@ -46,16 +48,15 @@ class Assembler:
     def render_frame(self, desc):
         assert isinstance(desc, madplot.FrameDescriptor)
 
-        png = self.moviemaker.next_frame()
-        canv = benu.benu.Canvas(png, self.w, self.h)
+        canv = self.moviemaker.new_canvas(self.w, self.h)
 
         self.wfmf.render(canv, self.panels['wide'], desc)
         self.zfmf.render(canv, self.panels['zoom'], desc)
 
-        canv.save()
+        self.moviemaker.save_canvas(canv)
         self.i += 1
 
-        return png
+        return canv
 
 def doit_using_framenumber(user_data):
     match, mdir, show_theta, show_velocity = user_data
@@ -76,36 +77,11 @@ def doit_using_framenumber(user_data):
     wide.show_lxly = True
     wide.show_fxfy = True
 
-    renderlist = []
-
-    zoom_ts = zoom.fmf.get_all_timestamps().tolist()
+    zoom_ts = zoom.fmf.get_all_timestamps()
     df = madplot.load_bagfile_single_dataframe(rosbagf, arena, ffill=True)
     t0 = df.index[0].asm8.astype(np.int64) / 1e9
 
-    for idx,group in df.groupby('h_framenumber'):
-        #did we save a frame ?
-        try:
-            frameoffset = zoom_ts.index(idx)
-        except ValueError:
-            #missing frame (probbably because the video was not recorded at
-            #full frame rate
-            continue
-
-        frame = madplot.FMFFrame(offset=frameoffset, timestamp=idx)
-        row = group.dropna(subset=['tobj_id']).tail(1)
-        if len(row):
-            if maxt > 0:
-                dt = (row.index[0].asm8.astype(np.int64) / 1e9) - t0
-                if dt > maxt:
-                    break
-
-            desc = madplot.FrameDescriptor(
-                                None,
-                                frame,
-                                row,
-                                row.index[0].asm8.astype(np.int64) / 1e9)
-
-            renderlist.append(desc)
+    renderlist = list(flymad.framesched.iter_zoom_frames(df, zoom_ts, maxt=maxt, t0=t0))
 
     wide.t0 = t0
 
@@ -122,7 +98,7 @@ def doit_using_framenumber(user_data):
 
     actual_w, actual_h = benu.utils.negotiate_panel_size_same_height(panels, TARGET_OUT_W)
 
-    moviemaker = madplot.MovieMaker(basename=os.path.basename(zoomf), fps=30)
+    moviemaker = madplot.MovieMaker(basename=os.path.basename(zoomf), fps=30, stream=True)
     target_moviefname = moviemaker.get_target_movie_name(mdir)
     if os.path.exists(target_moviefname):
         print 'target %r exists: skipping movie'%(target_moviefname,)
@@ -187,8 +163,9 @@ def get_matching_fmf_and_bag(gt, base_dir, maxtime=0):
     bag_re = get_bag_re(gt)
     matching = []
 
-    for fmffile in glob.glob(os.path.join(base_dir,'%s_*.fmf' % gt)):
-        fmfname = os.path.basename(fmffile)
+    for fmffile in filename_regexes.glob_ext(os.path.join(base_dir,'%s_*' % gt), 'fmf'):
+        #(without the .fmf or .cfmf extension)
+        fmfname = os.path.splitext(os.path.basename(fmffile))[0]
         matchobj = bag_re.search(fmfname)
         if matchobj is None:
             print "error: incorrectly named fmf file?", fmffile
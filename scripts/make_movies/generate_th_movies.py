@@ -21,6 +21,9 @@ import benu.utils
 import roslib; roslib.load_manifest('flymad')
 import rosbag
 import flymad.madplot as madplot
+import flymad.framesched
+import flymad.laser_epochs as laser_epochs
+import flymad.filename_regexes as filename_regexes
 from flymad.th_experiments import DOROTHEA_NAME_RE_BASE, DOROTHEA_BAGDIR, DOROTHEA_MP4DIR
 
 DOROTHEA_NAME_REGEXP = re.compile(r'^' + DOROTHEA_NAME_RE_BASE + '$')
@@ -50,16 +53,15 @@ class Assembler:
     def render_frame(self, desc):
         assert isinstance(desc, madplot.FrameDescriptor)
 
-        png = self.moviemaker.next_frame()
-        canv = benu.benu.Canvas(png, self.w, self.h)
+        canv = self.moviemaker.new_canvas(self.w, self.h)
 
         self.wfmf.render(canv, self.panels['wide'], desc)
         self.zfmf.render(canv, self.panels['zoom'], desc)
 
-        canv.save()
+        self.moviemaker.save_canvas(canv)
         self.i += 1
 
-        return png
+        return canv
 
 def doit_using_framenumber(user_data):
     match, mp4_dir, show_theta, show_velocity, pre_frames, post_frames = user_data
@@ -68,7 +70,7 @@ def doit_using_framenumber(user_data):
     rosbagf = match.bag
     maxt = match.maxt
 
-    moviemaker = madplot.MovieMaker(basename=os.path.basename(zoomf), fps=15)
+    moviemaker = madplot.MovieMaker(basename=os.path.basename(zoomf), fps=15, stream=True)
     target_moviefname = moviemaker.get_target_movie_name(mp4_dir)
     if os.path.exists(target_moviefname):
         print 'target %r exists: skipping movie'%(target_moviefname,)
@@ -87,9 +89,7 @@ def doit_using_framenumber(user_data):
     wide.show_lxly = True
     wide.show_fxfy = True
 
-    renderlist = []
-
-    zoom_ts = zoom.fmf.get_all_timestamps().tolist()
+    zoom_ts = zoom.fmf.get_all_timestamps()
     df = madplot.load_bagfile_single_dataframe(rosbagf, arena, ffill=True,
                                                tzname=TZNAME)
     t0 = df.index[0].asm8.astype(np.int64) / 1e9
@@ -98,11 +98,7 @@ def doit_using_framenumber(user_data):
     laser_power = df['laser_power'].values
     framenumber = df['h_framenumber'].values
 
-    laser_power = np.array( laser_power, copy=True )
-    laser_power[ np.isnan(laser_power) ] = 0
-
-    dlaser = laser_power[1:]-laser_power[:-1]
-    laser_transitions = np.nonzero(dlaser)[0]
+    laser_transitions = laser_epochs.LaserEpochs.from_values(laser_power).get_transitions()
     startframenumber = -np.inf
     stopframenumber = np.inf
     if pre_frames is None:
@@ -122,35 +118,7 @@ def doit_using_framenumber(user_data):
 
     # got start and stop frames -----
 
-    for idx,group in df.groupby('h_framenumber'):
-        # limit movies to only frames we want
-        this_framenumber = group['h_framenumber'].values[0]
-        if not (startframenumber <= this_framenumber and this_framenumber <= stopframenumber):
-            continue
-
-        #did we save a frame ?
-        try:
-            frameoffset = zoom_ts.index(idx)
-        except ValueError:
-            #missing frame (probbably because the video was not recorded at
-            #full frame rate
-            continue
-
-        frame = madplot.FMFFrame(offset=frameoffset, timestamp=idx)
-        row = group.dropna(subset=['tobj_id']).tail(1)
-        if len(row):
-            if maxt > 0:
-                dt = (row.index[0].asm8.astype(np.int64) / 1e9) - t0
-                if dt > maxt:
-                    break
-
-            desc = madplot.FrameDescriptor(
-                                None,
-                                frame,
-                                row,
-                                row.index[0].asm8.astype(np.int64) / 1e9)
-
-            renderlist.append(desc)
+    renderlist = list(flymad.framesched.iter_zoom_frames(df, zoom_ts, startframenumber, stopframenumber, maxt, t0))
 
     if len(renderlist)==0:
         moviemaker.cleanup()
@@ -225,7 +193,7 @@ def get_matching_fmf_and_bag(fmf_dir, maxtime,
     if not os.path.isdir(bagdir):
         raise RuntimeError('bagdir not a directory')
 
-    for fmffile in glob.glob(os.path.join(fmf_dir,'*.fmf')):
+    for fmffile in filename_regexes.glob_ext(os.path.join(fmf_dir,'*'), 'fmf'):
         fmfname = os.path.basename(fmffile)
         matchobj = DOROTHEA_NAME_REGEXP.match(fmfname)
 
@@ -4,7 +4,6 @@ import sys
 import os.path
 
 import numpy as np
-import cv2
 
 import roslib; roslib.load_manifest('flymad')
 import flymad.madplot as madplot
@@ -24,13 +23,12 @@ if __name__ == "__main__":
     fmf.enable_color_correction(brightness=20, contrast=1.5)
 
     frames = fmf.fmf.get_all_timestamps()
-    moviemaker = madplot.MovieMaker(basename=os.path.basename(path)+'_plain', fps=args.fps)
+    moviemaker = madplot.MovieMaker(basename=os.path.basename(path)+'_plain', fps=args.fps, stream=True)
     pbar = madplot.get_progress_bar(moviemaker.movie_fname, len(frames))
 
     for i,ts in enumerate(frames):
         f = fmf.get_frame_number(i)
-        png = moviemaker.next_frame()
-        cv2.imwrite(png, f)
+        moviemaker.write_frame(f, bgr=True)
         pbar.update(i)
 
         if 'TEST_MOVIES' in os.environ:
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import sys
 import time
 import os.path
 import glob
@@ -9,6 +10,7 @@ import re
 import collections
 import operator
 import multiprocessing
+import itertools
 
 import motmot.FlyMovieFormat.FlyMovieFormat as fmf
 import pandas as pd
@@ -19,6 +21,7 @@ import benu.utils
 
 import roslib; roslib.load_manifest('flymad')
 import flymad.madplot as madplot
+import flymad.framesched
 
 class Assembler:
     def __init__(self, w, h, panels, wfmf, moviemaker):
@@ -29,22 +32,24 @@ class Assembler:
         self.i = 0
         self.moviemaker = moviemaker
 
+    def warm_frame(self, desc):
+        self.wfmf.update(desc)
+
     def render_frame(self, desc):
         assert isinstance(desc, madplot.FrameDescriptor)
 
-        png = self.moviemaker.next_frame()
-        canv = benu.benu.Canvas(png, self.w, self.h)
+        canv = self.moviemaker.new_canvas(self.w, self.h)
 
         try:
             self.wfmf.render(canv, self.panels['wide'], desc)
-            canv.save()
+            self.moviemaker.save_canvas(canv)
             self.i += 1
         except Exception:
             import traceback
             traceback.print_exc()
             print "error rendering", desc.df
 
-        return png
+        return canv
 
 
 if __name__ == "__main__":
@@ -61,6 +66,8 @@ if __name__ == "__main__":
     parser.add_argument('--show-arena', action='store_true', default=False, help='show arena')
     parser.add_argument('--fps', type=int, default=20, help='framenumber')
     parser.add_argument('--hist', type=int, default=400, help='show this many points of trajectory history')
+    parser.add_argument('--processes', type=int, default=None, help='render using this many processes (default: all cores)')
+    parser.add_argument('--raster', action='store_true', default=False, help='draw with the (faster, not antialiased) raster canvas')
 
     args = parser.parse_args()
     path = args.path[0]
@@ -87,50 +94,9 @@ if __name__ == "__main__":
     except AttributeError:
         wts = df['t_framenumber'].dropna().unique()
 
-    pbar = madplot.get_progress_bar("computing frames", len(wts))
-
-    frames = []
-    for i,(wt0,wt1) in enumerate(madplot.pairwise(wts)):
-
-        pbar.update(i)
-
-        fdf = madplot.get_framedf(df,wt1)
-        lfdf = len(fdf)
-
-        if lfdf:
-            try:
-                most_recent_time = madplot.get_framedf(df, wt1).index[-1]
-
-                minidf = df[madplot.get_framedf(df, wt0).index[0]:most_recent_time]
-                last_head_row = minidf[minidf['h_framenumber'].notnull()].tail(1)
-
-                last_laser_row = minidf[minidf['lobj_id'].notnull()].tail(1)
-
-                w_frame = madplot.FMFFrame(
-                            *madplot.get_offset_and_nearest_fmf_timestamp(wts, float(wt1)))
-
-                epoch = most_recent_time.asm8.astype(np.int64) / 1e9
-                fd = madplot.FrameDescriptor(
-                                w_frame, None, 
-                                fdf.merge(pd.merge(last_head_row, last_laser_row, 'outer'),'outer'),
-                                epoch
-                )
-
-                frames.append(fd)
-
-                #FIXME: fails at movies longer than 27000 frames for unknown
-                #reasons
-                if len(frames) > 27000: break
-
-                if 'TEST_MOVIES' in os.environ:
-                    if len(frames) > 50: break
-
-            except (IndexError, TypeError):
-                import traceback
-                traceback.print_exc()
-                print "frame",i,"error: no frame descriptor generated\n",fdf
-
-    pbar.finish()
+    #FIXME: fails at movies longer than 27000 frames for unknown reasons
+    maxframes = 51 if 'TEST_MOVIES' in os.environ else 27001
+    frames = list(itertools.islice(flymad.framesched.iter_wide_frames(df, wts), maxframes))
 
     if not frames:
         print "no frames to render"
@@ -152,24 +118,16 @@ if __name__ == "__main__":
 
     actual_w, actual_h = benu.utils.negotiate_panel_size_same_height(panels, fmfwidth)
 
-    moviemaker = madplot.MovieMaker(basename=os.path.basename(path), fps=args.fps)
-
-    ass = Assembler(actual_w, actual_h,
-                    panels, 
-                    wfmf,
-                    moviemaker,
-    )
-
-    pbar = madplot.get_progress_bar(moviemaker.movie_fname, len(frames))
-
-    for i,desc in enumerate(frames):
-        ass.render_frame(desc)
-        pbar.update(i)
-
-    pbar.finish()
-
-    moviefname = moviemaker.render(args.outdir if args.outdir else os.path.dirname(path))
+    def make_assembler(moviemaker):
+        wfmf.reopen()
+        return Assembler(actual_w, actual_h,
+                         panels, 
+                         wfmf,
+                         moviemaker,
+        )
+
+    moviefname = madplot.render_movie_parallel(make_assembler, frames,
+                    args.outdir if args.outdir else os.path.dirname(path),
+                    os.path.basename(path),
+                    fps=args.fps, warmup=args.hist, processes=args.processes, raster=args.raster)
     print "wrote", moviefname
-
-    moviemaker.cleanup()
-
@@ -10,6 +10,8 @@ import benu.utils
 
 import roslib; roslib.load_manifest('flymad')
 import flymad.madplot as madplot
+import flymad.framesched
+import flymad.schema
 
 assert benu.__version__ >= "0.1.0"
 
@@ -27,67 +29,25 @@ class Assembler:
         self.i = 0
         self.moviemaker = moviemaker
 
+    def warm_frame(self, desc):
+        self.wfmf.update(desc)
+        self.zfmf.update(desc)
+        self.plotttm.update(desc)
+
     def render_frame(self, desc):
         assert isinstance(desc, madplot.FrameDescriptor)
 
-        png = self.moviemaker.next_frame()
-        canv = benu.benu.Canvas(png, self.w, self.h)
+        canv = self.moviemaker.new_canvas(self.w, self.h)
 
         self.wfmf.render(canv, self.panels['wide'], desc)
         self.zfmf.render(canv, self.panels['zoom'], desc)
         self.plotttm.render(canv, self.panels['plot'], desc)
 
-        canv.save()
+        self.moviemaker.save_canvas(canv)
         self.i += 1
 
-        return png
-
-def build_framedesc_list(pool_df, wt, zt):
-    frames = []
-
-    for z in zt:
-        z_frameoffset = np.where(zt == z)[0][0]
-        z_frameno = int(z)
-        assert z_frameno == z
-
-        row = None
-
-        for idx,hmatchingrow in (pool_df[pool_df['h_framenumber'] == z_frameno]).iterrows():
-
-            isnull = hmatchingrow.isnull()
-            if isnull.any():
-                if isnull['theta'] and (isnull.values.sum() == 1):
-                    #only theta is missing, that is harmless
-                    pass
-                else:
-                    #missing data
-                    continue
-
-            try:
-                t_frameno = int(hmatchingrow['t_framenumber'])
-                assert t_frameno == hmatchingrow['t_framenumber']
-            except ValueError:
-                #nan
-                continue
-
-            try:
-                w_frameoffset = np.where(wt == t_frameno)[0][0]
-                row = hmatchingrow
-                w_frameno = t_frameno
-            except IndexError:
-                continue
-
-        if row is not None:
-
-            w_frame = madplot.FMFFrame(w_frameoffset, w_frameno)
-            z_frame = madplot.FMFFrame(z_frameoffset, z_frameno)
-            epoch = idx.asm8.astype(np.int64) / 1e9
+        return canv
 
-            fd = madplot.FrameDescriptor(w_frame, z_frame, hmatchingrow, epoch)
-
-            frames.append(fd)
-
-    return frames
 
 if __name__ == "__main__":
     import argparse
@@ -97,6 +57,8 @@ if __name__ == "__main__":
     parser.add_argument('--wide-fmf', help='wide fmf file to render the trajectory over', required=True)
     parser.add_argument('--zoom-fmf', help='wide fmf file to render the trajectory over', required=True)
     parser.add_argument('--outdir', help='destination directory for mp4')
+    parser.add_argument('--processes', type=int, default=None, help='render using this many processes (default: all cores)')
+    parser.add_argument('--raster', action='store_true', default=False, help='draw with the (faster, not antialiased) raster canvas')
 
     args = parser.parse_args()
 
@@ -111,15 +73,17 @@ if __name__ == "__main__":
     arena = madplot.Arena(False)
 
     print "loading data"
-    df = madplot.load_bagfile_single_dataframe(BAG_FILE, arena, ffill=True)
+    #one row per zoom frame, with the tracking and targeting as of that frame
+    df = madplot.load_bagfile_single_dataframe(BAG_FILE, arena, ffill=False, align='ttm')
     wt = wfmf.fmf.get_all_timestamps()
     zt = zfmf.fmf.get_all_timestamps()
 
-    if len(df['tobj_id'].dropna().unique()) != 1:
+    tobj_ids = df['tobj_id'].values
+    if len(np.unique(tobj_ids[tobj_ids != flymad.schema.INT_SENTINEL])) != 1:
         print "TTM movies require single unique object IDs, I think..."
         sys.exit(1)
 
-    frames = build_framedesc_list(df, wt, zt)
+    frames = list(flymad.framesched.iter_ttm_frames(df, wt, zt))
     if not frames:
         print "no frames to render"
         sys.exit(0)
@@ -161,29 +125,26 @@ if __name__ == "__main__":
             device_y0=actual_h-PH, device_y1=actual_h
     )
 
-    moviemaker = madplot.MovieMaker(basename=os.path.basename(BAG_FILE))
-
-    ass = Assembler(actual_w, actual_h,
-                    panels, 
-                    wfmf,zfmf,ttlplotter,
-                    moviemaker,
-    )
-
-    pbar = madplot.get_progress_bar(moviemaker.movie_fname, len(frames))
-
-    for i,desc in enumerate(frames):
-        ass.render_frame(desc)
-        pbar.update(i)
-
-        if 'TEST_MOVIES' in os.environ:
-            if i > 50: break
-
-    pbar.finish()
-
-    moviefname = moviemaker.render(args.outdir if args.outdir else os.path.dirname(BAG_FILE))
+    if 'TEST_MOVIES' in os.environ:
+        frames = frames[:52]
+
+    def make_assembler(moviemaker):
+        wfmf.reopen()
+        zfmf.reopen()
+        return Assembler(actual_w, actual_h,
+                         panels, 
+                         wfmf,zfmf,ttlplotter,
+                         moviemaker,
+        )
+
+    #the trajectory and ttl plots show a history of previous frames
+    warmup = max(wfmf.xhist.maxlen, int(ttlplotter.dx.maxlen))
+
+    moviefname = madplot.render_movie_parallel(make_assembler, frames,
+                    args.outdir if args.outdir else os.path.dirname(BAG_FILE),
+                    os.path.basename(BAG_FILE),
+                    warmup=warmup, processes=args.processes, raster=args.raster)
     print "wrote", moviefname
 
-    moviemaker.cleanup()
-
     
 
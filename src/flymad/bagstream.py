@@ -0,0 +1,163 @@
+import datetime
+import collections
+
+import numpy as np
+import pandas as pd
+
+import roslib; roslib.load_manifest('flymad')
+import rospy
+import rosbag
+
+import flymad.madplot as madplot
+import flymad.regions
+import flymad.schema
+
+class BagChunk:
+    """
+    one time window of a bag file. dfs (same keys as load_bagfile) hold the
+    window [t0,t1) plus the overlap either side of it, core() returns only
+    the rows inside the window, so that metrics are not counted twice.
+    """
+
+    def __init__(self, number, t0, t1, geom, dfs, tz):
+        self.number = number
+        self.t0 = t0
+        self.t1 = t1
+        self.geom = geom
+        self.dfs = dfs
+        self._tz = tz
+
+    def core(self, name):
+        df = self.dfs[name]
+        if df is None or len(df) == 0:
+            return df
+        c0 = datetime.datetime.fromtimestamp(self.t0, self._tz)
+        c1 = datetime.datetime.fromtimestamp(self.t1, self._tz)
+        return df[(df.index >= c0) & (df.index < c1)]
+
+def _read_geom(bag):
+    #the geometry is typically only published once, at the start
+    geom = tuple()
+    for topic,msg,rostime in bag.read_messages(topics=["/draw_geom/poly"]):
+        geom = ([pt.x for pt in msg.points], [pt.y for pt in msg.points])
+    return geom
+
+def default_overlap_seconds():
+    """
+    the kalman smoother transient (the steps until its gains reach steady
+    state), plus a second for the velocity gradient
+    """
+    return madplot.Kalman().get_transient_seconds() + 1.0
+
+def iter_bagfile_chunks(bagpath, arena, chunk_seconds=300.0, overlap_seconds=None, smooth=False, extra_topics=None, tzname=None):
+    """
+    yields BagChunk objects of chunk_seconds length, so multi-hour bag files
+    can be analysed in bounded memory.
+
+    each chunk is read and smoothed with overlap_seconds (by default
+    default_overlap_seconds()) of extra data either side so that the kalman
+    smoother and the velocity gradient are (nearly) identical to processing
+    the whole file at once. unlike load_bagfile, short trajectories are not
+    filtered (their length is not known until the end).
+    """
+    if overlap_seconds is None:
+        overlap_seconds = default_overlap_seconds()
+
+    arena.update_from_calibration(bagpath)
+    tz = madplot.get_tz(tzname)
+
+    bag = rosbag.Bag(bagpath)
+    try:
+        geom = _read_geom(bag)
+        poly = arena.get_intersect_polygon(geom)
+
+        tstart = bag.get_start_time()
+        tend = bag.get_end_time()
+
+        number = 0
+        t0 = tstart
+        while t0 < tend:
+            t1 = min(t0 + chunk_seconds, tend + 1e-6)
+
+            print "streaming %s chunk %d (%.0fs - %.0fs)" % (bagpath, number, t0-tstart, t1-tstart)
+
+            _, l_df, t_df, h_df, e_df = madplot.read_bagfile_tables(
+                                            bag, arena, tz, extra_topics,
+                                            start_time=rospy.Time.from_sec(max(tstart, t0-overlap_seconds)),
+                                            end_time=rospy.Time.from_sec(t1+overlap_seconds))
+
+            madplot.smooth_tracked(t_df, arena, smooth, processes=1)
+            t_df['in_area'] = flymad.regions.contains(poly, t_df['x'].values, t_df['y'].values)
+            t_df['experiment'] = 0
+
+            l_df['laser_state'] = (l_df['laser_power'] > 0).astype(int)
+
+            dfs = {"targeted":l_df, "tracked":t_df, "ttm":h_df, "extra":e_df}
+            flymad.schema.apply_schemas(dfs)
+
+            yield BagChunk(number, t0, t1, geom, dfs, tz)
+
+            number += 1
+            t0 = t1
+    finally:
+        bag.close()
+
+class TimeInAreaAccumulator:
+    """percentage of time (samples) each tracked object spent in the area"""
+
+    def __init__(self):
+        self.n = collections.defaultdict(int)
+        self.n_in = collections.defaultdict(int)
+
+    def update(self, t_df):
+        for oid,g in t_df.groupby('tobj_id'):
+            self.n[oid] += len(g)
+            self.n_in[oid] += int(g['in_area'].sum())
+
+    def result(self):
+        return {oid:100.0*self.n_in[oid]/self.n[oid] for oid in self.n}
+
+class VelocityAccumulator:
+    """running count, mean, std and max of a velocity column per tracked object"""
+
+    def __init__(self, col='v'):
+        self.col = col
+        self.n = collections.defaultdict(int)
+        self.s = collections.defaultdict(float)
+        self.ss = collections.defaultdict(float)
+        self.max = collections.defaultdict(lambda: -np.inf)
+
+    def update(self, t_df):
+        for oid,g in t_df.groupby('tobj_id'):
+            v = g[self.col].values
+            v = v[np.isfinite(v)]
+            if len(v) == 0:
+                continue
+            self.n[oid] += len(v)
+            self.s[oid] += v.sum()
+            self.ss[oid] += (v**2).sum()
+            self.max[oid] = max(self.max[oid], v.max())
+
+    def result(self):
+        oids = sorted(self.n)
+        n = np.array([self.n[o] for o in oids], dtype=float)
+        mean = np.array([self.s[o] for o in oids]) / n
+        var = np.array([self.ss[o] for o in oids]) / n - mean**2
+        return pd.DataFrame({'n':n,
+                             'mean':mean,
+                             'std':np.sqrt(np.clip(var, 0, np.inf)),
+                             'max':[self.max[o] for o in oids]},
+                            index=oids)
+
+def accumulate_bagfile(bagpath, arena, accumulators, table='tracked', **kwargs):
+    """
+    streams bagpath in chunks (kwargs are passed to iter_bagfile_chunks) and
+    updates every accumulator with the non-overlapping rows of each chunk
+    """
+    for chunk in iter_bagfile_chunks(bagpath, arena, **kwargs):
+        df = chunk.core(table)
+        if df is None or len(df) == 0:
+            continue
+        for acc in accumulators:
+            acc.update(df)
+    return [acc.result() for acc in accumulators]
@@ -0,0 +1,214 @@
+import numpy as np
+import pandas as pd
+import scipy.stats
+
+class BinnedStats:
+    """
+    per (bin, fly) aggregates of stat_colname, for comparing many genotypes
+    bin by bin (see madplot.calc_p_values). data is {genotype:{'df':df}},
+    each df having columns align_colname, stat_colname, 't' and 'obj_id'.
+
+    like calc_p_values, the bins of a comparison span the align_colname
+    range of its first genotype, so the aggregates of every genotype are
+    computed once per first (reference) genotype and shared between all the
+    comparisons against it.
+    """
+
+    def __init__(self, data, align_colname, stat_colname, num_bins=50, bin_how='mean'):
+        if bin_how not in ('mean', 'median'):
+            raise ValueError("bin_how must be 'mean' or 'median'")
+        self._data = data
+        self.align_colname = align_colname
+        self.stat_colname = stat_colname
+        self.num_bins = num_bins
+        self.bin_how = bin_how
+
+        self._cols = {}
+        self._bins = {}
+        self._aggs = {}
+
+    def _get_cols(self, name):
+        try:
+            return self._cols[name]
+        except KeyError:
+            df = self._data[name]['df']
+            cols = self._cols[name] = dict(
+                        align=np.asarray(df[self.align_colname].values, dtype=np.float64),
+                        stat=np.asarray(df[self.stat_colname].values, dtype=np.float64),
+                        t=np.asarray(df['t'].values, dtype=np.float64),
+                        obj_id=np.asarray(df['obj_id'].values, dtype=np.float64))
+            return cols
+
+    def get_bins(self, ref):
+        """returns the bin edges for comparisons against ref"""
+        try:
+            return self._bins[ref]
+        except KeyError:
+            align = self._get_cols(ref)['align']
+            align_start = np.nanmin(align)
+            dalign = np.nanmax(align) - align_start
+            bins = self._bins[ref] = np.linspace(0,dalign,self.num_bins+1) + align_start
+            return bins
+
+    def _digitize(self, ref, name):
+        #like pd.cut, bins are closed on the right and values outside
+        #(including the first edge, and NaN) are not in any bin
+        b = np.searchsorted(self.get_bins(ref), self._get_cols(name)['align'], side='left') - 1
+        b[(b < 0) | (b >= self.num_bins)] = -1
+        return b
+
+    def _aggregate(self, ref, name):
+        cols = self._get_cols(name)
+        b = self._digitize(ref, name)
+        ok = (b >= 0) & ~np.isnan(cols['obj_id'])
+
+        b = b[ok]
+        obj_id = cols['obj_id'][ok]
+        stat = cols['stat'][ok]
+
+        order = np.lexsort((obj_id, b))
+        b = b[order]
+        obj_id = obj_id[order]
+        stat = stat[order]
+
+        if len(b):
+            newgroup = np.r_[True, (b[1:] != b[:-1]) | (obj_id[1:] != obj_id[:-1])]
+            starts = np.flatnonzero(newgroup)
+        else:
+            starts = np.zeros(0, dtype=int)
+
+        if self.bin_how == 'mean':
+            if len(starts):
+                values = np.add.reduceat(stat, starts) / np.diff(np.r_[starts, len(stat)])
+            else:
+                values = np.zeros(0)
+        else:
+            values = np.array([np.median(s) for s in np.split(stat, starts[1:])]) if len(starts) else np.zeros(0)
+
+        #the values of bin i are values[offsets[i]:offsets[i+1]]
+        counts = np.bincount(b[starts], minlength=self.num_bins)
+        offsets = np.r_[0, np.cumsum(counts)]
+        return offsets, values
+
+    def get_aggregates(self, ref, name):
+        """
+        returns (offsets, values), the per fly aggregate of each bin (of ref)
+        of genotype name are values[offsets[i]:offsets[i+1]]
+        """
+        key = ref, name
+        try:
+            return self._aggs[key]
+        except KeyError:
+            agg = self._aggs[key] = self._aggregate(ref, name)
+            return agg
+
+    def get_bin_times(self, ref):
+        """returns the first and last 't' of ref in each bin (NaN if empty)"""
+        b = self._digitize(ref, ref)
+        t = self._get_cols(ref)['t']
+        ok = (b >= 0) & ~np.isnan(t)
+        b = b[ok]
+        t = t[ok]
+
+        start = np.empty(self.num_bins)
+        start.fill(np.nan)
+        stop = start.copy()
+
+        order = np.argsort(b, kind='mergesort')
+        b = b[order]
+        t = t[order]
+        if len(b):
+            starts = np.flatnonzero(np.r_[True, b[1:] != b[:-1]])
+            start[b[starts]] = np.minimum.reduceat(t, starts)
+            stop[b[starts]] = np.maximum.reduceat(t, starts)
+        return start, stop
+
+    def p_values(self, gt1_name, gt2_name, name1=None, name2=None, permutations=0, seed=0, min_n=5):
+        """
+        returns a dataframe with one row per bin where both genotypes have
+        more than min_n flies, holding the Kruskal-Wallis p value (P) and, if
+        permutations > 0, a permutation test p value of the difference of
+        the means of the fly aggregates (P_perm).
+        """
+        off1, vals1 = self.get_aggregates(gt1_name, gt1_name)
+        off2, vals2 = self.get_aggregates(gt1_name, gt2_name)
+        start, stop = self.get_bin_times(gt1_name)
+        labels = self.get_bins(gt1_name)[:-1]
+
+        rng = np.random.RandomState(seed)
+
+        rows = []
+        for i,x in enumerate(labels):
+            test1 = vals1[off1[i]:off1[i+1]]
+            test2 = vals2[off2[i]:off2[i+1]]
+
+            if len(test1)<=min_n or len(test2)<=min_n:
+                # reaching end of data - stop
+                continue
+
+            try:
+                hval, pval = scipy.stats.kruskal(test1, test2)
+            except ValueError:
+                pval = 1.0
+
+            row = {'Bin_number': x,
+                   'P': pval,
+                   'bin_start_time':start[i],
+                   'bin_stop_time':stop[i],
+                   'name1':name1 if name1 is not None else gt1_name,
+                   'name2':name2 if name2 is not None else gt2_name,
+                   'test1_n':len(test1),
+                   'test2_n':len(test2),
+                   }
+            if permutations > 0:
+                row['P_perm'] = permutation_test(test1, test2, permutations, rng)
+            rows.append(row)
+
+        if not rows:
+            return pd.DataFrame()
+
+        return pd.DataFrame(rows, index=[r['Bin_number'] for r in rows])
+
+def permutation_test(a, b, permutations, rng=np.random):
+    """
+    two sided permutation test of the difference of the means of a and b,
+    all permutations are drawn at once
+    """
+    x = np.r_[a, b]
+    n1 = len(a)
+    d = abs(np.mean(a) - np.mean(b))
+
+    perm = np.argsort(rng.random_sample((permutations, len(x))), axis=1)
+    px = x[perm]
+    dp = np.abs(px[:,:n1].mean(axis=1) - px[:,n1:].mean(axis=1))
+
+    #allow for rounding differences from summing in another order
+    n = (dp >= d - 1e-12*abs(d)).sum()
+    return (1.0 + n) / (permutations + 1.0)
+
+def test_binned_stats():
+    np.random.seed(3)
+    data = {}
+    for gt,offset in (('a', 0.0), ('b', 1.0), ('c', 0.0)):
+        n = 3000
+        data[gt] = {'df':pd.DataFrame({
+                            't_align':np.random.uniform(-5, 15, n),
+                            'v':np.random.randn(n) + offset,
+                            'obj_id':np.random.randint(0, 12, n).astype(float),
+                            't':np.random.uniform(0, 100, n)})}
+
+    s = BinnedStats(data, 't_align', 'v', num_bins=4)
+    bins = s.get_bins('a')
+    off, vals = s.get_aggregates('a', 'b')
+
+    dfb = data['b']['df']
+    for i in range(4):
+        m = (dfb['t_align'] > bins[i]) & (dfb['t_align'] <= bins[i+1])
+        expected = [g['v'].values.mean() for _,g in dfb[m].groupby('obj_id')]
+        assert np.allclose(vals[off[i]:off[i+1]], expected)
+
+    p = s.p_values('a', 'b', permutations=200)
+    assert len(p) == 4
+    assert (p['P'] < 0.001).all()
+    assert (p['P_perm'] < 0.01).all()
+    assert (s.p_values('a', 'c')['P'] > 0.001).all()
@@ -0,0 +1,246 @@
+import os.path
+import glob
+import time
+import bisect
+import sqlite3
+import collections
+
+import flymad.filename_regexes as filename_regexes
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT,
+    ext TEXT,
+    mtime REAL,
+    size INTEGER,
+    valid INTEGER,
+    descr TEXT,
+    genotype TEXT,
+    laser TEXT,
+    repid TEXT,
+    camn TEXT,
+    t REAL
+);
+CREATE INDEX IF NOT EXISTS files_dir_ext_t ON files (directory, ext, t);
+CREATE INDEX IF NOT EXISTS files_ext_t ON files (ext, t);
+CREATE INDEX IF NOT EXISTS files_gt ON files (genotype, laser, repid);
+"""
+
+_COLUMNS = ('path', 'directory', 'ext', 'mtime', 'size', 'valid',
+            'descr', 'genotype', 'laser', 'repid', 'camn', 't')
+
+CatalogEntry = collections.namedtuple('CatalogEntry', ' '.join(_COLUMNS))
+
+def _parse(path, ext):
+    #returns the parsed columns, or None if the file is incorrectly named
+    _,regex = filename_regexes._MATCH_PATTERNS[ext]
+    try:
+        info = filename_regexes.parse_filename(path, regex)
+        t = time.mktime(filename_regexes.parse_date(path, regex))
+    except filename_regexes.RegexError:
+        return None
+
+    try:
+        info = filename_regexes.parse_filename(path, regex, extract_genotype_and_laser=True)
+    except ValueError:
+        #desc is not genotype-laser[-repid]
+        pass
+
+    return (info.get('desc'), info.get('genotype'), info.get('laser'),
+            info.get('repid'), info.get('camn'), t)
+
+class Catalog:
+    """
+    an index of the bag, mp4, (c)fmf and csv files in data directories. names
+    and dates are parsed once (using filename_regexes) and kept, with the
+    file size and modification time, in an sqlite database so rescanning
+    only parses new or changed files. the default database is in memory.
+    """
+
+    def __init__(self, dbpath=':memory:'):
+        self.dbpath = dbpath
+        self._db = sqlite3.connect(dbpath)
+        #paths are byte strings, like those from glob
+        self._db.text_factory = str
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def scan(self, directory, exts=('bag', 'mp4', 'fmf', 'csv'), recursive=False, verbose=True):
+        """
+        (re)indexes the files with the given extensions (fmf includes
+        cfmf) in directory, returns the number of new or changed files
+        """
+        directory = os.path.abspath(directory)
+        exts = [e for ext in exts for e in filename_regexes.get_exts(ext)]
+
+        paths = []
+        for ext in exts:
+            if recursive:
+                for dirpath, dirnames, filenames in os.walk(directory):
+                    paths.extend((os.path.join(dirpath,f),ext) for f in filenames if f.endswith('.'+ext))
+            else:
+                paths.extend((p,ext) for p in glob.glob(os.path.join(directory,'*.%s' % ext)))
+
+        known = {}
+        if recursive:
+            q = "SELECT path, mtime, size FROM files WHERE directory = ? OR directory LIKE ?"
+            args = (directory, os.path.join(directory,'%'))
+        else:
+            q = "SELECT path, mtime, size FROM files WHERE directory = ?"
+            args = (directory,)
+        for path, mtime, size in self._db.execute(q, args):
+            known[path] = (mtime, size)
+
+        rows = []
+        seen = set()
+        for path,ext in paths:
+            seen.add(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if known.get(path) == (st.st_mtime, st.st_size):
+                continue
+
+            parsed = _parse(path, ext)
+            if parsed is None:
+                if verbose:
+                    print "invalid filename", path
+                parsed = (None,)*6
+            rows.append((path, os.path.dirname(path), ext, st.st_mtime, st.st_size,
+                         int(parsed[-1] is not None)) + parsed)
+
+        gone = [(p,) for p in known if p not in seen and os.path.splitext(p)[1][1:] in exts]
+
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO files VALUES (%s)" % ','.join('?'*len(_COLUMNS)), rows)
+            self._db.executemany("DELETE FROM files WHERE path = ?", gone)
+
+        return len(rows)
+
+    def _select(self, where, args, order='t, path'):
+        q = "SELECT %s FROM files" % ', '.join(_COLUMNS)
+        if where:
+            q += " WHERE " + " AND ".join(where)
+        q += " ORDER BY " + order
+        return [CatalogEntry(*r) for r in self._db.execute(q, args)]
+
+    def get_files(self, ext=None, directory=None, include_invalid=False, **kwargs):
+        """
+        returns the CatalogEntry for every file matching the given ext
+        (fmf includes cfmf), directory and any of the columns genotype,
+        laser, repid, camn, descr, sorted by time
+        """
+        where = []
+        args = []
+        if ext is not None:
+            exts = filename_regexes.get_exts(ext)
+            where.append("ext IN (%s)" % ','.join('?'*len(exts)))
+            args.extend(exts)
+        if directory is not None:
+            where.append("directory = ?")
+            args.append(os.path.abspath(directory))
+        if not include_invalid:
+            where.append("valid = 1")
+        for col,val in kwargs.iteritems():
+            if col not in _COLUMNS:
+                raise ValueError("unknown column: %s" % col)
+            where.append("%s = ?" % col)
+            args.append(val)
+        entries = self._select(where, args)
+
+        if ext is not None and len(exts) > 1:
+            #the same movie in more than one format, keep the preferred one
+            best = {}
+            for e in entries:
+                stem = os.path.splitext(e.path)[0]
+                if stem not in best or exts.index(e.ext) < exts.index(best[stem].ext):
+                    best[stem] = e
+            entries = [e for e in entries if best[os.path.splitext(e.path)[0]] is e]
+
+        return entries
+
+    def find_nearest(self, ext, t, maxdt, directory=None):
+        """
+        returns the CatalogEntry of the file whose time is closest to t (and
+        less than maxdt seconds from it), or None
+        """
+        exts = filename_regexes.get_exts(ext)
+        where = ["ext IN (%s)" % ','.join('?'*len(exts)), "valid = 1", "t > ?", "t < ?"]
+        args = list(exts) + [t - maxdt, t + maxdt]
+        if directory is not None:
+            where.insert(0, "directory = ?")
+            args.insert(0, os.path.abspath(directory))
+        entries = self._select(where, args)
+        if not entries:
+            return None
+        return min(entries, key=lambda e: abs(e.t - t))
+
+    def get_matching_files(self, exta, extb, maxdt=20, dira=None, dirb=None):
+        """
+        returns a list of (a, b, dt), CatalogEntry for every pair of files
+        less than maxdt seconds apart
+        """
+        afiles = self.get_files(exta, dira)
+        bfiles = self.get_files(extb, dirb)
+        bts = [b.t for b in bfiles]
+
+        matched = []
+        for a in afiles:
+            lo = bisect.bisect_right(bts, a.t - maxdt)
+            hi = bisect.bisect_left(bts, a.t + maxdt)
+            for b in bfiles[lo:hi]:
+                dt = abs(a.t - b.t)
+                if dt < maxdt:
+                    matched.append((a, b, dt))
+        return matched
+
+def test_catalog():
+    import tempfile
+    import shutil
+
+    d = tempfile.mkdtemp()
+    try:
+        for f in ("rosbagOut_2014-02-23-16-28-08.bag",
+                  "rosbagOut_2014-02-23-17-00-00.bag",
+                  "wGP-140hpc-01_20140223_162808.mp4",
+                  "wGP-140hpc-02_20140223_165955.mp4",
+                  "badname.mp4"):
+            open(os.path.join(d,f),'w').close()
+
+        c = Catalog()
+        assert c.scan(d, verbose=False) == 5
+        assert c.scan(d, verbose=False) == 0
+
+        assert len(c.get_files('mp4')) == 2
+        assert len(c.get_files('mp4', include_invalid=True)) == 3
+        e, = c.get_files(genotype='wGP', repid='02')
+        assert e.laser == '140hpc'
+
+        m = c.get_matching_files('mp4', 'bag', maxdt=20)
+        assert sorted((os.path.basename(a.path), dt) for a,b,dt in m) == \
+                [("wGP-140hpc-01_20140223_162808.mp4", 0), ("wGP-140hpc-02_20140223_165955.mp4", 5)]
+
+        b = c.find_nearest('bag', e.t, 10)
+        assert os.path.basename(b.path) == "rosbagOut_2014-02-23-17-00-00.bag"
+        assert c.find_nearest('bag', e.t + 100, 10) is None
+
+        os.unlink(os.path.join(d,"badname.mp4"))
+        c.scan(d, verbose=False)
+        assert len(c.get_files('mp4', include_invalid=True)) == 2
+
+        #compressed movies are found as fmfs, the fmf is preferred
+        for f in ("wGP-140hpc-01_wide_20140223_162809.fmf",
+                  "wGP-140hpc-01_wide_20140223_162809.cfmf",
+                  "wGP-140hpc-01_zoom_20140223_162809.cfmf"):
+            open(os.path.join(d,f),'w').close()
+        assert c.scan(d, ('fmf',), verbose=False) == 3
+        assert sorted(os.path.basename(e.path) for e in c.get_files('fmf')) == \
+                ["wGP-140hpc-01_wide_20140223_162809.fmf", "wGP-140hpc-01_zoom_20140223_162809.cfmf"]
+        assert len(c.get_files('cfmf')) == 2
+        assert len(c.get_matching_files('fmf', 'bag', maxdt=20)) == 2
+    finally:
+        shutil.rmtree(d)
@@ -5,9 +5,13 @@ roslib.load_manifest('flymad')
 
 import rosbag
 
+import os.path
+import datetime
+import itertools
+import multiprocessing
+
 import pandas as pd
 import numpy as np
-import datetime
 
 def _check_t(msg_t, rt, msg_name=''):
     dt = datetime.datetime.fromtimestamp(msg_t)
@@ -131,11 +135,110 @@ def create_df(bname):
 
     return df
 
+def get_output_fnames(bname, binary=False):
+    fnames = [bname+".csv"]
+    if binary:
+        fnames.append(bname+".npz")
+    return fnames
+
+def is_up_to_date(bname, binary=False):
+    """true if all outputs of bname exist and are newer than it"""
+    try:
+        bt = os.path.getmtime(bname)
+        return all(os.path.getmtime(f) >= bt for f in get_output_fnames(bname, binary))
+    except OSError:
+        return False
+
+def save_npz(df, fname):
+    """saves df as one (uncompressed, columnar) array per column"""
+    arrays = {"__index__":df.index.values}
+    for i,col in enumerate(df.columns):
+        arrays["c%d" % i] = df[col].values
+    arrays["__columns__"] = np.array([str(c) for c in df.columns])
+    #write then rename, so an interrupted conversion is never up to date
+    tmp = fname + ".tmp.npz"
+    np.savez(tmp, **arrays)
+    os.rename(tmp, fname)
+
+def load_npz(fname):
+    d = np.load(fname)
+    cols = d["__columns__"].tolist()
+    return pd.DataFrame({c:d["c%d" % i] for i,c in enumerate(cols)},
+                        index=d["__index__"],
+                        columns=cols)
+
+def convert_bagfile(bname, binary=False):
+    df = create_df(bname).fillna(method='pad')
+    fname = bname+".csv"
+    df.to_csv(fname+".tmp")
+    os.rename(fname+".tmp", fname)
+    if binary:
+        save_npz(df, bname+".npz")
+    return bname
+
+def _convert_bagfile(job):
+    bname, binary = job
+    try:
+        return convert_bagfile(bname, binary), None
+    except Exception, e:
+        return bname, "%s: %s" % (e.__class__.__name__, e)
+
+def find_bagfiles(paths):
+    """expands directories (recursively) to the .bag files they contain"""
+    bnames = []
+    for p in paths:
+        if os.path.isdir(p):
+            for dirpath, dirnames, filenames in os.walk(p):
+                bnames.extend(os.path.join(dirpath,f) for f in sorted(filenames) if f.endswith(".bag"))
+        else:
+            bnames.append(p)
+    return bnames
+
+def convert_bagfiles(bnames, binary=False, force=False, processes=None):
+    """
+    converts every bag file whose outputs are missing or older than it,
+    across a process pool. returns an iterator of (bname, error) in the
+    order they complete, error is None on success.
+    """
+    todo = [b for b in bnames if force or not is_up_to_date(b, binary)]
+    if not todo:
+        return iter([])
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(todo)))
+
+    jobs = [(b, binary) for b in todo]
+    if processes == 1:
+        return itertools.imap(_convert_bagfile, jobs)
+
+    pool = multiprocessing.Pool(processes)
+    results = pool.imap_unordered(_convert_bagfile, jobs)
+    pool.close()
+    return results
+
 if __name__ == "__main__":
     import sys
-    fname = sys.argv[1]
-    df = create_df(sys.argv[1])
-    df.fillna(method='pad').to_csv(fname+".csv")
-
+    import argparse
+
+    parser = argparse.ArgumentParser(description='convert bag files (or directories of them) to csv')
+    parser.add_argument('path', nargs='+', help='bag file or directory')
+    parser.add_argument('--binary', action='store_true', default=False,
+                        help='also save a binary columnar (.npz) copy')
+    parser.add_argument('--force', action='store_true', default=False,
+                        help='convert even if the outputs are up to date')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes (default: one per cpu)')
+    args = parser.parse_args()
+
+    bnames = find_bagfiles(args.path)
+    nerr = 0
+    for bname,err in convert_bagfiles(bnames, args.binary, args.force, args.processes):
+        if err is None:
+            print "wrote", bname+".csv"
+        else:
+            print "ERROR converting", bname, err
+            nerr += 1
 
+    sys.exit(1 if nerr else 0)
 
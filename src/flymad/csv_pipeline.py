@@ -0,0 +1,116 @@
+import os.path
+import hashlib
+import itertools
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+import flymad.flymad_analysis_dan as flymad_analysis
+
+#change this if the output of load_and_smooth_csv changes
+PIPELINE_VERSION = 1
+
+def get_cache_fname(csvfile):
+    return csvfile + '.preproc.npz'
+
+def _arena_key(arena):
+    if arena is None:
+        return 'None'
+    return repr(tuple(getattr(arena, a, None) for a in
+                      ('_x','_y','_r','_xlim','_ylim','_convert','_rw','_sx','_sy')))
+
+def get_cache_key(csvfile, arena, smooth, resample_specifier):
+    """a hash of the csv file contents and the preprocessing parameters"""
+    h = hashlib.sha1()
+    with open(csvfile, 'rb') as f:
+        for buf in iter(lambda: f.read(1<<20), ''):
+            h.update(buf)
+    h.update(repr((PIPELINE_VERSION, _arena_key(arena), bool(smooth), resample_specifier)))
+    return h.hexdigest()
+
+def _load_npz(fname):
+    try:
+        return np.load(fname, allow_pickle=True)
+    except TypeError:
+        #numpy < 1.10
+        return np.load(fname)
+
+def save_cache(results, key, cache_fname):
+    df,dt = results[0],results[1]
+    arrays = {'__key__':np.array(key),
+              '__index__':df.index.values.astype('datetime64[ns]').astype(np.int64),
+              '__index_name__':np.array(str(df.index.name)),
+              '__columns__':np.array([str(c) for c in df.columns]),
+              '__meta__':np.array([str(m) for m in results[2:]]),
+              '__dt__':np.asarray(dt)}
+    for i,col in enumerate(df.columns):
+        arrays['c%d' % i] = df[col].values
+    #write then rename, so a partial cache is never read
+    tmp = cache_fname + '.tmp.npz'
+    np.savez(tmp, **arrays)
+    os.rename(tmp, cache_fname)
+
+def get_cached_key(cache_fname):
+    #npz members are read lazily, so this does not load the dataframe
+    try:
+        return str(_load_npz(cache_fname)['__key__'])
+    except Exception:
+        return None
+
+def load_cache(key, cache_fname):
+    """returns the cached load_and_smooth_csv results, or None if stale"""
+    if not os.path.exists(cache_fname):
+        return None
+    try:
+        d = _load_npz(cache_fname)
+        if str(d['__key__']) != key:
+            return None
+        cols = d['__columns__'].tolist()
+        index = pd.DatetimeIndex(d['__index__'].astype('datetime64[ns]'))
+        name = str(d['__index_name__'])
+        index.name = None if name == 'None' else name
+        df = pd.DataFrame({c:d['c%d' % i] for i,c in enumerate(cols)},
+                          index=index, columns=cols)
+        return (df, d['__dt__']) + tuple(d['__meta__'].tolist())
+    except Exception, e:
+        print "loading cache failed %s (%s)" % (cache_fname, e)
+        return None
+
+def _preprocess(job):
+    csvfile, arena, smooth, resample_specifier = job
+    key = get_cache_key(csvfile, arena, smooth, resample_specifier)
+    cache_fname = get_cache_fname(csvfile)
+    if get_cached_key(cache_fname) == key:
+        return csvfile, key, True
+
+    results = flymad_analysis.load_and_smooth_csv(csvfile, arena, smooth, resample_specifier)
+    if results is None:
+        return csvfile, key, False
+
+    save_cache(results, key, cache_fname)
+    return csvfile, key, True
+
+def preprocess_csvs(csvfiles, arena, smooth, resample_specifier='10L', processes=None):
+    """
+    loads, resamples and smooths (see load_and_smooth_csv) many scored csv
+    files across a process pool. the results are cached next to each csv,
+    keyed by its contents and the parameters, so unchanged files are only
+    read from the cache. yields (csvfile, load_and_smooth_csv results, or
+    None if the file could not be loaded) in the order of csvfiles.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(csvfiles)))
+
+    jobs = [(c, arena, smooth, resample_specifier) for c in csvfiles]
+    if (processes == 1) or multiprocessing.current_process().daemon:
+        done = itertools.imap(_preprocess, jobs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        done = pool.imap(_preprocess, jobs)
+        pool.close()
+
+    #the workers only report success, the dataframes are read from the cache
+    for csvfile, key, ok in done:
+        yield csvfile, (load_cache(key, get_cache_fname(csvfile)) if ok else None)
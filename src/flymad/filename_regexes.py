@@ -16,9 +16,32 @@ _MATCH_PATTERNS = {
     "bag":(BAG_DATE_FMT,BAG_FILENAME_REGEX),
     "mp4":(MP4_DATE_FMT,MP4_FILENAME_REGEX),
     "fmf":(FMF_DATE_FMT,FMF_FILENAME_REGEX),
+    "cfmf":(FMF_DATE_FMT,FMF_FILENAME_REGEX),
     "csv":(MP4_DATE_FMT,MP4_FILENAME_REGEX),
 }
 
+#a compressed fmf (see flymad.fmf.compress_fmf) keeps the name of the fmf,
+#and is found wherever an fmf is looked for. the first is preferred if a
+#movie is present in both formats
+_EXT_ALIASES = {
+    "fmf":("fmf","cfmf"),
+}
+
+def get_exts(ext):
+    return _EXT_ALIASES.get(ext, (ext,))
+
+def glob_ext(pattern, ext):
+    """
+    returns the files matching pattern + '.' + ext, or one of its aliases
+    (e.g. fmf and cfmf). only the preferred one of files in more than one
+    format is returned
+    """
+    found = collections.OrderedDict()
+    for e in get_exts(ext):
+        for path in sorted(glob.glob('%s.%s' % (pattern, e))):
+            found.setdefault(os.path.splitext(path)[0], path)
+    return found.values()
+
 class RegexError(Exception):
     pass
 
@@ -55,40 +78,33 @@ def parse_date(path, regex=None):
             pass
     raise RegexError("incorrect date string: %s" % datestr)
 
-def get_matching_files(dira, exta, dirb, extb, maxdt=20):
-    da,ra = _MATCH_PATTERNS[exta]
-    db,rb = _MATCH_PATTERNS[extb]
+def get_matching_files(dira, exta, dirb, extb, maxdt=20, catalog=None):
+    """
+    returns a MatchPair for every pair of files (a in dira, b in dirb) whose
+    dates are less than maxdt seconds apart. pass a flymad.catalog.Catalog
+    to reuse (or persist) the parsed filenames.
+    """
+    import flymad.catalog
+
     klass = collections.namedtuple(
                 'MatchPair',
                 '%(exta)s %(exta)s_info %(exta)s_time '\
                 '%(extb)s %(extb)s_info %(extb)s_time '\
                 'dt' % {'exta':exta,'extb':extb})
 
-    afiles = glob.glob(os.path.join(dira,'*.%s' % exta))
-    bfiles = glob.glob(os.path.join(dirb,'*.%s' % extb))
-
-    matched = []
-
-    for a in afiles:
-        try:
-            ainfo = parse_filename(a, ra)
-            atime = parse_date(a, ra)
-        except RegexError, e:
-            print "invalid filename", a
-            continue
+    if catalog is None:
+        catalog = flymad.catalog.Catalog()
+    catalog.scan(dira, (exta,))
+    catalog.scan(dirb, (extb,))
 
-        for b in bfiles:
-            try:
-                binfo = parse_filename(b,rb)
-                btime = parse_date(b,rb)
-            except RegexError, e:
-                print "invalid filename", b
-                continue
+    _,ra = _MATCH_PATTERNS[exta]
+    _,rb = _MATCH_PATTERNS[extb]
 
-            dt = abs(time.mktime(atime) - time.mktime(btime))
-
-            if (dt < maxdt):
-                matched.append(klass(a,ainfo,atime,b,binfo,btime,dt))
+    matched = []
+    for a,b,dt in catalog.get_matching_files(exta, extb, maxdt, dira, dirb):
+        matched.append(klass(a.path,parse_filename(a.path,ra),parse_date(a.path,ra),
+                             b.path,parse_filename(b.path,rb),parse_date(b.path,rb),
+                             dt))
 
     return matched
 
@@ -99,6 +115,7 @@ if __name__ == "__main__":
              "wGP-140hpc-01_20140223_162808.mp4",
              "wGP-140hpc-01_20140223_162808.mp4.csv",
              "wGP-140hpc-01_wide_20140223_162809.fmf",
+             "wGP-140hpc-01_zoom_20140223_162809.cfmf",
              "db194-ok371-05_20140523_131735.bag",
              "wshits-120t-08_20140307_125321.mp4.csv",
              "OK371shits-nolaser-05_20140227_141405.mp4.csv",
@@ -19,6 +19,7 @@ from pandas.tseries.offsets import DateOffset
 SECOND_TO_NANOSEC = 1e9
 
 from trackingparams import Kalman
+import laser_epochs
 
 GENOTYPE_LABELS = {
     "wtrpmyc":"+/TRPA1","wtrp":"+/TRPA1",
@@ -422,10 +423,21 @@ def courtship_combine_csvs_to_dataframe(path, globpattern=None, as_is_laser_stat
         globpattern = '*.csv'
 
     globpattern = os.path.join(path,globpattern)
+    posfiles = sorted(glob.glob(globpattern))
 
-    for obj_id,posfile in enumerate(sorted(glob.glob(globpattern))):
+    #group the files of each repID (in one pass, keeping the sorted order)
+    replicates = {}
+    for posfile in posfiles:
+        try:
+            experimentID,date,time = os.path.basename(posfile).split("_",2)
+            genotype,laser,repID = experimentID.split("-",2)
+            repID = experimentID + "_" + date
+        except:
+            continue
+        replicates.setdefault(repID, []).append(posfile)
+
+    for obj_id,posfile in enumerate(posfiles):
         csvfilefn = os.path.basename(posfile)
-        df = pd.read_csv(posfile)
         try:
             experimentID,date,time = csvfilefn.split("_",2)
             genotype,laser,repID = experimentID.split("-",2)
@@ -436,30 +448,22 @@ def courtship_combine_csvs_to_dataframe(path, globpattern=None, as_is_laser_stat
         #CONCATENATE MATCHING IDs:
         if csvfilefn in filelist:
             continue   #avoid processing flies more than once.
+        df = pd.read_csv(posfile)
         filelist.append(csvfilefn)  
         print "processing:", csvfilefn         
-        for csvfile2 in sorted(glob.glob(globpattern)):
+        for csvfile2 in replicates[repID]:
             csvfile2fn = os.path.basename(csvfile2)
-            try:
-                experimentID2,date2,time2 = csvfile2fn.split("_",2)
-                genotype2,laser2,repID2 = experimentID2.split("-",2)
-                repID2 = experimentID2 + "_" + date2
-            except:
-                continue
             if csvfile2fn in filelist:
                 continue 
-            elif repID2 == repID:
-                if 'rescore' in csvfile2fn:
-                    print "    rescore:", csvfile2fn, " replaces ", csvfilefn
-                    continue
-                else:
-                    print "    concatenating:", csvfile2fn
-                    filelist.append(csvfile2fn)
-                    csv2df = pd.read_csv(csvfile2)
-                    csv2df = pd.DataFrame(csv2df)
-                    df = pd.concat([df, csv2df])
-            else:
+            elif 'rescore' in csvfile2fn:
+                print "    rescore:", csvfile2fn, " replaces ", csvfilefn
                 continue
+            else:
+                print "    concatenating:", csvfile2fn
+                filelist.append(csvfile2fn)
+                csv2df = pd.read_csv(csvfile2)
+                csv2df = pd.DataFrame(csv2df)
+                df = pd.concat([df, csv2df])
   
         #convert 'V', 'X' AND 'S' to 1 or 0
         df['zx'] = df['zx'].astype(object).fillna('x')
@@ -580,10 +584,9 @@ def align_t_by_laser_on(df, min_experiment_duration, resample_bin='10L', align_f
     #
     #gradient on an array of 0/1 using a distance of 1 (default) uses
     #one sample each side, giving 2x the number of non-zero values.
-    dlaser = np.gradient( (df['laser_state'].values > 0).astype(int) ) > 0
-    #but if we treat the array as a string we can find those edges \x00\01
-    dlaser_str = dlaser.tostring()
-    rising_edges = [n for n in xrange(len(dlaser_str)) if dlaser_str.find('\x00\x01', n) == n]
+    #the edge is the sample before that (if there is one)
+    onsets = laser_epochs.get_gradient_onsets(df['laser_state'].values > 0)
+    rising_edges = onsets[onsets > 0] - 1
 
     n_rising_edges = len(rising_edges)
     print "\t%s laser pulses" % n_rising_edges
@@ -662,6 +665,30 @@ def extract_metadata_from_filename(csvfile):
 
     return experimentID,date,time,genotype,laser,repID
 
+#the letters used when scoring behaviours, unscored is 0
+SCORE_LETTERS = {
+    "zx":{"z":1.0,"x":0.0},
+    "as":{"a":1.0,"s":0.0},
+    "cv":{"c":1.0,"v":0.0},
+}
+
+def _score_converter(letters):
+    def convert(v):
+        try:
+            return letters[v]
+        except KeyError:
+            v = float(v) if v else np.nan
+            return 0.0 if np.isnan(v) else v
+    return convert
+
+def read_scored_csv(csvfile):
+    """
+    reads a scored csv (indexed by ns since epoch), the score columns
+    (zx, as, cv) are converted to 0.0/1.0 while parsing
+    """
+    converters = {c:_score_converter(l) for c,l in SCORE_LETTERS.iteritems()}
+    return pd.read_csv(csvfile, index_col=0, converters=converters)
+
 def load_and_smooth_csv(csvfile, arena, smooth, resample_specifier='10L'):
     metadata = extract_metadata_from_filename(csvfile)
     if metadata is None:
@@ -671,7 +698,7 @@ def load_and_smooth_csv(csvfile, arena, smooth, resample_specifier='10L'):
     experimentID,date,time,genotype,laser,repID = metadata
     print "processing:", experimentID
 
-    df = pd.read_csv(csvfile, index_col=0)
+    df = read_scored_csv(csvfile)
 
     if not df.index.is_unique:
         print "\tWARNING: corrupt csv: index (ns since epoch) must be unique"
@@ -683,21 +710,6 @@ def load_and_smooth_csv(csvfile, arena, smooth, resample_specifier='10L'):
     df = df.iloc[first_valid_row:]
     print "\tremove %d invalid rows at start of file" % first_valid_row
 
-    #convert 'V', 'X' AND 'S' to 1 or 0
-    df['zx'] = df['zx'].astype(object).fillna('x')
-    df['as'] = df['as'].astype(object).fillna('s')
-    df['cv'] = df['cv'].astype(object).fillna('v')
-    df['zx'][df['zx'] == 'z'] = 1
-    df['cv'][df['cv'] == 'c'] = 1
-    df['as'][df['as'] == 'a'] = 1
-    df['zx'][df['zx'] == 'x'] = 0
-    df['cv'][df['cv'] == 'v'] = 0
-    df['as'][df['as'] == 's'] = 0
-
-    #ensure these are floats incase we later resample
-    cols = ['zx','as','cv']
-    df[cols] = df[cols].astype(float)
-
     #resample to 10ms (mean) and set a proper time index on the df
     df = fixup_index_and_resample(df, resample_specifier)
 
@@ -729,7 +741,7 @@ def load_courtship_csv(path):
         experimentID,date,time,genotype,laser,repID = metadata
         print "processing:", csvfilefn
 
-        df = pd.read_csv(csvfile, index_col=0)
+        df = read_scored_csv(csvfile)
 
         if not df.index.is_unique:
             print "\tWARNING: corrupt csv: index (ns since epoch) must be unique"
@@ -746,21 +758,6 @@ def load_courtship_csv(path):
         df['time'] = df.index.values.astype('datetime64[ns]')
         df.set_index(['time'], inplace=True)
 
-        #convert 'V', 'X' AND 'S' to 1 or 0
-        df['zx'] = df['zx'].astype(object).fillna('x')
-        df['as'] = df['as'].astype(object).fillna('s')
-        df['cv'] = df['cv'].astype(object).fillna('v')
-        df['zx'][df['zx'] == 'z'] = 1
-        df['cv'][df['cv'] == 'c'] = 1
-        df['as'][df['as'] == 'a'] = 1
-        df['zx'][df['zx'] == 'x'] = 0
-        df['cv'][df['cv'] == 'v'] = 0
-        df['as'][df['as'] == 's'] = 0
-
-        #ensure these are floats incase we later resample
-        cols = ['zx','as','cv']
-        df[cols] = df[cols].astype(float)
-
         #give files a semi-random obj_id
         df['obj_id'] = create_object_id(date,time)
 
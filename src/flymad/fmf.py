@@ -0,0 +1,552 @@
+import os
+import bz2
+import zlib
+import mmap
+import struct
+import threading
+import itertools
+import collections
+import multiprocessing
+
+import numpy as np
+
+#the shape of a frame of each format, others are (height, bytes per row)
+_FRAME_SHAPES = {'MONO8':lambda h,w: (h,w),
+                 'RAW8':lambda h,w: (h,w),
+                 'RGB8':lambda h,w: (h,w,3)}
+
+def _frame_shape(fmt, height, width, bits_per_pixel):
+    if fmt in _FRAME_SHAPES:
+        return _FRAME_SHAPES[fmt](height, width)
+    return (height, width*bits_per_pixel//8)
+
+def read_header(f):
+    """
+    returns a dict of the fmf (version 1 or 3) header of the open file f,
+    as written by motmot.FlyMovieFormat
+    """
+    f.seek(0)
+    version, = struct.unpack('<I', f.read(4))
+    if version == 1:
+        fmt = 'MONO8'
+        bits_per_pixel = 8
+    elif version == 3:
+        formatlen, = struct.unpack('<I', f.read(4))
+        fmt = f.read(formatlen)
+        bits_per_pixel, = struct.unpack('<I', f.read(4))
+    else:
+        raise ValueError("unsupported fmf version %d" % version)
+    height, width = struct.unpack('<II', f.read(8))
+    bytes_per_chunk, n_frames = struct.unpack('<QQ', f.read(16))
+    return dict(version=version, format=fmt, bits_per_pixel=bits_per_pixel,
+                height=height, width=width, bytes_per_chunk=bytes_per_chunk,
+                n_frames=n_frames, header_size=f.tell())
+
+class _MovieReader:
+    #the methods shared by the fmf and cfmf readers, which set n_frames,
+    #width, height, format, bits_per_pixel, _timestamps, _decoder, _cache
+    #and _cache_size, and implement get_frame
+
+    def get_n_frames(self):
+        return self.n_frames
+
+    def get_width(self):
+        return self.width
+
+    def get_height(self):
+        return self.height
+
+    def get_format(self):
+        return self.format
+
+    def get_bits_per_pixel(self):
+        return self.bits_per_pixel
+
+    def get_all_timestamps(self):
+        return self._timestamps.copy()
+
+    def get_frame_at_or_before_timestamp(self, timestamp):
+        i = np.searchsorted(self._timestamps, timestamp, side='right') - 1
+        if i < 0:
+            raise ValueError("no frame at or before timestamp %f" % timestamp)
+        return self.get_frame(i)
+
+    def set_decoder(self, decoder):
+        """decoder(frame) -> decoded frame is used by get_decoded_frame"""
+        self._decoder = decoder
+        self.clear_cache()
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def get_decoded_frame(self, i):
+        """
+        returns (decoder(frame), timestamp), from the cache if frame i was
+        decoded recently
+        """
+        try:
+            frame = self._cache.pop(i)
+            ts = self._timestamps[i]
+        except KeyError:
+            frame, ts = self.get_frame(i)
+            if self._decoder is not None:
+                frame = self._decoder(frame)
+        if self._cache_size > 0:
+            self._cache[i] = frame
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return frame, ts
+
+class FMFReader(_MovieReader):
+    """
+    a read only fmf movie, memory mapped. frames are returned as numpy views
+    of the file (no copy or syscall per frame), and the timestamps are read
+    once. it has the reading methods of motmot's FlyMovie, so can be used in
+    its place.
+
+    when frames are read in order, a thread reads the next readahead frames
+    into the page cache (with normal file reads, which release the GIL) so
+    they are in memory when used. get_decoded_frame() additionally keeps
+    the cache_size most recently decoded (e.g. color corrected) frames.
+    """
+
+    def __init__(self, filename, readahead=32, cache_size=16):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            hdr = read_header(f)
+        for k,v in hdr.iteritems():
+            setattr(self, k, v)
+        self.framesize = (self.height, self.width)
+
+        size = os.path.getsize(filename)
+        #the header count is 0 if the movie was not closed properly
+        n = (size - self.header_size) // self.bytes_per_chunk
+        if (self.n_frames == 0) or (self.n_frames > n):
+            self.n_frames = n
+
+        self._file = open(filename, 'rb')
+        if self.n_frames:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mm = None
+
+        self._frame_shape = _frame_shape(self.format, self.height, self.width, self.bits_per_pixel)
+
+        if self._mm is not None:
+            self._timestamps = np.ndarray(shape=(self.n_frames,), dtype='<f8', buffer=self._mm,
+                                          offset=self.header_size,
+                                          strides=(self.bytes_per_chunk,)).copy()
+        else:
+            self._timestamps = np.zeros(0)
+
+        self._decoder = None
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+
+        self._last = -2
+        self._readahead = readahead
+        self._ra_lock = threading.Lock()
+        self._ra_event = threading.Event()
+        self._ra_next = 0
+        self._ra_closed = False
+        self._ra_thread = None
+        if readahead > 0 and self.n_frames:
+            self._ra_thread = threading.Thread(target=self._readahead_loop)
+            self._ra_thread.daemon = True
+            self._ra_thread.start()
+
+    def _readahead_loop(self):
+        done = 0
+        buf = bytearray(self.bytes_per_chunk * self._readahead)
+        with open(self.filename, 'rb') as f:
+            while True:
+                self._ra_event.wait()
+                with self._ra_lock:
+                    self._ra_event.clear()
+                    if self._ra_closed:
+                        return
+                    start = self._ra_next
+                stop = min(start + self._readahead, self.n_frames)
+                if done > start:
+                    #do not re-read the frames read last time
+                    start = min(done, stop)
+                if start >= stop:
+                    continue
+                f.seek(self._chunk_offset(start))
+                f.readinto(memoryview(buf)[:(stop - start)*self.bytes_per_chunk])
+                done = stop
+
+    def _chunk_offset(self, i):
+        return self.header_size + i*self.bytes_per_chunk
+
+    def close(self):
+        #in a forked process the thread (of the parent) is not alive, and
+        #its lock may have been copied held
+        if self._ra_thread is not None and self._ra_thread.is_alive():
+            with self._ra_lock:
+                self._ra_closed = True
+                self._ra_event.set()
+            self._ra_thread.join()
+        self._ra_thread = None
+        self._cache.clear()
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+    def get_frame(self, i):
+        """
+        returns (frame, timestamp). the frame is a read only view of the
+        file, valid until close()
+        """
+        if i < 0:
+            i += self.n_frames
+        if not (0 <= i < self.n_frames):
+            raise IndexError("frame %d out of range" % i)
+
+        if self._ra_thread is not None and i == self._last + 1:
+            with self._ra_lock:
+                self._ra_next = i + 1
+                self._ra_event.set()
+        self._last = i
+
+        frame = np.ndarray(shape=self._frame_shape, dtype=np.uint8, buffer=self._mm,
+                           offset=self._chunk_offset(i) + 8)
+        return frame, self._timestamps[i]
+
+    def get_raw_chunks(self, start, stop):
+        """
+        returns a buffer (no copy) of the timestamp and frame chunks start to
+        stop, e.g. for writing them into another fmf with the same header
+        """
+        return buffer(self._mm, self._chunk_offset(start), (stop - start)*self.bytes_per_chunk)
+
+    def get_raw_frames(self, start, stop):
+        """returns the frames start to stop as a (n, frame bytes) uint8 view"""
+        chunks = np.frombuffer(self.get_raw_chunks(start, stop), dtype=np.uint8)
+        return chunks.reshape(stop - start, self.bytes_per_chunk)[:,8:]
+
+def cut_fmf(filename, cuts, blocksize=64<<20):
+    """
+    copies frame ranges of the fmf filename into new fmfs, cuts being a
+    sequence of (start, stop, destfilename) frame numbers (python slice
+    semantics). frames are fixed size, so the chunks are copied straight
+    from the mapped file (no decoding) in a single pass over the source,
+    blocksize bytes at a time, however many cuts (even overlapping ones)
+    there are.
+    """
+    r = FMFReader(filename, readahead=0, cache_size=0)
+    dests = []
+    try:
+        with open(filename, 'rb') as f:
+            header = f.read(r.header_size)
+
+        for start, stop, dest in cuts:
+            start, stop, _ = slice(start, stop).indices(r.n_frames)
+            stop = max(start, stop)
+            df = open(dest, 'wb')
+            #the frame count is the last field of the header
+            df.write(header[:-8] + struct.pack('<Q', stop - start))
+            dests.append((start, stop, df))
+
+        if dests:
+            step = max(1, blocksize // r.bytes_per_chunk)
+            first = min(d[0] for d in dests)
+            last = max(d[1] for d in dests)
+            for i in range(first, last, step):
+                j = min(i + step, last)
+                for start, stop, df in dests:
+                    lo = max(i, start)
+                    hi = min(j, stop)
+                    if lo < hi:
+                        df.write(r.get_raw_chunks(lo, hi))
+    finally:
+        for _, _, df in dests:
+            df.close()
+        r.close()
+
+#the compressed, chunked fmf (cfmf) archive format. it is
+#
+#   'CFMF' version(u32) codec format bits_per_pixel(u32) height(u32)
+#   width(u32) frame_bytes(u64) n_frames(u64) frames_per_chunk(u32)
+#   <compressed chunks of frames_per_chunk frames>
+#   timestamps(f64 x n_frames) chunk_offsets(u64 x n_chunks+1)
+#   index_offset(u64)
+#
+#(strings being their length (u32) and bytes), so the index is written
+#after the chunks, which are compressed in parallel and written in order.
+CFMF_MAGIC = 'CFMF'
+CFMF_VERSION = 1
+
+CODECS = {'zlib':(zlib.compress, zlib.decompress),
+          'bz2':(bz2.compress, bz2.decompress)}
+
+def is_cfmf(filename):
+    with open(filename, 'rb') as f:
+        return f.read(4) == CFMF_MAGIC
+
+def open_movie(filename, **kwargs):
+    """returns a CFMFReader or FMFReader of filename, whichever it is"""
+    if is_cfmf(filename):
+        return CFMFReader(filename, **kwargs)
+    return FMFReader(filename, **kwargs)
+
+def _pack_str(s):
+    return struct.pack('<I', len(s)) + s
+
+def _read_str(f):
+    n, = struct.unpack('<I', f.read(4))
+    return f.read(n)
+
+class CFMFReader(_MovieReader):
+    """
+    a read only cfmf (see compress_fmf) movie, with the reading methods of
+    FMFReader. the timestamps and chunk index are read once, and the
+    chunk_cache_size most recently used chunks are kept decompressed, so
+    reading in order decompresses each chunk once and a random frame costs
+    the decompression of one chunk.
+    """
+
+    def __init__(self, filename, cache_size=16, chunk_cache_size=2):
+        self.filename = filename
+        self._file = f = open(filename, 'rb')
+        if f.read(4) != CFMF_MAGIC:
+            raise ValueError("%s is not a cfmf file" % filename)
+        version, = struct.unpack('<I', f.read(4))
+        if version != CFMF_VERSION:
+            raise ValueError("unsupported cfmf version %d" % version)
+        self.codec = _read_str(f)
+        self.format = _read_str(f)
+        self.bits_per_pixel, self.height, self.width = struct.unpack('<III', f.read(12))
+        self.frame_bytes, self.n_frames = struct.unpack('<QQ', f.read(16))
+        self.frames_per_chunk, = struct.unpack('<I', f.read(4))
+        self.framesize = (self.height, self.width)
+        self._frame_shape = _frame_shape(self.format, self.height, self.width, self.bits_per_pixel)
+        self._decompress = CODECS[self.codec][1]
+
+        f.seek(-8, os.SEEK_END)
+        index_offset, = struct.unpack('<Q', f.read(8))
+        f.seek(index_offset)
+        n_chunks = -(-self.n_frames // self.frames_per_chunk)
+        self._timestamps = np.fromfile(f, dtype='<f8', count=self.n_frames)
+        self._chunk_offsets = np.fromfile(f, dtype='<u8', count=n_chunks + 1).astype(np.int64)
+
+        self._decoder = None
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+        self._chunks = collections.OrderedDict()
+        self._chunk_cache_size = max(1, chunk_cache_size)
+
+    def close(self):
+        self._cache.clear()
+        self._chunks.clear()
+        self._file.close()
+
+    def get_chunk(self, c):
+        """returns the frames of chunk c as an (n, frame bytes) uint8 array"""
+        try:
+            frames = self._chunks.pop(c)
+        except KeyError:
+            start, stop = self._chunk_offsets[c:c+2]
+            self._file.seek(start)
+            frames = np.frombuffer(self._decompress(self._file.read(stop - start)), dtype=np.uint8)
+            frames = frames.reshape(-1, self.frame_bytes)
+        self._chunks[c] = frames
+        while len(self._chunks) > self._chunk_cache_size:
+            self._chunks.popitem(last=False)
+        return frames
+
+    def get_frame(self, i):
+        """returns (frame, timestamp), the frame is read only"""
+        if i < 0:
+            i += self.n_frames
+        if not (0 <= i < self.n_frames):
+            raise IndexError("frame %d out of range" % i)
+        c, j = divmod(i, self.frames_per_chunk)
+        frame = self.get_chunk(c)[j].reshape(self._frame_shape)
+        return frame, self._timestamps[i]
+
+#the source fmf of each worker process
+_compress_reader = None
+
+def _compress_chunk(job):
+    global _compress_reader
+    filename, start, stop, codec, level = job
+    if _compress_reader is None or _compress_reader.filename != filename:
+        _compress_reader = FMFReader(filename, readahead=0, cache_size=0)
+    frames = np.ascontiguousarray(_compress_reader.get_raw_frames(start, stop))
+    return CODECS[codec][0](frames.tostring(), level)
+
+def compress_fmf(filename, destfilename, frames_per_chunk=32, codec='zlib', level=6, processes=None):
+    """
+    losslessly compresses the fmf filename into the cfmf destfilename,
+    chunks of frames_per_chunk frames being compressed (with codec, one of
+    CODECS) in parallel by processes processes
+    """
+    r = FMFReader(filename, readahead=0, cache_size=0)
+    ts = r.get_all_timestamps()
+    n_frames = r.n_frames
+    r.close()
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    jobs = [(filename, i, min(i + frames_per_chunk, n_frames), codec, level)
+            for i in range(0, n_frames, frames_per_chunk)]
+    processes = max(1, min(processes, len(jobs)))
+
+    if (processes == 1) or multiprocessing.current_process().daemon:
+        done = itertools.imap(_compress_chunk, jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes)
+        done = pool.imap(_compress_chunk, jobs)
+        pool.close()
+
+    #write then rename, so a partial archive is never read
+    tmp = destfilename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(CFMF_MAGIC + struct.pack('<I', CFMF_VERSION))
+        f.write(_pack_str(codec) + _pack_str(r.format))
+        f.write(struct.pack('<III', r.bits_per_pixel, r.height, r.width))
+        f.write(struct.pack('<QQI', r.bytes_per_chunk - 8, n_frames, frames_per_chunk))
+
+        offsets = [f.tell()]
+        for data in done:
+            f.write(data)
+            offsets.append(f.tell())
+
+        index_offset = f.tell()
+        f.write(np.asarray(ts, dtype='<f8').tostring())
+        f.write(np.asarray(offsets, dtype='<u8').tostring())
+        f.write(struct.pack('<Q', index_offset))
+    os.rename(tmp, destfilename)
+
+    if pool is not None:
+        pool.join()
+
+    _close_compress_reader()
+
+def _close_compress_reader():
+    #when the chunks were compressed in this process
+    global _compress_reader
+    if _compress_reader is not None:
+        _compress_reader.close()
+        _compress_reader = None
+
+def _write_test_fmf(fname, frames, timestamps, version=3):
+    h, w = frames[0].shape[:2]
+    with open(fname, 'wb') as f:
+        if version == 3:
+            f.write(struct.pack('<II', 3, 5) + 'MONO8' + struct.pack('<I', 8))
+        else:
+            f.write(struct.pack('<I', 1))
+        f.write(struct.pack('<IIQQ', h, w, h*w + 8, len(frames)))
+        for fr,ts in zip(frames, timestamps):
+            f.write(struct.pack('<d', ts))
+            f.write(fr.astype(np.uint8).tostring())
+
+def test_fmf_reader():
+    import tempfile
+    import shutil
+
+    d = tempfile.mkdtemp()
+    try:
+        frames = [np.random.randint(0, 255, (4,6)) for i in range(100)]
+        ts = np.arange(100) * 0.01 + 1000.0
+        for version in (1, 3):
+            fn = os.path.join(d, 'test%d.fmf' % version)
+            _write_test_fmf(fn, frames, ts, version)
+
+            r = FMFReader(fn, readahead=8, cache_size=4)
+            assert r.get_n_frames() == 100
+            assert (r.width, r.height) == (6, 4)
+            assert np.all(r.get_all_timestamps() == ts)
+            for i in range(100):
+                f, t = r.get_frame(i)
+                assert np.all(f == frames[i]) and t == ts[i]
+            f, t = r.get_frame_at_or_before_timestamp(1000.505)
+            assert t == ts[50] and np.all(f == frames[50])
+
+            r.set_decoder(lambda f: f.astype(float) * 2)
+            assert np.all(r.get_decoded_frame(3)[0] == frames[3] * 2)
+            assert 3 in r._cache
+
+            assert str(r.get_raw_chunks(1, 2)) == struct.pack('<d', ts[1]) + frames[1].astype(np.uint8).tostring()
+            r.close()
+
+        fn = os.path.join(d, 'test3.fmf')
+        cuts = [(10, 20, os.path.join(d, 'a.fmf')),
+                (15, 200, os.path.join(d, 'b.fmf')),
+                (0, 0, os.path.join(d, 'c.fmf'))]
+        cut_fmf(fn, cuts, blocksize=7*(4*6 + 8))
+        for start, stop, dest in cuts:
+            r = FMFReader(dest)
+            n = len(range(100)[start:stop])
+            assert r.get_n_frames() == n and r.format == 'MONO8'
+            assert np.all(r.get_all_timestamps() == ts[start:stop])
+            for i in range(n):
+                assert np.all(r.get_frame(i)[0] == frames[start + i])
+            r.close()
+    finally:
+        shutil.rmtree(d)
+
+def test_cfmf():
+    import tempfile
+    import shutil
+
+    d = tempfile.mkdtemp()
+    try:
+        frames = [np.random.randint(0, 4, (4,6)) for i in range(100)]
+        ts = np.arange(100) * 0.01 + 1000.0
+        fn = os.path.join(d, 'test.fmf')
+        _write_test_fmf(fn, frames, ts)
+
+        for codec,processes in (('zlib',1), ('bz2',2)):
+            cfn = os.path.join(d, 'test.cfmf')
+            compress_fmf(fn, cfn, frames_per_chunk=7, codec=codec, processes=processes)
+            assert os.path.getsize(cfn) < os.path.getsize(fn)
+
+            r = open_movie(cfn, chunk_cache_size=2)
+            assert isinstance(r, CFMFReader)
+            assert r.get_n_frames() == 100 and (r.width, r.height) == (6, 4)
+            assert r.get_format() == 'MONO8'
+            assert np.all(r.get_all_timestamps() == ts)
+            for i in range(100) + [99, 3, 50, -1]:
+                f, t = r.get_frame(i)
+                assert f.shape == (4,6) and np.all(f == frames[i]) and t == ts[i]
+            assert len(r._chunks) == 2
+            f, t = r.get_frame_at_or_before_timestamp(1000.505)
+            assert t == ts[50] and np.all(f == frames[50])
+            r.set_decoder(lambda f: f.astype(float) * 2)
+            assert np.all(r.get_decoded_frame(3)[0] == frames[3] * 2)
+            r.close()
+
+        r = open_movie(fn)
+        assert isinstance(r, FMFReader)
+        r.close()
+    finally:
+        shutil.rmtree(d)
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(description='losslessly compress fmf files into cfmf archives')
+    parser.add_argument('path', nargs='+', help='fmf file')
+    parser.add_argument('--outdir', help='destination directory (default: next to the fmf)')
+    parser.add_argument('--codec', choices=sorted(CODECS), default='zlib')
+    parser.add_argument('--level', type=int, default=6, help='compression level (1-9)')
+    parser.add_argument('--frames-per-chunk', type=int, default=32,
+                        help='frames compressed together (fewer gives faster random access)')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes (default: one per cpu)')
+    args = parser.parse_args()
+
+    for fn in args.path:
+        dest = os.path.splitext(fn)[0] + '.cfmf'
+        if args.outdir:
+            dest = os.path.join(args.outdir, os.path.basename(dest))
+        compress_fmf(fn, dest, args.frames_per_chunk, args.codec, args.level, args.processes)
+        print "wrote %s (%.1f%% of %s)" % (dest, 100.0*os.path.getsize(dest)/os.path.getsize(fn), fn)
+
+    sys.exit(0)
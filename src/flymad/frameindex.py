@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+NO_MATCH = -1
+
+class FramenumberIndex:
+    """
+    lookup of table rows by framenumber using a sorted copy of the
+    framenumber column (O(log n) per query instead of a full column scan)
+    """
+
+    def __init__(self, framenumbers):
+        if isinstance(framenumbers, pd.Series):
+            framenumbers = framenumbers.values
+        fn = np.asarray(framenumbers, dtype=np.float64)
+
+        #a stable sort so that, for duplicate framenumbers, the first
+        #position in the original table is also the first in the sorted one
+        self._order = np.argsort(fn, kind='mergesort')
+        self._sorted = fn[self._order]
+        self._n = len(fn)
+
+    def __len__(self):
+        return self._n
+
+    def locate(self, framenumbers):
+        """
+        returns (positions, counts). positions is the row position (into the
+        original table) of the first row with each framenumber, or NO_MATCH.
+        counts is the number of rows with that framenumber.
+        """
+        q = np.atleast_1d(np.asarray(framenumbers, dtype=np.float64))
+
+        left = np.searchsorted(self._sorted, q, side='left')
+        right = np.searchsorted(self._sorted, q, side='right')
+
+        #NaN never matches (searchsorted puts it after the NaNs in the column)
+        counts = np.where(np.isnan(q), 0, right - left)
+
+        positions = np.empty(len(q), dtype=np.int64)
+        positions.fill(NO_MATCH)
+        found = counts > 0
+        positions[found] = self._order[left[found]]
+
+        return positions, counts
+
+    def get_unique_positions(self, framenumbers):
+        """
+        returns the row position for every framenumber that matches exactly
+        one row, NO_MATCH otherwise
+        """
+        positions, counts = self.locate(framenumbers)
+        positions[counts != 1] = NO_MATCH
+        return positions
+
+def join_unique_on_framenumber(df, colname, framenumbers, values):
+    """
+    returns an array, aligned with the rows of df, holding values[i] at the
+    row whose df[colname] is framenumbers[i] (iff exactly one such row
+    exists) and NaN everywhere else
+    """
+    pos = FramenumberIndex(df[colname]).get_unique_positions(framenumbers)
+    ok = pos != NO_MATCH
+
+    joined = np.empty(len(df), dtype=np.float64)
+    joined.fill(np.nan)
+    joined[pos[ok]] = np.asarray(values, dtype=np.float64)[ok]
+    return joined
+
+def test_framenumber_index():
+    fns = np.array([5, 3, 3, np.nan, 9, 1])
+    idx = FramenumberIndex(fns)
+
+    pos, n = idx.locate([3, 9, 2, np.nan])
+    assert list(pos) == [1, 4, NO_MATCH, NO_MATCH]
+    assert list(n) == [2, 1, 0, 0]
+
+    assert list(idx.get_unique_positions([1, 3, 5])) == [5, NO_MATCH, 0]
+
+    df = pd.DataFrame({'fn':fns})
+    joined = join_unique_on_framenumber(df, 'fn', [9, 3, 1], [90., 30., 10.])
+    assert np.isnan(joined[[0, 1, 2, 3]]).all()
+    assert list(joined[[4, 5]]) == [90., 10.]
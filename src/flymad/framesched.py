@@ -0,0 +1,208 @@
+import collections
+
+import numpy as np
+import pandas as pd
+
+import flymad.frameindex
+
+FMFFrame = collections.namedtuple('FMFFrame', 'offset timestamp')
+
+class FrameDescriptor:
+    def __init__(self, w_frame, z_frame, df_or_series, timestamp_localtime_secs):
+        self.w_frame = w_frame
+        self.z_frame = z_frame
+        self.df = df_or_series
+        self.timestamp_localtime_secs = timestamp_localtime_secs
+
+    @property
+    def epoch(self):
+        return self.timestamp_localtime_secs
+
+    def get_row(self, *cols):
+        if isinstance(self.df, pd.Series):
+            return self.df
+        elif isinstance(self.df, pd.DataFrame):
+            #return the most recent row always
+            return self.df.dropna(subset=cols).tail(1)
+
+def asof_positions(stamps, times):
+    """
+    returns the position of the last of the (sorted) stamps at or before
+    each of times, or -1 if there is none
+    """
+    return np.searchsorted(np.asarray(stamps), np.asarray(times), side='right') - 1
+
+def _notnull(df, col):
+    return pd.notnull(df[col].values)
+
+def _epochs(index):
+    return index.asi8 / 1e9
+
+def _last_per_value(values, positions):
+    #the last of positions (in order) for each distinct values[positions],
+    #returns (values, positions) sorted by value
+    order = positions[np.argsort(values[positions], kind='mergesort')]
+    v = values[order]
+    last = np.r_[v[1:] != v[:-1], True] if len(v) else np.zeros(0, dtype=bool)
+    return v[last], order[last]
+
+def iter_zoom_frames(df, zoom_ts, startframenumber=-np.inf, stopframenumber=np.inf, maxt=0, t0=None):
+    """
+    yields a FrameDescriptor (with only a z_frame) for every zoom camera
+    frame (h_framenumber) in [startframenumber,stopframenumber] that was
+    recorded (is in zoom_ts) and has a tracked fly, in framenumber order.
+    the df is the last row of that frame with a tobj_id. stops at the first
+    frame more than maxt seconds after t0 (the start of df) if maxt > 0.
+    """
+    fn = np.asarray(df['h_framenumber'].values, dtype=np.float64)
+    ok = _notnull(df, 'h_framenumber') & _notnull(df, 'tobj_id')
+    ok[ok] = (fn[ok] >= startframenumber) & (fn[ok] <= stopframenumber)
+
+    fns, rows = _last_per_value(fn, np.flatnonzero(ok))
+    offsets = flymad.frameindex.FramenumberIndex(zoom_ts).locate(fns)[0]
+
+    epochs = _epochs(df.index)
+    if t0 is None and len(epochs):
+        t0 = epochs[0]
+
+    for fno, offset, r in zip(fns, offsets, rows):
+        if offset == flymad.frameindex.NO_MATCH:
+            #missing frame (probbably because the video was not recorded at
+            #full frame rate
+            continue
+        if maxt > 0 and (epochs[r] - t0) > maxt:
+            break
+        yield FrameDescriptor(None,
+                              FMFFrame(offset=offset, timestamp=fno),
+                              df.iloc[r:r+1],
+                              epochs[r])
+
+def iter_ttm_frames(df, wt, zt):
+    """
+    yields a FrameDescriptor for every zoom frame (zt) with a complete row
+    (only theta may be missing) in df whose tracking framenumber is a wide
+    frame (wt). the df is that row (the last one, if there are many).
+    """
+    hfn = np.asarray(df['h_framenumber'].values, dtype=np.float64)
+    tfn = np.asarray(df['t_framenumber'].values, dtype=np.float64)
+
+    isnull = pd.isnull(df)
+    ok = _notnull(df, 'h_framenumber') & _notnull(df, 't_framenumber')
+    if 'theta' in df:
+        ok &= ~(isnull.drop(['theta'], axis=1).values.any(axis=1))
+    else:
+        ok &= ~(isnull.values.any(axis=1))
+    ok[ok] = np.round(tfn[ok]) == tfn[ok]
+
+    wpos = np.empty(len(df), dtype=np.int64)
+    wpos.fill(flymad.frameindex.NO_MATCH)
+    wpos[ok] = flymad.frameindex.FramenumberIndex(wt).locate(tfn[ok])[0]
+    ok &= wpos != flymad.frameindex.NO_MATCH
+
+    hfns, rows = _last_per_value(hfn, np.flatnonzero(ok))
+    zt = np.asarray(zt, dtype=np.float64)
+    zpos = flymad.frameindex.FramenumberIndex(zt).locate(zt)[0]
+    hpos = np.searchsorted(hfns, zt)
+
+    epochs = _epochs(df.index)
+    for z, z_offset, h in zip(zt, zpos, hpos):
+        if h >= len(hfns) or hfns[h] != z:
+            continue
+        r = rows[h]
+        yield FrameDescriptor(FMFFrame(wpos[r], int(tfn[r])),
+                              FMFFrame(z_offset, int(z)),
+                              df.iloc[r],
+                              epochs[r])
+
+def iter_wide_frames(df, wts):
+    """
+    yields a FrameDescriptor (with only a w_frame) for every consecutive
+    pair of wide frames (wt0,wt1) with tracking data, the df holding the
+    rows of frame wt1 merged with the last head and laser rows since the
+    first row of frame wt0.
+    """
+    wts = np.asarray(wts)
+    tfn = np.asarray(df['t_framenumber'].values, dtype=np.float64)
+    idx = flymad.frameindex.FramenumberIndex(tfn)
+    order = np.argsort(tfn, kind='mergesort')
+
+    n = len(df)
+    arange = np.arange(n)
+    #the position of the last head (laser) row at or before each row
+    last_h = np.maximum.accumulate(np.where(_notnull(df, 'h_framenumber'), arange, -1)) if n else arange
+    last_l = np.maximum.accumulate(np.where(_notnull(df, 'lobj_id'), arange, -1)) if n else arange
+
+    stamps = df.index.asi8
+    epochs = stamps / 1e9
+
+    left, counts = idx.locate(wts)
+    #as get_offset_and_nearest_fmf_timestamp(wts, wt1)
+    woffsets = asof_positions(wts, wts)
+    #the positions (into order) of the first row of each frame
+    sleft = np.searchsorted(tfn[order], np.asarray(wts, dtype=np.float64), side='left')
+
+    for i in range(1, len(wts)):
+        if counts[i] == 0 or counts[i-1] == 0:
+            continue
+
+        rows = np.sort(order[sleft[i]:sleft[i]+counts[i]])
+        fdf = df.iloc[rows]
+
+        #the time range of df[first row of wt0:last row of wt1]
+        start = np.searchsorted(stamps, stamps[left[i-1]], side='left')
+        stop = np.searchsorted(stamps, stamps[rows[-1]], side='right')
+
+        h = last_h[stop-1]
+        l = last_l[stop-1]
+        last_head_row = df.iloc[h:h+1] if h >= start else df.iloc[0:0]
+        last_laser_row = df.iloc[l:l+1] if l >= start else df.iloc[0:0]
+
+        w_frame = FMFFrame(woffsets[i], wts[woffsets[i]])
+        yield FrameDescriptor(w_frame, None,
+                              fdf.merge(pd.merge(last_head_row, last_laser_row, 'outer'),'outer'),
+                              epochs[rows[-1]])
+
+def test_frame_schedule():
+    t = pd.DatetimeIndex(np.arange(12) * 10**8 + 1400000000 * 10**9)
+    nan = np.nan
+    df = pd.DataFrame({'h_framenumber':[1, 1, 2, 3, 3, nan, 4, 5, 5, 6, nan, 7],
+                       'tobj_id':     [1, 1, nan, 1, 1, 1, 1, 1, nan, 1, 1, 1],
+                       't_framenumber':[10, 10, 11, 12, 12, 13, 14, 15, 15, 16, 17, 18],
+                       'theta':       [0, 0, 0, nan, 0, 0, 0, 0, 0, 0, 0, 0],
+                       'lobj_id':     [nan, 1, nan, nan, 1, nan, nan, nan, nan, 1, nan, nan]},
+                      index=t)
+
+    #as generate_*_movies did it
+    zoom_ts = [1.0, 3.0, 5.0, 6.0, 7.0]
+    old = []
+    for fno,group in df.groupby('h_framenumber'):
+        if fno not in zoom_ts:
+            continue
+        row = group.dropna(subset=['tobj_id']).tail(1)
+        if len(row):
+            old.append((zoom_ts.index(fno), fno, row.index[0]))
+    new = [(d.z_frame.offset, d.z_frame.timestamp, d.df.index[0])
+           for d in iter_zoom_frames(df, np.array(zoom_ts))]
+    assert new == old
+    assert len(list(iter_zoom_frames(df, np.array(zoom_ts), maxt=0.35))) == 1
+    assert [d.z_frame.timestamp for d in iter_zoom_frames(df, np.array(zoom_ts), 3, 6)] == [3, 5, 6]
+
+    wt = np.array([10, 11, 12, 14, 15, 16, 18], dtype=float)
+    zt = np.array([1, 2, 3, 4, 5, 7], dtype=float)
+    frames = list(iter_ttm_frames(df.drop(['lobj_id'], axis=1), wt, zt))
+    #frame 2 has no tobj_id, frame 3 uses its complete last row
+    assert [(d.z_frame.timestamp, d.w_frame.timestamp, d.w_frame.offset) for d in frames] == \
+            [(1, 10, 0), (3, 12, 2), (4, 14, 3), (5, 15, 4), (7, 18, 6)]
+    assert frames[1].df.name == t[4]
+
+    wts = np.array([10, 11, 12, 13, 14], dtype=float)
+    frames = list(iter_wide_frames(df, wts))
+    assert [d.w_frame for d in frames] == [(1, 11), (2, 12), (3, 13), (4, 14)]
+    for d,(wt0,wt1) in zip(frames, zip(wts[:-1], wts[1:])):
+        fdf = df[df['t_framenumber'] == wt1]
+        minidf = df[df[df['t_framenumber'] == wt0].index[0]:fdf.index[-1]]
+        last_head_row = minidf[minidf['h_framenumber'].notnull()].tail(1)
+        last_laser_row = minidf[minidf['lobj_id'].notnull()].tail(1)
+        expected = fdf.merge(pd.merge(last_head_row, last_laser_row, 'outer'),'outer')
+        assert d.df.equals(expected)
+        assert d.epoch == fdf.index[-1].asm8.astype(np.int64) / 1e9
@@ -0,0 +1,102 @@
+import numpy as np
+
+def get_laser_on(values, threshold=0):
+    """laser_state or laser_power values to a boolean array, NaN is off"""
+    values = np.asarray(values, dtype=np.float64)
+    on = np.zeros(values.shape, dtype=bool)
+    ok = ~np.isnan(values)
+    on[ok] = values[ok] > threshold
+    return on
+
+def get_gradient_onsets(on):
+    """
+    the first sample of each run of positive np.gradient(on). this is how
+    laser onsets have been found historically (see
+    flymad_analysis_dan.align_t_by_laser_on), because the gradient is
+    central it is usually the sample before the laser came on.
+    """
+    on = np.asarray(on).astype(int)
+    if len(on) < 2:
+        return np.zeros(0, dtype=int)
+    g = np.gradient(on) > 0
+    return np.flatnonzero(g & ~np.r_[False, g[:-1]])
+
+class LaserEpochs:
+    """
+    the intervals where the laser was on. starts[i] is the first sample of
+    epoch (trial) i, stops[i] is the first sample after it (or the number
+    of samples if the laser was still on at the end).
+    """
+
+    def __init__(self, on):
+        self.on = np.asarray(on, dtype=bool)
+        d = np.diff(np.r_[False, self.on, False].astype(np.int8))
+        self.starts = np.flatnonzero(d == 1)
+        self.stops = np.flatnonzero(d == -1)
+
+    @classmethod
+    def from_values(cls, values, threshold=0):
+        return cls(get_laser_on(values, threshold))
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def n_samples(self):
+        return len(self.on)
+
+    def get_transitions(self):
+        """
+        the last sample before every change of laser state, i.e. the
+        nonzero positions of np.diff(on)
+        """
+        t = np.sort(np.r_[self.starts, self.stops]) - 1
+        return t[(t >= 0) & (t < self.n_samples - 1)]
+
+    def get_trials(self):
+        """
+        the trial (epoch) number of each sample, counting the time after an
+        epoch (until the next starts) as part of it. -1 before the first.
+        """
+        return np.searchsorted(self.starts, np.arange(self.n_samples), side='right') - 1
+
+    def get_aligned_time(self, t):
+        """
+        the time of each sample relative to the start of its trial (see
+        get_trials), NaN before the first trial
+        """
+        t = np.asarray(t, dtype=np.float64)
+        trials = self.get_trials()
+        aligned = np.empty(len(t))
+        aligned.fill(np.nan)
+        ok = trials >= 0
+        aligned[ok] = t[ok] - t[self.starts[trials[ok]]]
+        return aligned
+
+    def get_durations(self, t):
+        """the duration of each epoch, using the sample times t"""
+        t = np.asarray(t, dtype=np.float64)
+        stops = np.minimum(self.stops, self.n_samples - 1)
+        return t[stops] - t[self.starts]
+
+def test_laser_epochs():
+    s = np.array([0, 0, 1, 1, 0, 0, 0, 1, 0, 1, 1])
+    e = LaserEpochs.from_values(s)
+    assert len(e) == 3
+    assert list(e.starts) == [2, 7, 9]
+    assert list(e.stops) == [4, 8, 11]
+    assert list(e.get_transitions()) == list(np.flatnonzero(np.diff(s)))
+    assert list(e.get_trials()) == [-1, -1, 0, 0, 0, 0, 0, 1, 1, 2, 2]
+
+    t = np.arange(len(s)) * 0.5
+    a = e.get_aligned_time(t)
+    assert np.isnan(a[:2]).all()
+    assert list(a[2:]) == [0, 0.5, 1.0, 1.5, 2.0, 0, 0.5, 0, 0.5]
+
+    assert list(get_laser_on([np.nan, 0, 3])) == [False, False, True]
+
+    #the gradient convention, as the old string search in align_t_by_laser_on
+    dlaser = (np.gradient(s) > 0).tostring()
+    old = [n for n in xrange(len(dlaser)) if dlaser.find('\x00\x01', n) == n]
+    o = get_gradient_onsets(s)
+    assert list(o[o > 0] - 1) == old
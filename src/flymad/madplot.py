@@ -8,6 +8,8 @@ import tempfile
 import shutil
 import cPickle as pickle
 import itertools
+import multiprocessing
+import subprocess
 
 import sh
 import cv2
@@ -19,20 +21,28 @@ import shapely.geometry as sg
 import matplotlib.pyplot as plt
 import matplotlib.patches
 import matplotlib.colors
+import matplotlib.figure
+import matplotlib.backends.backend_agg
 import progressbar
-import adskalman.adskalman
-from scipy.stats import kruskal
 import fake_plotly
 import pprint
 
-import motmot.FlyMovieFormat.FlyMovieFormat
 import benu.benu
 import benu.utils
+import cairo
 
 import roslib; roslib.load_manifest('flymad')
 import rosbag
 
 import flymad.laser_camera_calibration
+import flymad.binstats
+import flymad.fmf
+import flymad.frameindex
+import flymad.framesched
+import flymad.raster
+import flymad.regions
+import flymad.rts_smoother
+import flymad.schema
 
 assert benu.__version__ >= "0.1.0"
 
@@ -82,14 +92,23 @@ class Kalman:
 
         y = np.c_[x,y]
         initx = np.array([y[0,0],y[0,1],0,0])
-        initV = 0*np.eye(4)
+        return self.get_smoother().smooth(y, initx)
+
+    def smooth_many(self, xys):
+        """smooth a list of (x,y) trajectories in one batch"""
+        ys = [np.c_[x,y] for x,y in xys]
+        initxs = [np.array([y[0,0],y[0,1],0,0]) for y in ys]
+        return self.get_smoother().smooth_many(ys, initxs)
 
-        xsmooth,Vsmooth = adskalman.adskalman.kalman_smoother(y,
-                                self.A,self.C,
-                                self.Q,self.R,
-                                initx,initV)
+    def get_smoother(self):
+        initV = 0*np.eye(4)
+        return flymad.rts_smoother.get_smoother(self.A,self.C,
+                                                self.Q,self.R,
+                                                initV)
 
-        return xsmooth
+    def get_transient_seconds(self):
+        """the time until the smoother gains reach steady state"""
+        return self.get_smoother().M * self.dt
 
 class Arena:
 
@@ -444,6 +463,11 @@ def merge_bagfiles(bfs, geom_must_interect=True):
         t_df = t_df.append(_t_df, verify_integrity=True)
         h_df = h_df.append(_h_df, verify_integrity=True)
 
+        #appending can upcast columns if one of the dataframes was empty
+        flymad.schema.apply_schema(l_df, flymad.schema.TARGETED)
+        flymad.schema.apply_schema(t_df, flymad.schema.TRACKED)
+        flymad.schema.apply_schema(h_df, flymad.schema.TTM)
+
         #check this is the same trial
         oldgp = sg.Polygon(list(zip(*_geom)))
         newgp = sg.Polygon(list(zip(*geom)))
@@ -457,41 +481,146 @@ def merge_bagfiles(bfs, geom_must_interect=True):
     return l_df, t_df, h_df, geom
 
 
-CACHE_VERSION = 2
+def group_positions(ids):
+    """
+    returns a list of (id, positions) for every unique value in ids, the
+    positions are in their original (i.e. time) order
+    """
+    if len(ids) == 0:
+        return []
+    order = np.argsort(ids, kind='mergesort')
+    sids = ids[order]
+    splits = np.flatnonzero(sids[1:] != sids[:-1]) + 1
+    starts = np.r_[0, splits]
+    return zip(sids[starts], np.split(order, splits))
+
+def smooth_trajectory(job):
+    """
+    the per-trajectory part of load_bagfile. job is (t_ts, x_px, y_px, smooth, arena),
+    returns a dict of the (optionally kalman smoothed) position and velocity arrays
+    """
+    t_ts, x_px, y_px, smooth, arena = job
+
+    #a single sample (e.g. a fly first seen in the last frame of a bagstream
+    #chunk) is too short for a gradient, keep its position but the velocity
+    #is unknown
+    short = len(t_ts) < 2
+
+    if short:
+        dt = np.empty(len(t_ts))
+        dt.fill(np.nan)
+    else:
+        dt = np.gradient(t_ts)
+
+    if smooth and not short:
+        #smooth the positions, and recalculate the velocitys based on this.
+        kf = Kalman()
+        smoothed = kf.smooth(x_px, y_px)
+        x_px = smoothed[:,0]
+        y_px = smoothed[:,1]
+    else:
+        x_px = arena.scale_x(x_px)
+        y_px = arena.scale_y(y_px)
+
+    if short:
+        vx_px = dt.copy()
+        vy_px = dt.copy()
+    else:
+        vx_px = np.gradient(x_px) / dt
+        vy_px = np.gradient(y_px) / dt
+
+    #and their scaled equivilents
+    vx = arena.scale_vx(vx_px)
+    vy = arena.scale_vx(vy_px)
+
+    return {'x_px':x_px, 'y_px':y_px,
+            'vx_px':vx_px, 'vy_px':vy_px, 'v_px':np.sqrt((vx_px**2) + (vy_px**2)),
+            'x':arena.scale_x(x_px), 'y':arena.scale_y(y_px),
+            'vx':vx, 'vy':vy, 'v':np.sqrt((vx**2) + (vy**2)),
+            't_dt':dt}
+
+def map_trajectories(func, jobs, processes=None):
+    """
+    map func over jobs in a process pool. falls back to running serially if
+    processes == 1, or if we are already running inside a pool worker
+    (e.g. plot_many loads bag files in parallel)
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(jobs))
+
+    if (processes <= 1) or multiprocessing.current_process().daemon:
+        return map(func, jobs)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        #big chunks so the many-short-trajectories case is not dominated
+        #by ipc overhead
+        chunksize = max(1, len(jobs) // (4*processes))
+        return pool.map(func, jobs, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+CACHE_VERSION = 3
+
+def _cache_args_match(cache_dict, cache_args, verbose=True):
+    if cache_dict['version']!=CACHE_VERSION:
+        if verbose:
+            print 'loading cache failed\n\tcached version %s != %s' % (cache_dict['version'], CACHE_VERSION)
+        return False
+    if cache_dict['args']==cache_args:
+        return True
+
+    if verbose:
+        print 'loading cache failed'
+        print '\targs different'
+        print '\tcache:\n\t\t',cache_dict['args']
+        print '\tthis call:\n\t\t',cache_args
+    if cache_args is None:
+        all_equal = False
+    else:
+        all_equal=True
+        for i in range(len(cache_args)):
+            if not cache_dict['args'][i]==cache_args[i]:
+                all_equal=False
+                break
+    if all_equal and verbose:
+        print 'hmm, parts are equal, but whole is not?! returning cache'
+    return all_equal
+
+def _read_bagfile_cache_header(cache_buf):
+    #the version and args are pickled before the results, so they can be
+    #checked without reading the results. (older caches are one dict
+    #also holding the results)
+    return pickle.load( cache_buf )
+
+def bagfile_cache_is_valid(cache_args, cache_fname):
+    """true if cache_fname holds the load_bagfile results for cache_args"""
+    if not os.path.exists(cache_fname):
+        return False
+    try:
+        with open(cache_fname,'rb') as cache_buf:
+            cache_dict = _read_bagfile_cache_header(cache_buf)
+    except Exception:
+        return False
+    return _cache_args_match(cache_dict, cache_args, verbose=False)
 
 def load_bagfile_cache(cache_args, cache_fname):
     if os.path.exists(cache_fname):
         print 'loading cache', cache_fname
-        cache_buf = open(cache_fname,'rb')
         try:
-            cache_dict = pickle.load( cache_buf )
-        except Exception as err:
-            print 'loading cache failed\n\t%s' % (err,)
-        else:
-            if cache_dict['version']==CACHE_VERSION:
-                if cache_dict['args']==cache_args:
-                    results = cache_dict['results']
+            with open(cache_fname,'rb') as cache_buf:
+                cache_dict = _read_bagfile_cache_header(cache_buf)
+                if _cache_args_match(cache_dict, cache_args):
+                    if 'results' in cache_dict:
+                        results = cache_dict['results']
+                    else:
+                        results = pickle.load( cache_buf )
                     print '\tloaded cache succeeded'
                     return results
-                else:
-                    print 'loading cache failed'
-                    print '\targs different'
-                    print '\tcache:\n\t\t',cache_dict['args']
-                    print '\tthis call:\n\t\t',cache_args
-                    if cache_args is None:
-                        all_equal = False
-                    else:
-                        all_equal=True
-                        for i in range(len(cache_args)):
-                            if not cache_dict['args'][i]==cache_args[i]:
-                                all_equal=False
-                                break
-                    if all_equal:
-                        print 'hmm, parts are equal, but whole is not?! returning cache'
-                        results = cache_dict['results']
-                        return results
-            else:
-                print 'loading cache failed\n\tcached version %s != %s' % (cache_dict['version'], CACHE_VERSION)
+        except Exception as err:
+            print 'loading cache failed\n\t%s' % (err,)
 
     return None
 
@@ -499,51 +628,33 @@ def save_bagfile_cache(results, cache_args, cache_fname):
     cache_dict = {}
     cache_dict['version']=CACHE_VERSION
     cache_dict['args']=cache_args
-    cache_dict['results']=results
-    pickle.dump(cache_dict, open(cache_fname,'wb'), -1)
+    with open(cache_fname,'wb') as cache_buf:
+        pickle.dump(cache_dict, cache_buf, -1)
+        pickle.dump(results, cache_buf, -1)
     print 'saved cache',cache_fname
 
-def load_bagfile(bagpath, arena, filter_short=100, filter_short_pct=0, smooth=False, extra_topics=None, tzname=None):
-    def in_area(row, poly):
-        if poly:
-            in_area = poly.contains( sg.Point(row['x'], row['y']) )
-        else:
-            in_area = False
-        return pd.Series({"in_area":in_area})
-
-    def get_extra_key(topic, attr):
-        return "e%s_%s" % (topic.replace('/','_'),attr)
-
-    #because the arena is updated between calls it is an argument to the function that
-    #changes, thus must be modified before checking cache_args
-    arena.update_from_calibration(bagpath)
-
-    cache_args = os.path.basename(bagpath), arena, filter_short, filter_short_pct, smooth, extra_topics, tzname
-    cache_fname = bagpath+'.madplot-cache'
-    results = load_bagfile_cache(cache_args, cache_fname)
-    if results is not None:
-        return results
-
-    if extra_topics is None:
-        extra_topics = {}
-
-    print "loading", bagpath
-    bag = rosbag.Bag(bagpath)
-    if tzname is None:
-        if int(os.environ.get('MADPLOT_FORCE_USER_TZNAME','0'))==1:
-            raise ValueError('tzname is not specified')
-        else:
-            tzname = 'CET'
-
-    tz = pytz.timezone( tzname )
+def get_bagfile_cache_fname(bagpath):
+    return bagpath+'.madplot-cache'
 
+def get_tz(tzname=None):
     if tzname is None:
         if int(os.environ.get('MADPLOT_FORCE_USER_TZNAME','0'))==1:
             raise ValueError('tzname is not specified')
         else:
             tzname = 'CET'
+    return pytz.timezone( tzname )
+
+def read_bagfile_tables(bag, arena, tz, extra_topics=None, start_time=None, end_time=None):
+    """
+    reads the flymad topics of an open rosbag.Bag (optionally only those
+    between start_time and end_time, rospy.Time) into unsmoothed dataframes.
+    returns geom, l_df, t_df, h_df, e_df
+    """
+    def get_extra_key(topic, attr):
+        return "e%s_%s" % (topic.replace('/','_'),attr)
 
-    tz = pytz.timezone( tzname )
+    if extra_topics is None:
+        extra_topics = {}
 
     geom_msg = None
 
@@ -578,7 +689,9 @@ def load_bagfile(bagpath, arena, filter_short=100, filter_short_pct=0, smooth=Fa
               "/flymad/raw_2d_positions"]
     topics.extend( extra_topics.keys() )
 
-    for topic,msg,rostime in bag.read_messages(topics=topics):
+    for topic,msg,rostime in bag.read_messages(topics=topics,
+                                               start_time=start_time,
+                                               end_time=end_time):
         if topic == "/targeter/targeted":
             ts = msg.header.stamp.to_sec()
             naive_datetime_timestamp = datetime.datetime.fromtimestamp(ts)
@@ -669,8 +782,6 @@ def load_bagfile(bagpath, arena, filter_short=100, filter_short_pct=0, smooth=Fa
     l_data["laser_x"] = arena.scale_x(l_data["laser_x_px"])
     l_data["laser_y"] = arena.scale_y(l_data["laser_y_px"])
 
-    poly = arena.get_intersect_polygon(geom)
-
     l_df = pd.DataFrame(l_data, index=l_index)
     t_df = pd.DataFrame(t_data, index=t_index)
     h_df = pd.DataFrame(h_data, index=h_index)
@@ -689,21 +800,79 @@ def load_bagfile(bagpath, arena, filter_short=100, filter_short_pct=0, smooth=Fa
             t_df['theta'] = r_df['r_theta'].values
             print "\tload: copying all raw2d theta to tracked theta as only 1 obj id"
         else:
-            print "\tload: copying raw2d theta to tracked theta by framenumber (SLOW!)"
-            #match up the first object theta value based on framenumber using 
-            #depressingly slow and inefficient iteration
-            n_idx = []
-            n_theta = []
-
-            for idx,s in r_df.iterrows():
-                fn = s['r_framenumber']
-                row = t_df[t_df['t_framenumber'] == fn]['theta']
-                if len(row) == 1:
-                    n_idx.append(row.index[0])
-                    n_theta.append(s['r_theta'])
-
-            n_s = pd.Series(n_theta, index=n_idx)
-            t_df['theta'] = n_s
+            print "\tload: copying raw2d theta to tracked theta by framenumber"
+            #match up the first object theta value based on framenumber
+            t_df['theta'] = flymad.frameindex.join_unique_on_framenumber(
+                                    t_df, 't_framenumber',
+                                    r_df['r_framenumber'].values,
+                                    r_df['r_theta'].values)
+
+    return geom, l_df, t_df, h_df, e_df
+
+def smooth_tracked(t_df, arena, smooth, processes=None):
+    """
+    (optionally kalman smooth) and calculate the position and velocity
+    columns of the tracked dataframe, in place
+    """
+    groups = group_positions(t_df['tobj_id'].values)
+    if smooth:
+        for tobj_id,pos in groups:
+            print "\tkalman smoothing traj %s (%s pts long)" % (tobj_id, len(pos))
+
+    t_ts = t_df['t_ts'].values
+    x_px = t_df['x_px'].values
+    y_px = t_df['y_px'].values
+    jobs = [(t_ts[pos], x_px[pos], y_px[pos], smooth, arena) for _,pos in groups]
+
+    if smooth and (len(jobs) > 1):
+        results = map_trajectories(smooth_trajectory, jobs, processes)
+    else:
+        results = map(smooth_trajectory, jobs)
+
+    #replace all values with their smoothed equivilents, in one go
+    cols = ('x_px','y_px','vx_px','vy_px','v_px','x','y','vx','vy','v','t_dt')
+    out = {c:np.empty(len(t_df)) for c in cols}
+    for (_,pos),result in zip(groups,results):
+        for c in cols:
+            out[c][pos] = result[c]
+    for c in cols:
+        t_df[c] = out[c]
+
+def test_smooth_tracked():
+    arena = Arena(False)
+    #object 2 is only seen once, at the end of the window
+    t_df = DataFrame({'tobj_id':[1,1,1,2],
+                      't_ts':[0.0,0.01,0.02,0.02],
+                      'x_px':[10.0,11.0,12.0,50.0],
+                      'y_px':[20.0,20.0,20.0,60.0]})
+    for smooth in (False, True):
+        df = t_df.copy()
+        smooth_tracked(df, arena, smooth, processes=1)
+        assert np.isfinite(df['v'].values[:3]).all()
+        assert np.isnan(df['v'].values[3])
+        assert np.isnan(df['t_dt'].values[3])
+        assert df['x_px'].values[3] == arena.scale_x(50.0)
+
+def get_bagfile_cache_args(bagpath, arena, filter_short=100, filter_short_pct=0, smooth=False, extra_topics=None, tzname=None, processes=None):
+    #because the arena is updated between calls it is an argument to the function that
+    #changes, thus must be modified before checking cache_args
+    arena.update_from_calibration(bagpath)
+    return os.path.basename(bagpath), arena, filter_short, filter_short_pct, smooth, extra_topics, tzname
+
+def load_bagfile(bagpath, arena, filter_short=100, filter_short_pct=0, smooth=False, extra_topics=None, tzname=None, processes=None):
+    cache_args = get_bagfile_cache_args(bagpath, arena, filter_short, filter_short_pct, smooth, extra_topics, tzname)
+    cache_fname = get_bagfile_cache_fname(bagpath)
+    results = load_bagfile_cache(cache_args, cache_fname)
+    if results is not None:
+        return results
+
+    print "loading", bagpath
+    bag = rosbag.Bag(bagpath)
+    tz = get_tz(tzname)
+
+    geom, l_df, t_df, h_df, e_df = read_bagfile_tables(bag, arena, tz, extra_topics)
+
+    poly = arena.get_intersect_polygon(geom)
 
     #optionally find short trials here, print the length of kept trials
     if (filter_short_pct > 0) or (filter_short > 0):
@@ -725,61 +894,116 @@ def load_bagfile(bagpath, arena, filter_short=100, filter_short_pct=0, smooth=Fa
         t_df = t_df[~t_df['tobj_id'].isin(short_tracks)]
 
     #now resmooth the tracking data. these are all long enough
-    grouper = t_df.groupby('tobj_id')
-    for tobj_id, group in grouper:
-        dt = np.gradient(group['t_ts'].values)
-
-        if smooth:
-            print "\tkalman smoothing traj %s (%s pts long)" % (tobj_id, len(group))
-            #smooth the positions, and recalculate the velocitys based on this.
-            kf = Kalman()
-            smoothed = kf.smooth(group['x_px'].values, group['y_px'].values)
-            x_px = smoothed[:,0]
-            y_px = smoothed[:,1]
-        else:
-            x_px = arena.scale_x(group['x_px'].values)
-            y_px = arena.scale_y(group['y_px'].values)
-
-        vx_px = np.gradient(x_px) / dt
-        vy_px = np.gradient(y_px) / dt
-
-        #replace all values with their smoothed equivilents.
-        ixs_of_group = grouper.groups[tobj_id]
-
-        t_df['x_px'][ixs_of_group] = x_px
-        t_df['y_px'][ixs_of_group] = y_px
-        t_df['vx_px'][ixs_of_group] = vx_px
-        t_df['vy_px'][ixs_of_group] = vy_px
-        t_df['v_px'][ixs_of_group] = np.sqrt((vx_px**2) + (vy_px**2))
-
-        #and their scaled equivilents
-        vx = arena.scale_vx(vx_px)
-        vy = arena.scale_vx(vy_px)
-        t_df['x'][ixs_of_group] = arena.scale_x(x_px)
-        t_df['y'][ixs_of_group] = arena.scale_y(y_px)
-        t_df['vx'][ixs_of_group] = vx
-        t_df['vy'][ixs_of_group] = vy
-        t_df['v'][ixs_of_group] = np.sqrt((vx**2) + (vy**2))
-
-        t_df['t_dt'][ixs_of_group] = dt
+    smooth_tracked(t_df, arena, smooth, processes)
 
     #add a new colum if they were in the area
-    t_df = pd.concat([t_df,
-                      t_df.apply(in_area, axis=1, args=(poly,))],
-                      axis=1)
+    t_df['in_area'] = flymad.regions.contains(poly, t_df['x'].values, t_df['y'].values)
 
     t_df['experiment'] = 0
 
     l_df['laser_state'] = 0
     l_df['laser_state'][l_df['laser_power'] > 0] = 1
 
-    results = geom, {"targeted":l_df, "tracked":t_df, "ttm":h_df, "extra":e_df}
+    dfs = {"targeted":l_df, "tracked":t_df, "ttm":h_df, "extra":e_df}
+    flymad.schema.apply_schemas(dfs)
+
+    results = geom, dfs
 
     save_bagfile_cache(results, cache_args, cache_fname)
 
     return results
 
-def load_bagfile_single_dataframe(bagpath, arena, ffill, warn=False, **kwargs):
+def asof_join(spine_df, df, tolerance=None):
+    """
+    returns the columns of df aligned to the rows of spine_df, each row
+    holding the most recent row of df at or before the spine row time. rows
+    with no earlier data, or whose data is older than tolerance seconds,
+    are NaN.
+    """
+    #an empty table has a plain (not datetime) index, so convert explicitly
+    spine_ns = np.asarray(spine_df.index.values, 'datetime64[ns]').view('i8')
+    df_ns = np.asarray(df.index.values, 'datetime64[ns]').view('i8')
+
+    #messages from one topic are nearly always in order, but be sure
+    order = np.argsort(df_ns, kind='mergesort')
+    df_ns = df_ns[order]
+
+    pos = np.searchsorted(df_ns, spine_ns, side='right') - 1
+    ok = pos >= 0
+    if tolerance is not None:
+        ok[ok] = (spine_ns[ok] - df_ns[pos[ok]]) <= int(tolerance*1e9)
+    rows = order[pos[ok]]
+
+    cols = collections.OrderedDict()
+    for col in df.columns:
+        v = df[col].values
+        if v.dtype.kind in 'fc':
+            joined = np.empty(len(spine_df), dtype=v.dtype)
+            joined.fill(np.nan)
+        else:
+            joined = np.empty(len(spine_df), dtype=object)
+            joined.fill(np.nan)
+        joined[ok] = v[rows]
+        cols[col] = joined
+
+    return DataFrame(cols, index=spine_df.index)
+
+def test_asof_join():
+    t = lambda *s: pd.to_datetime(np.array(s)*1e9)
+    spine = DataFrame({'a':[1,2,3]}, index=t(1.0,2.0,3.0))
+    df = DataFrame({'b':[10.0,20.0],'c':['x','y']}, index=t(2.05,0.5))
+
+    j = asof_join(spine, df)
+    assert list(j['b']) == [20.0,20.0,10.0]
+    assert list(j['c']) == ['y','y','x']
+
+    j = asof_join(spine, df, tolerance=1.0)
+    assert list(j['b'][[0,2]]) == [20.0,10.0]
+    assert np.isnan(j['b'].values[1])
+
+    #empty tables on either side
+    empty = DataFrame({'b':[],'c':[]}, index=[])
+    j = asof_join(spine, empty)
+    assert len(j) == 3
+    assert np.isnan(j['b'].values.astype(float)).all()
+    j = asof_join(DataFrame({'a':[]}, index=[]), df)
+    assert len(j) == 0
+    assert list(j.columns) == ['b','c']
+
+def load_bagfile_aligned_dataframe(bagpath, arena, spine='tracked', tolerance=0.1, **kwargs):
+    """
+    returns a single dense dataframe with one row per row of the spine table
+    (e.g. 'tracked' for one row per tracked object per frame, or 'ttm' for
+    the zoom camera frame clock). the other tables are as-of joined onto it,
+    see asof_join. missing values in integer columns are
+    flymad.schema.INT_SENTINEL, not NaN.
+    """
+    geom, dfs = load_bagfile(bagpath, arena, **kwargs)
+
+    spine_df = dfs[spine]
+    parts = [spine_df]
+    for name in ("targeted", "tracked", "ttm", "extra"):
+        _df = dfs.get(name)
+        if (name == spine) or (_df is None):
+            continue
+        #the spine takes precedence for any duplicated column
+        _df = _df[[c for c in _df.columns if c not in spine_df.columns]]
+        parts.append(asof_join(spine_df, _df, tolerance))
+
+    pool_df = pd.concat(parts, axis=1)
+    flymad.schema.apply_schemas({name:pool_df for name in flymad.schema.SCHEMAS})
+    return pool_df
+
+def load_bagfile_single_dataframe(bagpath, arena, ffill, warn=False, align=None, tolerance=0.1, **kwargs):
+    """
+    returns all tables of the bag file in one dataframe. by default this is
+    the (sparse) union of the table indices, optionally forward filled. if
+    align names a table (e.g. 'tracked') then load_bagfile_aligned_dataframe
+    is returned instead, and ffill is ignored.
+    """
+    if align is not None:
+        return load_bagfile_aligned_dataframe(bagpath, arena, spine=align, tolerance=tolerance, **kwargs)
+
     geom, dfs = load_bagfile(bagpath, arena, **kwargs)
     l_df = dfs["targeted"]
     t_df = dfs["tracked"]
@@ -801,6 +1025,64 @@ def load_bagfile_single_dataframe(bagpath, arena, ffill, warn=False, **kwargs):
 
     return pool_df
 
+def _cache_bagfile(job):
+    bagpath, arena, kwargs = job
+    #only the path goes back to the parent, it reads the results from the cache
+    load_bagfile(bagpath, arena, processes=1, **kwargs)
+    return bagpath
+
+def cache_bagfiles(bagpaths, arena, processes=None, **kwargs):
+    """
+    loads bag files across a process pool so that their caches are valid.
+    returns an iterator over the paths, in the order they complete. kwargs
+    are passed to load_bagfile.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(bagpaths)))
+
+    jobs = [(b, arena, kwargs) for b in bagpaths]
+    if (processes == 1) or multiprocessing.current_process().daemon:
+        return itertools.imap(_cache_bagfile, jobs)
+
+    pool = multiprocessing.Pool(processes)
+    results = pool.imap_unordered(_cache_bagfile, jobs)
+    pool.close()
+    return _join_when_done(pool, results)
+
+def _join_when_done(pool, results):
+    try:
+        for r in results:
+            yield r
+        pool.join()
+    finally:
+        #if not exhausted (e.g. a worker raised)
+        pool.terminate()
+
+def load_bagfiles(bagpaths, arena, processes=None, **kwargs):
+    """
+    loads many bag files in parallel. yields (bagpath, load_bagfile results)
+    in the order they become available, bag files with a valid cache first.
+    kwargs are passed to load_bagfile.
+
+    the large dataframes are not sent back from the worker processes, instead
+    they are read from the (just written) bagfile cache.
+    """
+    cached = []
+    uncached = []
+    for b in bagpaths:
+        cache_args = get_bagfile_cache_args(b, arena, **kwargs)
+        if bagfile_cache_is_valid(cache_args, get_bagfile_cache_fname(b)):
+            cached.append(b)
+        else:
+            uncached.append(b)
+
+    #start the workers first, then read the caches while they run
+    done = cache_bagfiles(uncached, arena, processes, **kwargs) if uncached else []
+
+    for b in itertools.chain(cached, done):
+        yield b, load_bagfile(b, arena, **kwargs)
+
 def calculate_total_pct_in_area(tdf, maxtime):
     pcts = []
 
@@ -888,6 +1170,48 @@ def calculate_time_in_area(tdf, maxtime, toffsets):
     #rows are experiments, cols are the time bins
     return np.r_[exp_pcts]
 
+def get_time_in_area(t, in_area, tout_reset_time, first=None):
+    """
+    returns the time accumulated in the area at each sample. time inside
+    accumulates over visits, and is only reset after more than
+    tout_reset_time continuously outside. t and in_area may hold several
+    trajectories one after the other, first marks the first sample of each
+    (default: there is only one).
+    """
+    t = np.asarray(t, dtype=np.float64)
+    in_area = np.asarray(in_area, dtype=bool)
+    n = len(t)
+    if n == 0:
+        return np.zeros(0)
+
+    if first is None:
+        first = np.zeros(n, dtype=bool)
+        first[0] = True
+    else:
+        first = np.asarray(first, dtype=bool).copy()
+        first[0] = True
+
+    #the time since the previous sample counts towards the state of this one
+    dt = np.r_[0, np.diff(t)]
+    dt[first] = 0
+    t_in = np.cumsum(np.where(in_area, dt, 0))
+
+    #runs of samples all inside or all outside (within one trajectory)
+    runstart = first.copy()
+    runstart[1:] |= in_area[1:] != in_area[:-1]
+    starts = np.flatnonzero(runstart)
+    run = np.cumsum(runstart) - 1
+
+    #outside runs long enough to reset the time inside. t_in is constant
+    #through an outside run, so the reset value can be taken from any sample
+    t_out = np.add.reduceat(np.where(in_area, 0, dt), starts)
+    reset = ((t_out > tout_reset_time) & ~in_area[starts])[run] | first
+
+    #t_in only increases, so this is its value at the most recent reset
+    base = np.maximum.accumulate(np.where(reset, t_in, 0))
+
+    return t_in - base
+
 def calculate_latency_and_velocity_to_stay(tdf, holdtime=20, minlenpct=0.10, tout_reset_time=1, arena=None, geom=None, debug_plot=True, title=''):
     tts = []
     vel_out = []
@@ -911,46 +1235,34 @@ def calculate_latency_and_velocity_to_stay(tdf, holdtime=20, minlenpct=0.10, tou
 
             print "\tltcy: obj_id", name, "len", lenpct
 
-            #timestamp of experiment start
-            t0ix = t0.index[0]
-            t00 = t0 = t1 = t0ix.asm8.astype(np.int64) / 1e9
-
-            t_in_area = 0
-            t_out_area = 0
-            for ix,row in group.iterrows():
-
-                t1 = ix.asm8.astype(np.int64) / 1e9
-                dt = t1 - t0
+            t = group.index.asi8 / 1e9
+            in_area = group['in_area'].values.astype(bool)
+            t_in_areas = get_time_in_area(t, in_area, tout_reset_time)
 
-                if row['in_area']:
-                    t_out_area = 0
-                    t_in_area += dt
-                    if t_in_area > holdtime:
-                        #the fly made it
-                        break
-                else:
-                    t_out_area += dt
-                    if (t_out_area > tout_reset_time):
-                        t_in_area = 0
-
-                t0 = t1
+            #the first sample where the fly has been in the area long enough
+            made_it = np.flatnonzero(in_area & (t_in_areas > holdtime))
+            if len(made_it):
+                last = made_it[0]
+            else:
+                last = len(group) - 1
 
             #this is either the time for the fly to make it, or the total time of
             #the experiment
-            tts.append( t1 - t00 )
+            tts.append( t[last] - t[0] )
 
             #if the fly finished inside then slicing the trajectory into parts
             #inside and outside makes sense.
-            if row['in_area'] and (t_in_area > holdtime):
+            if len(made_it):
+                t_in_area = t_in_areas[last]
                 print "\tltcy: obj_id %s finished inside after %.1f (in for %.1f)" % (name, tts[-1], t_in_area)
                 #the time they first got to the area, more or less beucause there
                 #could is tout_reset_time hysteresis is the most recent index minus
-                #the t_in_area
-                t_first_in_area_ix = ix - datetime.timedelta(seconds=t_in_area)
-                t_last_in_area = ix
+                #the t_in_area (rounded to microseconds, like a timedelta)
+                ns = group.index.asi8
+                t_first_in_area_ns = ns[last] - int(round(t_in_area*1e6))*1000
 
-                dfo = group[:t_first_in_area_ix]
-                dfi = group[t_first_in_area_ix:t_last_in_area]
+                dfo = group.iloc[:ns.searchsorted(t_first_in_area_ns, side='right')]
+                dfi = group.iloc[ns.searchsorted(t_first_in_area_ns, side='left'):ns.searchsorted(ns[last], side='right')]
 
                 vel_out.append( dfo['v'].mean() )
 
@@ -997,21 +1309,8 @@ def get_progress_bar(name, maxval):
     pbar = progressbar.ProgressBar(widgets=widgets,maxval=maxval).start()
     return pbar
 
-FMFFrame = collections.namedtuple('FMFFrame', 'offset timestamp')
-
-class FrameDescriptor:
-    def __init__(self, w_frame, z_frame, df_or_series, timestamp_localtime_secs):
-        self.w_frame = w_frame
-        self.z_frame = z_frame
-        self.df = df_or_series
-        self.timestamp_localtime_secs = timestamp_localtime_secs
-
-    def get_row(self, *cols):
-        if isinstance(self.df, pd.Series):
-            return self.df
-        elif isinstance(self.df, pd.DataFrame):
-            #return the most recent row always
-            return self.df.dropna(subset=cols).tail(1)
+FMFFrame = flymad.framesched.FMFFrame
+FrameDescriptor = flymad.framesched.FrameDescriptor
 
 class _FMFPlotter:
 
@@ -1031,24 +1330,50 @@ class _FMFPlotter:
     show_arena = False
 
     def __init__(self, path):
+        self._path = path
         if path:
-            self.fmf = motmot.FlyMovieFormat.FlyMovieFormat.FlyMovie(path)
+            self._open()
             self.width = self.fmf.width
             self.height = self.fmf.height
         else:
             self.fmf = None
 
+    def _open(self):
+        #an fmf or compressed (cfmf) movie
+        self.fmf = flymad.fmf.open_movie(self._path)
+        #the same frame is often shown in consecutive movie frames, so keep
+        #the most recent color corrected frames
+        self.fmf.set_decoder(self._color_correct)
+
+    def reopen(self):
+        #a forked process must have its own read-ahead thread (and, for a
+        #cfmf, file position), and not keep the (inherited) mapping and
+        #file of the parent open
+        if self.fmf is not None:
+            self.fmf.close()
+        if self._path:
+            self._open()
+
+    def update(self, desc):
+        #plotters with state (e.g. a trajectory history) update it here, it
+        #is called by render, or alone to warm up the state without drawing
+        pass
+
     def enable_show_arena(self, arena):
         self.show_arena = arena
 
     def enable_force_rgb(self):
         self.force_color = True
+        if self.fmf is not None:
+            self.fmf.clear_cache()
 
     def enable_color_correction(self, brightness, contrast):
         assert 0 < brightness < 100
         assert 1.0 <= contrast <= 3.0
         self.alpha = contrast
         self.beta = brightness
+        if self.fmf is not None:
+            self.fmf.clear_cache()
 
     def _color_correct(self, f):
         if self.force_color:
@@ -1065,14 +1390,14 @@ class _FMFPlotter:
         if self.fmf is None:
             return None
 
-        f,ts = self.fmf.get_frame(frame.offset)
+        f,ts = self.fmf.get_decoded_frame(frame.offset)
         assert ts == frame.timestamp
 
-        return self._color_correct(f)
+        return f
 
     def get_frame_number(self, offset):
-        f,ts = self.fmf.get_frame(offset)
-        return self._color_correct(f)
+        f,ts = self.fmf.get_decoded_frame(offset)
+        return f
 
     def get_benu_panel(self, device_x0, device_x1, device_y0, device_y1):
         return dict(
@@ -1206,12 +1531,8 @@ class FMFMultiTrajectoryPlotter(_FMFPlotter, _MultiTrajectoryColorManager):
         self.trajs_last_seen = {}
         self.maxlen=maxlen
 
-    def render(self, canv, panel, desc):
+    def update(self, desc):
         w_framenumber = desc.w_frame.timestamp
-        to_kill = []
-
-        #get the targeted fly
-        rowt = desc.get_row('lobj_id','fly_x', 'fly_y')
 
         #birth and update the trajectory history of all previous flies
         for oid,_row in desc.df.groupby('tobj_id'):
@@ -1225,17 +1546,23 @@ class FMFMultiTrajectoryPlotter(_FMFPlotter, _MultiTrajectoryColorManager):
             self.trajs_y[oid].append(row['y'])
             self.trajs_last_seen[oid] = t_framenumber
 
+        #kill old, dead trajectories
+        for oid in self.trajs_x.keys():
+            if (w_framenumber - self.trajs_last_seen[oid]) > 5:
+                del self.trajs_x[oid]
+                del self.trajs_y[oid]
+
+    def render(self, canv, panel, desc):
+        self.update(desc)
+
+        #get the targeted fly
+        rowt = desc.get_row('lobj_id','fly_x', 'fly_y')
+
         with canv.set_user_coords_from_panel(panel):
             self.imshow(canv, desc.w_frame)
 
             #draw all trajectories
             for oid in self.trajs_x:
-
-                #check for old, dead trajectories
-                if (w_framenumber - self.trajs_last_seen[oid]) > 5:
-                    to_kill.append(oid)
-                    continue
-
                 canv.scatter( self.trajs_x[oid],
                               self.trajs_y[oid],
                               color_rgba=self.trajs_colors[int(oid)], radius=0.5 )
@@ -1255,10 +1582,6 @@ class FMFMultiTrajectoryPlotter(_FMFPlotter, _MultiTrajectoryColorManager):
                 canv.text("%.1fs" % (desc.epoch - self.t0),
                           panel["dw"]-40,panel["dh"]-17, color_rgba=(0.5,0.5,0.5,1.0))
 
-        for oid in to_kill:
-            del self.trajs_x[oid]
-            del self.trajs_y[oid]
-
 class FMFTrajectoryPlotter(_FMFPlotter):
 
     name = 'w'
@@ -1268,15 +1591,22 @@ class FMFTrajectoryPlotter(_FMFPlotter):
         self.xhist = collections.deque(maxlen=maxlen)
         self.yhist = collections.deque(maxlen=maxlen)
 
+    def _get_row(self, desc):
+        return desc.get_row('fly_x', 'fly_y', 'laser_x', 'laser_y', 'mode')
+
+    def update(self, desc):
+        row = self._get_row(desc)
+        self.xhist.append(row['fly_x'])
+        self.yhist.append(row['fly_y'])
+
     def render(self, canv, panel, desc):
-        row = desc.get_row('fly_x', 'fly_y', 'laser_x', 'laser_y', 'mode')
+        self.update(desc)
+
+        row = self._get_row(desc)
 
         x,y = row['fly_x'],row['fly_y']
         lx,ly,mode = row['laser_x'],row['laser_y'],row['mode']
 
-        self.xhist.append(x)
-        self.yhist.append(y)
-
         with canv.set_user_coords_from_panel(panel):
             self.imshow(canv, desc.w_frame)
 
@@ -1386,8 +1716,15 @@ def row_to_target_mode_string(row):
         return NO_TARGET_STRING
 
 class TTLPlotter:
+    """
+    a plot of the head to target dx and dy over the last HIST seconds. the
+    figure (axes, ticks, colours) is drawn once per panel size, and each
+    frame only the two lines are redrawn (blitted) over a copy of it and the
+    resulting image drawn into the panel
+    """
 
     HIST = 3.0
+    DPI = 100
 
     def __init__(self, t0, ifi):
         self.t0 = t0
@@ -1395,8 +1732,9 @@ class TTLPlotter:
         maxlen = self.HIST / self.ifi
         self.dx = collections.deque(maxlen=maxlen)
         self.dy = collections.deque(maxlen=maxlen)
+        self._fig = None
 
-    def render(self, canv, panel, desc):
+    def update(self, desc):
         row = desc.get_row('target_type', 'head_x', 'head_y', 'body_x', 'body_y', 'target_x', 'target_y')
 
         head_dx, head_dy = target_dx_dy_from_message(row)
@@ -1404,28 +1742,103 @@ class TTLPlotter:
         self.dx.appendleft(head_dx)
         self.dy.appendleft(head_dy)
 
-        time = np.array(range(len(self.dx)))*self.ifi*-1.0
+    def _setup_figure(self, w, h):
+        fig = matplotlib.figure.Figure(figsize=(float(w)/self.DPI, float(h)/self.DPI), dpi=self.DPI)
+        matplotlib.backends.backend_agg.FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+        self._xline, = ax.plot([], [], 'r-', animated=True)
+        self._yline, = ax.plot([], [], 'b-', animated=True)
+        ax.set_ylim([-200,200])
+        ax.set_xlim([0,-1.0*self.HIST])
+        ax.axhline(0, color='k')
+        ax.yaxis.set_ticks([-150, -100, -50, 0, 50, 100, 150])
+        benu.utils.set_foregroundcolor(ax, 'white')
+        benu.utils.set_backgroundcolor(ax, 'black')
+        fig.patch.set_facecolor('black')
+        fig.subplots_adjust(left=0.035, right=0.98)
+
+        fig.canvas.draw()
+        self._background = fig.canvas.copy_from_bbox(fig.bbox)
+        self._ax = ax
+        self._fig = fig
+        self._size = (w, h)
+
+    def get_image(self, w, h):
+        """returns the current plot as an (h,w,3) RGB uint8 array"""
+        if self._fig is None or self._size != (w, h):
+            self._setup_figure(w, h)
+
+        time = np.arange(len(self.dx))*self.ifi*-1.0
+        self._xline.set_data(time, np.array(self.dx, dtype=float))
+        self._yline.set_data(time, np.array(self.dy, dtype=float))
+
+        fc = self._fig.canvas
+        fc.restore_region(self._background)
+        self._ax.draw_artist(self._xline)
+        self._ax.draw_artist(self._yline)
+
+        cw, ch = fc.get_width_height()
+        buf = np.frombuffer(fc.buffer_rgba(), dtype=np.uint8).reshape(ch, cw, 4)
+        return buf[:,:,:3].copy()
 
+    def render(self, canv, panel, desc):
+        self.update(desc)
+
+        img = self.get_image(int(panel['width']), int(panel['height']))
         with canv.set_user_coords_from_panel(panel):
-            with canv.get_figure(panel) as fig:
-                ax = fig.gca()
-                ax.plot( time, self.dx, 'r-' )
-                ax.plot( time, self.dy, 'b-' )
-                ax.set_ylim([-200,200])
-                ax.set_xlim([0,-1.0*self.HIST])
-                ax.axhline(0, color='k')
-                ax.yaxis.set_ticks([-150, -100, -50, 0, 50, 100, 150])
-                benu.utils.set_foregroundcolor(ax, 'white')
-                benu.utils.set_backgroundcolor(ax, 'black')
-                fig.patch.set_facecolor('black')
-                fig.subplots_adjust(left=0.035, right=0.98)
+            canv.imshow(img, 0, 0, filter='best')
+
+def get_canvas_image(canv):
+    """
+    returns the contents of a benu png Canvas (or a RasterCanvas) as an
+    (h,w,3) RGB uint8 array, without writing it to disk (the cairo surface
+    is read directly).
+
+    benu has no public accessor for the surface, this relies on the png
+    Canvas of benu 0.1.x keeping its cairo ImageSurface as _surf
+    """
+    if isinstance(canv, flymad.raster.RasterCanvas):
+        return canv.get_image()
+
+    surf = getattr(canv, '_surf', None)
+    if not isinstance(surf, cairo.ImageSurface):
+        raise ValueError("only png canvases can be streamed")
+    if surf.get_format() != cairo.FORMAT_ARGB32:
+        raise ValueError("unsupported canvas surface format %s" % surf.get_format())
+
+    surf.flush()
+    h = surf.get_height()
+    w = surf.get_width()
+    stride = surf.get_stride()
+    #cairo ARGB32 is native endian, so BGRA on little endian machines
+    buf = np.frombuffer(surf.get_data(), dtype=np.uint8).reshape(h, stride//4, 4)
+    return buf[:,:w,2::-1]
 
 class MovieMaker:
-    def __init__(self, tmpdir='/tmp/', basename='movie', fps=20):
+    """
+    makes an mp4 from rendered frames. by default frames are saved as pngs
+    in a temporary directory and encoded by render(). with stream=True the
+    frames are instead piped, as raw RGB, directly to an ffmpeg process
+    as they are produced (which blocks when the encoder falls behind) so no
+    frames are written to disk.
+
+    in both modes, new_canvas()/save_canvas() give a benu canvas for each
+    frame, and write_frame() adds an image (e.g. a camera frame). with
+    raster=True new_canvas() instead gives a (much faster, not antialiased)
+    flymad.raster.RasterCanvas, the same one cleared for every frame.
+    """
+    def __init__(self, tmpdir='/tmp/', basename='movie', fps=20, stream=False, raster=False):
         self.tmpdir = tempfile.mkdtemp(str(basename), dir=tmpdir)
         self.basename = basename
         self.num = 0
         self.fps = fps
+        self.stream = stream
+        self.raster = raster
+
+        self._canvas = None
+
+        self._encoder = None
+        self._frame_shape = None
 
         print "movies temporary files saved to %s" % self.tmpdir
 
@@ -1445,21 +1858,85 @@ class MovieMaker:
         self.num = num
         return os.path.join(self.tmpdir,"frame{:0>6d}.png".format(num))
 
-    def render(self, moviedir):
-        sh.mplayer("mf://%s/frame*.png" % self.tmpdir,
-                   "-mf", "fps=%d" % self.fps,
-                   "-vo", "yuv4mpeg:file=%s/movie.y4m" % self.tmpdir,
-                   "-ao", "null", 
-                   "-nosound", "-noframedrop", "-benchmark", "-nolirc"
-        )
+    def new_canvas(self, w, h):
+        #in stream mode the png filename is never written (see save_canvas),
+        #but taking it advances frame_number
+        if not self.raster:
+            return benu.benu.Canvas(self.next_frame(), w, h)
+        if self._canvas is None or (self._canvas.width, self._canvas.height) != (int(w), int(h)):
+            self._canvas = flymad.raster.RasterCanvas(self.next_frame(), w, h)
+        else:
+            self._canvas.reset(self.next_frame())
+        return self._canvas
 
+    def save_canvas(self, canv):
+        if self.stream:
+            self._write_rgb(get_canvas_image(canv))
+        else:
+            canv.save()
+
+    def write_frame(self, img, bgr=False):
+        """adds an image (gray, or RGB or BGR (e.g. from cv2)) as the next frame"""
+        img = np.asarray(img, dtype=np.uint8)
+        if img.ndim == 2:
+            img = np.dstack((img,img,img))
+        elif bgr:
+            img = img[:,:,::-1]
+
+        if self.stream:
+            self.next_frame()
+            self._write_rgb(img)
+        else:
+            cv2.imwrite(self.next_frame(), img[:,:,::-1])
+
+    def _start_encoder(self, h, w):
+        self._frame_shape = (h, w, 3)
+        self._encoder = subprocess.Popen(
+                ["ffmpeg", "-y", "-loglevel", "error",
+                 "-f", "rawvideo", "-pix_fmt", "rgb24",
+                 "-s", "%dx%d" % (w, h), "-r", str(self.fps),
+                 "-i", "-",
+                 #x264 needs even dimensions
+                 "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+                 "-c:v", "libx264", "-pix_fmt", "yuv420p",
+                 os.path.join(self.tmpdir, "movie.mp4")],
+                stdin=subprocess.PIPE)
+
+    def _write_rgb(self, rgb):
+        h, w = rgb.shape[:2]
+        if self._encoder is None:
+            self._start_encoder(h, w)
+        elif rgb.shape != self._frame_shape:
+            raise ValueError("frame %d is %r, not %r" % (self.num, rgb.shape, self._frame_shape))
+        #blocks while the encoder is busy
+        self._encoder.stdin.write(np.ascontiguousarray(rgb).data)
+
+    def _finish_encoder(self):
+        if self._encoder is None:
+            raise ValueError("no frames were written")
+        self._encoder.stdin.close()
+        ret = self._encoder.wait()
+        self._encoder = None
+        if ret != 0:
+            raise RuntimeError("ffmpeg failed (exit code %d)" % ret)
+
+    def render(self, moviedir):
         if not os.path.isdir(moviedir):
             os.makedirs(moviedir)
 
+        if self.stream:
+            self._finish_encoder()
+        else:
+            sh.mplayer("mf://%s/frame*.png" % self.tmpdir,
+                       "-mf", "fps=%d" % self.fps,
+                       "-vo", "yuv4mpeg:file=%s/movie.y4m" % self.tmpdir,
+                       "-ao", "null", 
+                       "-nosound", "-noframedrop", "-benchmark", "-nolirc"
+            )
 
-        sh.x264("--output=%s/movie.mp4" % self.tmpdir,
-                "%s/movie.y4m" % self.tmpdir,
-        )
+            sh.x264("--output=%s/movie.mp4" % self.tmpdir,
+                    "%s/movie.y4m" % self.tmpdir,
+            )
 
         moviefname = self.get_target_movie_name(moviedir)
         sh.mv("-u", "%s/movie.mp4" % self.tmpdir, moviefname)
@@ -1470,9 +1947,107 @@ class MovieMaker:
         return moviefname
 
     def cleanup(self):
+        if self._encoder is not None:
+            self._encoder.kill()
+            self._encoder.wait()
+            self._encoder = None
         shutil.rmtree(self.tmpdir)
 
 
+def concat_movies(fnames, moviefname):
+    """concatenates movies of the same size and encoding, without re-encoding"""
+    listfname = moviefname + '.concat.txt'
+    with open(listfname, 'w') as f:
+        for fn in fnames:
+            f.write("file '%s'\n" % os.path.abspath(fn))
+    try:
+        subprocess.check_call(["ffmpeg", "-y", "-loglevel", "error",
+                               "-f", "concat", "-safe", "0", "-i", listfname,
+                               "-c", "copy", moviefname])
+    finally:
+        os.unlink(listfname)
+    return moviefname
+
+#set before the worker processes are forked, so the assembler (and its
+#frames) does not have to be pickled
+_render_job = None
+
+def _render_chunk(chunk):
+    i, start, stop, warmup = chunk
+    make_assembler, frames, fps, segdir, raster = _render_job
+
+    moviemaker = MovieMaker(tmpdir=segdir, basename='segment%04d' % i, fps=fps, stream=True, raster=raster)
+    try:
+        ass = make_assembler(moviemaker)
+        for desc in frames[max(0,start-warmup):start]:
+            ass.warm_frame(desc)
+        for desc in frames[start:stop]:
+            ass.render_frame(desc)
+        return i, moviemaker.render(segdir)
+    finally:
+        moviemaker.cleanup()
+
+def render_movie_parallel(make_assembler, frames, moviedir, basename, fps=20, warmup=0, processes=None, tmpdir='/tmp/', raster=False):
+    """
+    renders frames (FrameDescriptors) to moviedir/basename.mp4. the frames
+    are split into contiguous chunks, each rendered and encoded in a worker
+    process, and the segments are concatenated without re-encoding.
+
+    make_assembler(moviemaker) is called in each worker. it should return an
+    object (whose fmf plotters have been reopen()ed) with render_frame(desc),
+    rendering to moviemaker, and warm_frame(desc), which only updates the
+    state of the plotters (see _FMFPlotter.update). the warmup frames before
+    each chunk are passed to warm_frame, so a chunk starts as if all the
+    previous frames had been rendered. raster is passed to the MovieMakers.
+    """
+    global _render_job
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(frames)))
+
+    #chunks rendered in this process would share one assembler, whose
+    #plotter state carries over (and the warmup frames would be added
+    #twice), so then the movie is one chunk
+    serial = (processes == 1) or multiprocessing.current_process().daemon
+    if serial:
+        processes = 1
+
+    bounds = np.linspace(0, len(frames), processes+1).astype(int)
+    chunks = [(i, bounds[i], bounds[i+1], warmup) for i in range(processes)]
+
+    segdir = tempfile.mkdtemp(str(basename), dir=tmpdir)
+    _render_job = make_assembler, frames, fps, segdir, raster
+    try:
+        if serial:
+            done = itertools.imap(_render_chunk, chunks)
+            pool = None
+        else:
+            #a fresh worker per chunk, a worker reused for a second chunk
+            #would keep the plotter state of its first
+            pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+            done = pool.imap_unordered(_render_chunk, chunks)
+            pool.close()
+
+        segments = {}
+        for i,fname in done:
+            segments[i] = fname
+            print "rendered %s segment %d/%d" % (basename, len(segments), len(chunks))
+        if pool is not None:
+            pool.join()
+
+        if not os.path.isdir(moviedir):
+            os.makedirs(moviedir)
+        moviefname = os.path.join(moviedir, "%s.mp4" % basename)
+        if len(segments) == 1:
+            shutil.move(segments[0], moviefname)
+        else:
+            concat_movies([segments[i] for i in sorted(segments)], moviefname)
+        return moviefname
+    finally:
+        _render_job = None
+        shutil.rmtree(segdir)
+
 if __name__ == "__main__":
     for unit in ('mm','cm','m'):
         a = Arena(unit)
@@ -1499,6 +2074,7 @@ if __name__ == "__main__":
 def calc_p_values(data, gt1_name, gt2_name,
                   align_colname=None, stat_colname=None,
                   num_bins=50, bin_how='mean',
+                  stats=None, permutations=0,
                   ):
 
     if align_colname is None:
@@ -1506,62 +2082,15 @@ def calc_p_values(data, gt1_name, gt2_name,
     if stat_colname is None:
         raise ValueError("you must explicitly set stat_colname (try 'v')")
 
-    df_ctrl = data[gt1_name]['df']
-    df_exp = data[gt2_name]['df']
-
-    align_start = df_ctrl[align_colname].min()
-    dalign = df_ctrl[align_colname].max() - align_start
+    #the per (bin,fly) aggregates can be shared between many comparisons
+    if stats is None:
+        stats = flymad.binstats.BinnedStats(data, align_colname, stat_colname, num_bins, bin_how)
 
-    p_values = DataFrame()
-
-    if bin_how=='mean':
-        bin_func = np.mean
-    elif bin_how=='median':
-        bin_func = np.median
-
-    bins = np.linspace(0,dalign,num_bins+1) + align_start
-    binned_ctrl = pd.cut(df_ctrl[align_colname], bins, labels= bins[:-1])
-    binned_exp = pd.cut(df_exp[align_colname], bins, labels= bins[:-1])
-    for x in binned_ctrl.levels:
-        test1_all_flies_df = df_ctrl[binned_ctrl == x]
-        bin_start_time = test1_all_flies_df['t'].min()
-        bin_stop_time = test1_all_flies_df['t'].max()
-
-        test1 = []
-        for obj_id, fly_group in test1_all_flies_df.groupby('obj_id'):
-            test1.append( bin_func(fly_group[stat_colname].values) )
-        test1 = np.array(test1)
-
-        test2_all_flies_df = df_exp[binned_exp == x]
-        test2 = []
-        for obj_id, fly_group in test2_all_flies_df.groupby('obj_id'):
-            test2.append( bin_func(fly_group[stat_colname].values) )
-        test2 = np.array(test2)
-
-        if len(test1)<=5 or len(test2)<=5:
-            # reaching end of data - stop
-            continue
+    import flymad.flymad_analysis_dan as flymad_analysis
+    name1=flymad_analysis.human_label(gt1_name)
+    name2=flymad_analysis.human_label(gt2_name)
 
-        try:
-            hval, pval = kruskal(test1, test2)
-        except ValueError as err:
-            pval = 1.0
-
-        import flymad.flymad_analysis_dan as flymad_analysis
-        name1=flymad_analysis.human_label(gt1_name)
-        name2=flymad_analysis.human_label(gt2_name)
-
-        dftemp = DataFrame({'Bin_number': x,
-                            'P': pval,
-                            'bin_start_time':bin_start_time,
-                            'bin_stop_time':bin_stop_time,
-                            'name1':name1,
-                            'name2':name2,
-                            'test1_n':len(test1),
-                            'test2_n':len(test2),
-                            }, index=[x])
-        p_values = pd.concat([p_values, dftemp])
-    return p_values
+    return stats.p_values(gt1_name, gt2_name, name1, name2, permutations=permutations)
 
 def get_pairwise(data,gt1_name,gt2_name,**kwargs):
     layout_title = kwargs.pop('layout_title',None)
@@ -1626,6 +2155,11 @@ def view_pairwise_stats_plotly( data, names, fig_prefix, **kwargs):
                 continue
             pairs.append( (name1, name2 ) )
 
+    if 'stats' not in kwargs:
+        kwargs['stats'] = flymad.binstats.BinnedStats(data,
+                                kwargs.get('align_colname'), kwargs.get('stat_colname'),
+                                kwargs.get('num_bins', 50), kwargs.get('bin_how', 'mean'))
+
     graph_data = []
     layout=None
     pvalue_results = {}
@@ -0,0 +1,272 @@
+import numpy as np
+import scipy.signal
+import scipy.interpolate
+
+PI2 = 2*np.pi
+
+def wrap_plus_minus(dtheta, around=np.pi):
+    """
+    wraps angles over the interval [-around,around)
+
+    e.g. wrap_plus_minus(dt, np.pi) returns angles wrapped [-pi,pi)
+    """
+    dtheta = np.asarray(dtheta, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        return np.where(dtheta > 0,
+                        np.fmod(dtheta+around, 2.0*around) - around,
+                        np.fmod(dtheta-around, 2.0*around) + around)
+
+def angle_distance(a, b):
+    """the absolute angle between a and b (radians, 0 to pi)"""
+    return np.abs(wrap_plus_minus(np.asarray(a) - np.asarray(b), np.pi))
+
+def unwrap_mod_pi(theta):
+    """
+    unwraps an orientation that is only known modulo pi (i.e. ambiguous
+    with respect to head/tail), by choosing the smallest rotation
+    between each sample
+    """
+    theta = np.asarray(theta, dtype=np.float64)
+    return np.unwrap(2.0*theta) / 2.0
+
+def choose_orientations_primitive(theta):
+    """
+    Remove head/tail ambiguity.
+
+    Assumes theta is == orientation modulo pi, in other words,
+    that the orientation is ambiguous with respect to head/tail. Each
+    orientation is the one closest to the previous one, wrapped [0,2pi)
+    (except the first, which is unchanged).
+    """
+    theta = np.asarray(theta, dtype=np.float64)
+    if len(theta) == 0:
+        return theta.copy()
+    result = np.mod(unwrap_mod_pi(theta), PI2)
+    result[0] = theta[0]
+    return result
+
+def _pad(arrays, fill=np.nan):
+    n = max(len(a) for a in arrays)
+    padded = np.empty((len(arrays), n))
+    padded.fill(fill)
+    for i,a in enumerate(arrays):
+        padded[i,:len(a)] = a
+    return padded
+
+def choose_orientations(thetas, vxs=None, vys=None, velocity_weight=1.0, max_speed=np.inf):
+    """
+    Remove head/tail ambiguity of many trajectories at once.
+
+    thetas is a list of orientation arrays (modulo pi). the orientation
+    of each sample is chosen (Viterbi) to minimise the total rotation over
+    the whole trajectory plus, if the velocities vxs and vys are given,
+    velocity_weight*min(speed,max_speed) times the angle between the
+    orientation and the direction of travel. NaN samples are skipped (the
+    samples either side of a gap are compared directly). returns a list of
+    the chosen orientations, wrapped [0,2pi), NaN where theta is NaN.
+    """
+    lengths = [len(th) for th in thetas]
+    if not lengths or max(lengths) == 0:
+        return [np.zeros(0) for th in thetas]
+
+    th = _pad(thetas)
+    N,T = th.shape
+    valid = ~np.isnan(th)
+    #the two candidate orientations of each sample
+    cand = np.dstack((th, th + np.pi))
+
+    if vxs is not None:
+        vx = _pad(vxs)
+        vy = _pad(vys)
+        w = velocity_weight*np.clip(np.hypot(vx, vy), 0, max_speed)
+        heading = np.arctan2(vy, vx)
+        emit = w[:,:,None]*angle_distance(cand, heading[:,:,None])
+        emit[np.isnan(emit)] = 0
+    else:
+        emit = np.zeros((N,T,2))
+
+    cost = emit[:,0].copy()
+    back = np.zeros((N,T,2), dtype=np.int8)
+    back[:] = [0,1]
+
+    #each valid sample is linked to the last valid one (prev), so NaN
+    #samples (gaps, and the padding past the end of a trajectory) keep the
+    #cost and pass the state through (their back is the identity)
+    rows = np.arange(N)
+    prev = np.zeros(N, dtype=int)
+    has_prev = valid[:,0].copy()
+    for t in range(1,T):
+        dist = angle_distance(cand[rows,prev,:,None], cand[:,t,None,:])
+        dist[~has_prev] = 0
+        total = cost[:,:,None] + dist
+        #the best previous state for each current state
+        best = np.argmin(total, axis=1)
+        new = np.choose(best, (total[:,0], total[:,1])) + emit[:,t]
+        ok = valid[:,t]
+        back[ok,t] = best[ok]
+        cost[ok] = new[ok]
+        prev[ok] = t
+        has_prev |= ok
+
+    state = np.argmin(cost, axis=1)
+    states = np.empty((N,T), dtype=np.int8)
+    states[:,T-1] = state
+    for t in range(T-1,0,-1):
+        state = back[rows,t,state]
+        states[:,t-1] = state
+
+    chosen = np.mod(th + states*np.pi, PI2)
+    return [chosen[i,:n] for i,n in enumerate(lengths)]
+
+def calc_dtheta(theta):
+    """
+    the change in (modulo pi) orientation between consecutive samples,
+    wrapped [-pi/2,pi/2)
+    """
+    return wrap_plus_minus(np.diff(np.asarray(theta, dtype=np.float64)), around=np.pi/2.0)
+
+def calc_angular_velocity(stamps, theta, cutoff_hz=5.0, filter_order=8, method='downsampled', downsample_sec=1.0, orientation='primitive'):
+    """
+    returns a dict of arrays (the same length as stamps, NaN where stamps or
+    theta are NaN): theta_wrapped, theta_unwrapped, theta_unwrapped_lowpass,
+    angular_velocity and (for the downsampled method)
+    theta_unwrapped_downsampled
+
+    if cutoff_hz==0, no lowpass filtering is done.
+
+    Assumes theta is == orientation modulo pi, in other words,
+    that the orientation is ambiguous with respect to head/tail, which is
+    resolved with choose_orientations_primitive, or choose_orientations
+    if orientation is 'viterbi'.
+
+    Methods:
+         'raw' - central difference on raw theta values
+         'lowpassed' - central difference on lowpassed theta values
+         'downsampled' - central difference on downsampled theta values
+    """
+    stamps = np.asarray(stamps, dtype=np.float64)
+    theta = np.asarray(theta, dtype=np.float64)
+
+    good_cond = ~(np.isnan(stamps) | np.isnan(theta))
+    goodstamps = stamps[good_cond]
+    dgoodstamps = goodstamps[1:]-goodstamps[:-1]
+    assert np.alltrue(dgoodstamps > 0)
+
+    # unwrap theta, dealing with nans
+    good_theta = theta[good_cond]
+    if orientation == 'viterbi':
+        good_theta_chosen = choose_orientations([good_theta])[0]
+    else:
+        good_theta_chosen = choose_orientations_primitive(good_theta)
+    good_theta_unwrapped = np.unwrap(good_theta_chosen)
+
+    dt = np.mean(dgoodstamps)
+
+    if cutoff_hz != 0:
+        sample_rate_hz = 1.0/dt
+        nyquist_rate_hz = sample_rate_hz*0.5
+
+        filt_b, filt_a = scipy.signal.butter(filter_order,
+                                             cutoff_hz/nyquist_rate_hz)
+        lowpassed = scipy.signal.filtfilt(filt_b, filt_a,
+                                          good_theta_unwrapped)
+    else:
+        lowpassed = good_theta_unwrapped
+
+    good = {'theta_wrapped':good_theta_chosen,
+            'theta_unwrapped':good_theta_unwrapped,
+            'theta_unwrapped_lowpass':lowpassed}
+
+    # calculate angular velocity using central difference
+    if method=='raw':
+        good['angular_velocity'] = np.gradient(good_theta_unwrapped)/dt
+    elif method=='lowpassed':
+        good['angular_velocity'] = np.gradient(lowpassed)/dt
+    elif method=='downsampled':
+        # downsample theta
+        n_samps = int(np.round(downsample_sec/dt))
+        downdt = n_samps*dt
+        downtime = goodstamps[::n_samps]
+        downtheta = lowpassed[::n_samps]
+
+        # linear interpolation of downsampled theta
+        interp = scipy.interpolate.interp1d( downtime, downtheta,
+                                             bounds_error=False,
+                                             fill_value=np.nan,
+                                             )
+        good['theta_unwrapped_downsampled'] = interp( goodstamps )
+
+        downvel = np.gradient( downtheta )/downdt
+        interp = scipy.interpolate.interp1d( downtime, downvel,
+                                             bounds_error=False,
+                                             fill_value=np.nan,
+                                             )
+        good['angular_velocity'] = interp( goodstamps )
+    else:
+        raise ValueError("unknown method: %s" % method)
+
+    results = {}
+    for name,values in good.iteritems():
+        tmp = np.nan*np.ones( (len(stamps,) ))
+        tmp[good_cond] = values
+        results[name] = tmp
+    return results
+
+def supplement_angles(df, **kwargs):
+    """
+    adds the columns of calc_angular_velocity (computed from df['t_ts'] and
+    df['theta']) to df. kwargs are passed to calc_angular_velocity
+    """
+    for name,values in calc_angular_velocity(df['t_ts'].values, df['theta'].values, **kwargs).iteritems():
+        df[name] = values
+
+def test_orientation():
+    np.random.seed(2)
+
+    d = np.array([-7.0, -3.5, -0.1, 0.0, 0.1, 3.5, 7.0])
+    import math
+    for around in (np.pi, np.pi/2):
+        expected = [math.fmod(x+around, 2*around)-around if x > 0 else
+                    math.fmod(x-around, 2*around)+around for x in d]
+        assert np.allclose(wrap_plus_minus(d, around), expected)
+
+    #the old per-sample implementation
+    def primitive(theta):
+        theta_prev = theta[0]
+        result = [theta_prev]
+        diffs = np.array([-3*np.pi,-2*np.pi,-np.pi,0,np.pi,2*np.pi,3*np.pi])
+        for ambiguous_angle in theta[1:]:
+            possible_angles = diffs + ambiguous_angle
+            theta_prev = ambiguous_angle+diffs[np.argmin(abs(theta_prev - possible_angles))]
+            if theta_prev < 0:
+                theta_prev = theta_prev + PI2
+            elif theta_prev >= PI2:
+                theta_prev = theta_prev - PI2
+            result.append(theta_prev)
+        return np.array(result)
+
+    true = np.cumsum(np.random.randn(500)*0.3)
+    ambiguous = np.mod(true + np.pi*np.random.randint(0,2,500), np.pi)
+    assert np.allclose(choose_orientations_primitive(ambiguous), primitive(ambiguous))
+
+    #with the velocity pointing forwards, the viterbi choice recovers the
+    #true orientation, also when trajectories of different lengths are
+    #done at once
+    vx = np.cos(true)
+    vy = np.sin(true)
+    a,b = choose_orientations([ambiguous, ambiguous[:100]], [vx, vx[:100]], [vy, vy[:100]])
+    assert np.allclose(angle_distance(a, true), 0)
+    assert np.allclose(angle_distance(b, true[:100]), 0)
+
+    #NaNs inside a trajectory are skipped
+    gappy = ambiguous.copy()
+    gappy[[0, 10, 11, 200]] = np.nan
+    ok = ~np.isnan(gappy)
+    c, = choose_orientations([gappy], [vx], [vy])
+    d, = choose_orientations([gappy[ok]], [vx[ok]], [vy[ok]])
+    assert np.all(np.isnan(c[~ok]))
+    assert np.allclose(c[ok], d)
+    assert np.allclose(angle_distance(c[ok], true[ok]), 0)
+    c, = choose_orientations([gappy])
+    d, = choose_orientations([gappy[ok]])
+    assert np.allclose(c[ok], d)
@@ -0,0 +1,387 @@
+import os
+import types
+import hashlib
+import cPickle as pickle
+
+import numpy as np
+import pandas as pd
+
+class File:
+    """
+    a stage argument that is a file. it is hashed by its content, and the
+    stage function is passed its path.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+    def __repr__(self):
+        return "File(%r)" % self.path
+
+_SIMPLE_TYPES = (int, long, float, bool, str, unicode, type(None),
+                 list, tuple, dict, np.ndarray, np.number)
+
+def files(paths):
+    return [File(p) for p in paths]
+
+def _code_hash(h, code):
+    #the bytecode and constants (including those of nested functions), but
+    #not the line numbers, so moving a function does not invalidate it
+    h.update(code.co_code)
+    for c in code.co_consts:
+        if isinstance(c, types.CodeType):
+            _code_hash(h, c)
+        else:
+            h.update(repr(c))
+    h.update(repr(code.co_names))
+
+class Artifact:
+    """
+    the (not necessarily computed) output of a stage called with some
+    arguments. get() returns it, from the store if possible.
+    """
+    def __init__(self, stage, args, kwargs):
+        self.stage = stage
+        self.args = args
+        self.kwargs = kwargs
+        self._key = None
+        self._value = None
+        self._done = False
+
+    def __repr__(self):
+        return "Artifact(%s, %s)" % (self.stage.name, self.key[:8])
+
+    @property
+    def key(self):
+        if self._key is None:
+            h = hashlib.sha1()
+            h.update(self.stage.name)
+            h.update(self.stage.code_version)
+            self.stage.pipeline.hash_value(h, self.args)
+            self.stage.pipeline.hash_value(h, sorted(self.kwargs.items()))
+            self._key = h.hexdigest()
+        return self._key
+
+    @property
+    def params_key(self):
+        """
+        like key, but hashing the path of File arguments (also those of
+        Artifact arguments) instead of their content, so it is cheap
+        """
+        h = hashlib.sha1()
+        h.update(self.stage.name)
+        h.update(self.stage.code_version)
+        self.stage.pipeline.hash_value(h, self.args, contents=False)
+        self.stage.pipeline.hash_value(h, sorted(self.kwargs.items()), contents=False)
+        return h.hexdigest()
+
+    def get(self):
+        if not self._done:
+            self._value = self.stage.pipeline.get_artifact(self)
+            self._done = True
+        return self._value
+
+class Stage:
+    def __init__(self, pipeline, func, name, version):
+        self.pipeline = pipeline
+        self.func = func
+        self.name = name
+        self.version = version
+
+        h = hashlib.sha1()
+        h.update(repr(version))
+        _code_hash(h, func.func_code)
+        self.code_version = h.hexdigest()
+
+    def __call__(self, *args, **kwargs):
+        return Artifact(self, args, kwargs)
+
+    def get_latest(self, *args, **kwargs):
+        """
+        returns the most recently computed (or loaded) output of this stage,
+        if it was called with the same arguments, without hashing the
+        content of any File arguments. None if there is none
+        """
+        return self.pipeline.get_latest(Artifact(self, args, kwargs))
+
+class Pipeline:
+    """
+    incremental analysis. functions are declared as stages, and calling a
+    stage returns an Artifact whose key is a hash of the stage code (and
+    version), its arguments, the content of any File arguments and the keys
+    of any Artifact arguments (the outputs of other stages). artifacts are
+    stored (pickled) in cachedir, so Artifact.get() only computes the stages
+    whose inputs changed, and does not even load the outputs of unchanged
+    upstream stages.
+
+        pipe = Pipeline(cachedir)
+
+        @pipe.stage(version=1)
+        def load(csvfile, arena):
+            ...
+        @pipe.stage()
+        def pool(loaded, gts):
+            ...
+
+        data = pool([load(f, arena) for f in files(csvfiles)], gts).get()
+
+    stage functions are passed the values of Artifact arguments and the
+    path of File arguments (also inside lists, tuples and dicts).
+    Stage.get_latest(*args) returns the last output of a stage if it was
+    called with the same arguments, without looking at (or hashing) the
+    content of any File inputs.
+    """
+
+    FILE_HASHES = 'file_hashes.pkl'
+    LATEST = 'latest'
+
+    def __init__(self, cachedir, verbose=True):
+        self.cachedir = cachedir
+        self.verbose = verbose
+        self._stages = {}
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+        #content hashes are kept for files whose mtime and size is unchanged
+        self._file_hashes = {}
+        self._file_hashes_changed = False
+        try:
+            with open(os.path.join(cachedir, self.FILE_HASHES), 'rb') as f:
+                self._file_hashes = pickle.load(f)
+        except Exception:
+            pass
+
+    def stage(self, name=None, version=0):
+        """decorator, version should be changed if the output format changes"""
+        def wrapper(func):
+            sname = name if name is not None else func.__name__
+            if sname in self._stages:
+                raise ValueError("stage %s already exists" % sname)
+            s = self._stages[sname] = Stage(self, func, sname, version)
+            return s
+        return wrapper
+
+    def hash_file(self, path):
+        st = os.stat(path)
+        stat = (st.st_mtime, st.st_size)
+        try:
+            cstat, digest = self._file_hashes[path]
+            if cstat == stat:
+                return digest
+        except KeyError:
+            pass
+
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for buf in iter(lambda: f.read(1<<20), ''):
+                h.update(buf)
+        digest = h.hexdigest()
+        self._file_hashes[path] = (stat, digest)
+        self._file_hashes_changed = True
+        return digest
+
+    def hash_value(self, h, value, contents=True):
+        """
+        if contents is False File arguments are hashed by their path, not
+        their content, and Artifact arguments by their params_key
+        """
+        if isinstance(value, Artifact):
+            if contents:
+                h.update('artifact' + value.key)
+            else:
+                h.update('artifact' + value.params_key)
+        elif isinstance(value, File):
+            if contents:
+                h.update('file' + self.hash_file(value.path))
+            else:
+                h.update('file' + value.path)
+        elif isinstance(value, (list, tuple)):
+            h.update('%s%d' % (type(value).__name__, len(value)))
+            for v in value:
+                self.hash_value(h, v, contents)
+        elif isinstance(value, dict):
+            h.update('dict%d' % len(value))
+            for k in sorted(value):
+                self.hash_value(h, k, contents)
+                self.hash_value(h, value[k], contents)
+        elif isinstance(value, np.ndarray):
+            h.update(str(value.dtype) + repr(value.shape))
+            if value.dtype.hasobject:
+                #the bytes of an object array are pointers, so hash the values
+                self.hash_value(h, value.tolist(), contents)
+            else:
+                h.update(np.ascontiguousarray(value).tostring())
+        elif isinstance(value, (pd.Series, pd.DataFrame)):
+            h.update(repr(list(value.columns if isinstance(value, pd.DataFrame) else [value.name])))
+            self.hash_value(h, value.index.values)
+            self.hash_value(h, value.values)
+        elif hasattr(value, '__dict__') and not isinstance(value, type):
+            #objects like Arena are hashed by their simple attributes (so
+            #e.g. its shapely geometry, whose repr is its address, is skipped)
+            h.update('object' + value.__class__.__name__)
+            for k,v in sorted(vars(value).items()):
+                if isinstance(v, _SIMPLE_TYPES):
+                    self.hash_value(h, k, contents)
+                    self.hash_value(h, v, contents)
+        else:
+            h.update(type(value).__name__ + repr(value))
+
+    def _resolve(self, value):
+        if isinstance(value, Artifact):
+            return value.get()
+        elif isinstance(value, File):
+            return value.path
+        elif isinstance(value, (list, tuple)):
+            return type(value)(self._resolve(v) for v in value)
+        elif isinstance(value, dict):
+            return dict((k,self._resolve(v)) for k,v in value.iteritems())
+        return value
+
+    def get_artifact_fname(self, artifact):
+        return os.path.join(self.cachedir, artifact.stage.name, artifact.key + '.pkl')
+
+    def get_latest_fname(self, stage):
+        return os.path.join(self.cachedir, stage.name, self.LATEST)
+
+    def _load(self, fname):
+        with open(fname, 'rb') as f:
+            return pickle.load(f)
+
+    def get_artifact(self, artifact):
+        fname = self.get_artifact_fname(artifact)
+        if os.path.exists(fname):
+            try:
+                value = self._load(fname)
+                if self.verbose:
+                    print "loaded %s" % artifact
+                self._set_latest(artifact)
+                return value
+            except Exception, e:
+                print "loading %s failed (%s)" % (fname, e)
+
+        if self.verbose:
+            print "computing %s" % artifact
+        value = artifact.stage.func(*self._resolve(artifact.args),
+                                    **self._resolve(artifact.kwargs))
+        self._save(value, fname)
+        self._set_latest(artifact)
+        return value
+
+    def get_latest(self, artifact):
+        stage = artifact.stage
+        try:
+            with open(self.get_latest_fname(stage)) as f:
+                key, params_key = f.read().split()
+        except Exception:
+            return None
+
+        if params_key != artifact.params_key:
+            print "latest %s was computed with different arguments" % stage.name
+            return None
+
+        try:
+            value = self._load(os.path.join(self.cachedir, stage.name, key + '.pkl'))
+        except Exception:
+            return None
+        if self.verbose:
+            print "loaded latest %s (%s)" % (stage.name, key[:8])
+        return value
+
+    def _set_latest(self, artifact):
+        #the key of the output, and of the arguments it was computed with
+        fname = self.get_latest_fname(artifact.stage)
+        tmp = fname + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write("%s %s" % (artifact.key, artifact.params_key))
+        os.rename(tmp, fname)
+
+    def _save(self, value, fname):
+        d = os.path.dirname(fname)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        #write then rename, so a partial artifact is never read
+        tmp = fname + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, -1)
+        os.rename(tmp, fname)
+
+        if self._file_hashes_changed:
+            tmp = os.path.join(self.cachedir, self.FILE_HASHES + '.tmp')
+            with open(tmp, 'wb') as f:
+                pickle.dump(self._file_hashes, f, -1)
+            os.rename(tmp, os.path.join(self.cachedir, self.FILE_HASHES))
+            self._file_hashes_changed = False
+
+def test_pipeline():
+    import tempfile
+    import shutil
+
+    d = tempfile.mkdtemp()
+    try:
+        calls = []
+
+        fn = os.path.join(d, 'a.txt')
+        with open(fn, 'w') as f:
+            f.write('1 2 3')
+
+        def make():
+            pipe = Pipeline(os.path.join(d, 'cache'), verbose=False)
+
+            @pipe.stage()
+            def load(path):
+                calls.append('load')
+                return np.array(open(path).read().split(), dtype=float)
+
+            @pipe.stage()
+            def stats(arr, how):
+                calls.append('stats')
+                return getattr(np, how)(arr)
+
+            return load, stats
+
+        load, stats = make()
+        assert stats(load(File(fn)), 'mean').get() == 2
+        assert calls == ['load', 'stats']
+
+        #a new process, only the changed stage is computed, and the
+        #unchanged load is not even read
+        load, stats = make()
+        assert stats(load(File(fn)), 'sum').get() == 6
+        assert calls == ['load', 'stats', 'stats']
+        assert stats(load(File(fn)), 'mean').get() == 2
+        assert calls == ['load', 'stats', 'stats']
+
+        with open(fn, 'w') as f:
+            f.write('1 2 3 4 5')
+        os.utime(fn, (0, 0))
+        load, stats = make()
+        assert stats(load(File(fn)), 'mean').get() == 3
+        assert calls == ['load', 'stats', 'stats', 'load', 'stats']
+
+        class _Obj:
+            def __init__(self, a):
+                self.a = a
+                self.skipped = object()
+        h1, h2, h3 = hashlib.sha1(), hashlib.sha1(), hashlib.sha1()
+        pipe = Pipeline(os.path.join(d, 'cache'), verbose=False)
+        pipe.hash_value(h1, _Obj(1))
+        pipe.hash_value(h2, _Obj(1))
+        pipe.hash_value(h3, _Obj(2))
+        assert h1.digest() == h2.digest() != h3.digest()
+
+        #object arrays (e.g. string columns) are hashed by value
+        h1, h2, h3 = hashlib.sha1(), hashlib.sha1(), hashlib.sha1()
+        pipe.hash_value(h1, pd.DataFrame({'a':['x' + 'y', 'z'], 'b':[1.0, 2.0]}))
+        pipe.hash_value(h2, pd.DataFrame({'a':['xy', 'z'], 'b':[1.0, 2.0]}))
+        pipe.hash_value(h3, pd.DataFrame({'a':['xy', 'w'], 'b':[1.0, 2.0]}))
+        assert h1.digest() == h2.digest() != h3.digest()
+
+        #the latest output, without the file contents, but only for the
+        #same arguments
+        with open(fn, 'w') as f:
+            f.write('7')
+        load, stats = make()
+        assert stats.get_latest(load(File(fn)), 'mean') == 3
+        assert stats.get_latest(load(File(fn)), 'sum') is None
+        assert stats.get_latest(load(File(fn + '.other')), 'mean') is None
+        assert calls == ['load', 'stats', 'stats', 'load', 'stats']
+    finally:
+        shutil.rmtree(d)
@@ -0,0 +1,286 @@
+import contextlib
+
+import numpy as np
+import matplotlib.path
+import cv2
+
+#cv2.LINE_AA (cv2.CV_AA in opencv 2)
+_LINE_AA = getattr(cv2, 'LINE_AA', 16)
+
+def _rgb_alpha(color_rgba):
+    r,g,b,a = color_rgba
+    return np.array([r,g,b], dtype=np.float32)*255, float(a)
+
+class RasterCanvas:
+    """
+    a replacement for a benu png Canvas, with the subset of its drawing
+    methods (set_user_coords, set_user_coords_from_panel, imshow, scatter,
+    plot, poly and text) used by the madplot plotters, so the plotters
+    render(canv, panel, desc) unchanged.
+
+    it draws directly into an (h,w,3) RGB uint8 array, with numpy (and
+    opencv for text and smooth image scaling): images are copied in (a
+    slice assignment when not scaled), and the points of scatter and plot
+    are drawn all at once with a precomputed stencil instead of one cairo
+    path each. it is not antialiased (except text), and overlapping points
+    of one scatter call are only blended once.
+
+    get_image() returns the array (no copy), and reset() clears it to draw
+    the next frame, so a MovieMaker reuses one canvas for a whole movie.
+    """
+
+    def __init__(self, fname, width, height):
+        self.fname = fname
+        self.width = int(width)
+        self.height = int(height)
+        self._buf = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        #device = user*scale + offset, and the device clip rect (x0,y0,x1,y1)
+        self._coords = [(1.0, 1.0, 0.0, 0.0, (0, 0, self.width, self.height))]
+        self._stencils = {}
+
+    def reset(self, fname):
+        self.fname = fname
+        self._buf.fill(0)
+        del self._coords[1:]
+
+    def get_image(self):
+        return self._buf
+
+    def save(self):
+        cv2.imwrite(self.fname, self._buf[:,:,::-1])
+
+    @contextlib.contextmanager
+    def set_user_coords(self, device_rect, user_rect, transform=None):
+        if transform is not None:
+            raise ValueError("transforms are not supported")
+        psx, psy, pox, poy, (cx0, cy0, cx1, cy1) = self._coords[-1]
+
+        dx0, dy0, dw, dh = device_rect
+        ux0, uy0, uw, uh = user_rect
+        sx = float(dw) / uw
+        sy = float(dh) / uh
+
+        #the device rect is given in the current (parent) user coords
+        x0 = pox + psx*dx0
+        y0 = poy + psy*dy0
+        x1 = x0 + psx*dw
+        y1 = y0 + psy*dh
+        clip = (max(cx0, int(np.ceil(min(x0,x1) - 0.5))),
+                max(cy0, int(np.ceil(min(y0,y1) - 0.5))),
+                min(cx1, int(np.ceil(max(x0,x1) - 0.5))),
+                min(cy1, int(np.ceil(max(y0,y1) - 0.5))))
+
+        self._coords.append((psx*sx, psy*sy, x0 - psx*sx*ux0, y0 - psy*sy*uy0, clip))
+        try:
+            yield
+        finally:
+            self._coords.pop()
+
+    def set_user_coords_from_panel(self, panel):
+        dw = panel.get('dw', panel['device_x1'] - panel['device_x0'])
+        dh = panel.get('dh', panel['device_y1'] - panel['device_y0'])
+        return self.set_user_coords((panel['device_x0'], panel['device_y0'], dw, dh),
+                                    (0, 0, panel['width'], panel['height']))
+
+    def _to_device(self, x, y):
+        sx, sy, ox, oy, _ = self._coords[-1]
+        x = np.asarray(x, dtype=np.float64).ravel()
+        y = np.asarray(y, dtype=np.float64).ravel()
+        return x*sx + ox, y*sy + oy
+
+    def _blend(self, region, rgb, alpha):
+        #region is an index into the buffer, alpha a scalar or an array
+        #matching the indexed pixels
+        if np.isscalar(alpha) and alpha >= 1:
+            self._buf[region] = rgb
+        else:
+            alpha = np.asarray(alpha, dtype=np.float32)
+            if alpha.ndim:
+                alpha = alpha[...,None]
+            cur = self._buf[region].astype(np.float32)
+            self._buf[region] = (cur + (rgb - cur)*alpha + 0.5).astype(np.uint8)
+
+    def _stencil(self, radius, linewidth, fill):
+        #the pixel offsets of a circle outline (or disc) drawn at a pixel
+        key = (round(radius, 2), round(linewidth, 2), fill)
+        try:
+            return self._stencils[key]
+        except KeyError:
+            pass
+        n = int(np.ceil(radius + linewidth/2.0))
+        dy, dx = np.mgrid[-n:n+1, -n:n+1]
+        d = np.hypot(dx, dy)
+        if fill or (radius <= linewidth):
+            keep = d <= max(radius + linewidth/2.0, 0.5)
+        else:
+            keep = np.abs(d - radius) <= linewidth/2.0
+        s = self._stencils[key] = (dy[keep], dx[keep])
+        return s
+
+    def _stamp(self, px, py, stencil, color_rgba):
+        _, _, _, _, (cx0, cy0, cx1, cy1) = self._coords[-1]
+        ok = np.isfinite(px) & np.isfinite(py)
+        if not ok.any():
+            return
+        iy = (np.floor(py[ok]).astype(np.int64)[:,None] + stencil[0][None,:]).ravel()
+        ix = (np.floor(px[ok]).astype(np.int64)[:,None] + stencil[1][None,:]).ravel()
+        inside = (ix >= cx0) & (ix < cx1) & (iy >= cy0) & (iy < cy1)
+        flat = np.unique(iy[inside]*self.width + ix[inside])
+        rgb, a = _rgb_alpha(color_rgba)
+        self._blend((flat // self.width, flat % self.width), rgb, a)
+
+    def imshow(self, im, l, b, filter='nearest'):
+        """draws the (gray or RGB) image im with its top left corner at l,b"""
+        im = np.asarray(im)
+        if im.dtype != np.uint8:
+            im = np.clip(im, 0, 255).astype(np.uint8)
+        sx, sy, _, _, (cx0, cy0, cx1, cy1) = self._coords[-1]
+        (x0,), (y0,) = self._to_device([l], [b])
+        h, w = im.shape[:2]
+
+        #the device pixels whose centres are inside the image
+        ix0 = max(cx0, int(np.ceil(x0 - 0.5)))
+        iy0 = max(cy0, int(np.ceil(y0 - 0.5)))
+        ix1 = min(cx1, int(np.ceil(x0 + w*sx - 0.5)))
+        iy1 = min(cy1, int(np.ceil(y0 + h*sy - 0.5)))
+        if ix1 <= ix0 or iy1 <= iy0:
+            return
+
+        if sx == 1 and sy == 1 and x0 == int(x0) and y0 == int(y0):
+            patch = im[iy0-int(y0):iy1-int(y0), ix0-int(x0):ix1-int(x0)]
+        elif filter == 'nearest':
+            cols = np.clip(((np.arange(ix0, ix1) + 0.5 - x0)/sx).astype(np.int64), 0, w-1)
+            rows = np.clip(((np.arange(iy0, iy1) + 0.5 - y0)/sy).astype(np.int64), 0, h-1)
+            patch = im[rows[:,None], cols[None,:]]
+        else:
+            dw = int(round(w*sx))
+            dh = int(round(h*sy))
+            interp = cv2.INTER_AREA if (dw < w and dh < h) else cv2.INTER_LINEAR
+            scaled = cv2.resize(im, (dw, dh), interpolation=interp)
+            ox = int(np.ceil(x0 - 0.5))
+            oy = int(np.ceil(y0 - 0.5))
+            patch = scaled[iy0-oy:iy1-oy, ix0-ox:ix1-ox]
+            #rounding can leave the scaled image a pixel short
+            iy1 = iy0 + patch.shape[0]
+            ix1 = ix0 + patch.shape[1]
+
+        if patch.ndim == 2:
+            patch = patch[:,:,None]
+        self._buf[iy0:iy1, ix0:ix1] = patch[:,:,:3]
+
+    def scatter(self, x, y, color_rgba=(1,1,1,1), radius=1.0, markeredgewidth=1.0, fill=False):
+        """draws circles (outlines, unless fill) of radius (user units) at x,y"""
+        sx, sy, _, _, _ = self._coords[-1]
+        px, py = self._to_device(x, y)
+        r = radius*(abs(sx) + abs(sy))/2.0
+        self._stamp(px, py, self._stencil(r, markeredgewidth, fill), color_rgba)
+
+    def plot(self, xarr, yarr, color_rgba=(1,1,1,1), close_path=False, linewidth=1.0):
+        """draws the line through the points xarr,yarr"""
+        px, py = self._to_device(xarr, yarr)
+        if close_path and len(px):
+            px = np.r_[px, px[0]]
+            py = np.r_[py, py[0]]
+        if len(px) < 2:
+            self._stamp(px, py, self._stencil(0, linewidth, True), color_rgba)
+            return
+
+        #sample every segment at (at most) one pixel steps
+        dx = np.diff(px)
+        dy = np.diff(py)
+        n = np.nan_to_num(np.ceil(np.maximum(np.abs(dx), np.abs(dy)))).astype(np.int64) + 1
+        seg = np.repeat(np.arange(len(n)), n)
+        t = (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)) / np.maximum(n - 1, 1).astype(float)[seg]
+        self._stamp(px[seg] + t*dx[seg] + 0.5, py[seg] + t*dy[seg] + 0.5,
+                    self._stencil(0, linewidth, True), color_rgba)
+
+    def poly(self, xarr, yarr, color_rgba=(1,1,1,1), **kwargs):
+        """fills the polygon xarr,yarr"""
+        _, _, _, _, (cx0, cy0, cx1, cy1) = self._coords[-1]
+        px, py = self._to_device(xarr, yarr)
+        ix0 = max(cx0, int(np.ceil(px.min() - 0.5)))
+        iy0 = max(cy0, int(np.ceil(py.min() - 0.5)))
+        ix1 = min(cx1, int(np.ceil(px.max() - 0.5)))
+        iy1 = min(cy1, int(np.ceil(py.max() - 0.5)))
+        if ix1 <= ix0 or iy1 <= iy0:
+            return
+
+        rgb, a = _rgb_alpha(color_rgba)
+        xs = np.unique(px)
+        ys = np.unique(py)
+        if set(zip(px, py)) == set((x,y) for x in xs for y in ys) and len(xs) == len(ys) == 2:
+            #an axis aligned rectangle
+            self._blend((slice(iy0,iy1), slice(ix0,ix1)), rgb, a)
+            return
+
+        yy, xx = np.mgrid[iy0:iy1, ix0:ix1]
+        centres = np.column_stack((xx.ravel() + 0.5, yy.ravel() + 0.5))
+        inside = matplotlib.path.Path(np.column_stack((px, py))).contains_points(centres)
+        self._blend((yy.ravel()[inside], xx.ravel()[inside]), rgb, a)
+
+    def text(self, text, x, y, color_rgba=(0,0,0,1), font_size=10, font_face=None, bold=False):
+        """draws text with its baseline starting at x,y (font_size pixels)"""
+        _, _, _, _, (cx0, cy0, cx1, cy1) = self._coords[-1]
+        (px,), (py,) = self._to_device([x], [y])
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        #hershey capitals are ~22px high at scale 1, cairo's ~0.7 font_size
+        scale = 0.7*font_size/22.0
+        thickness = 2 if bold else 1
+        (tw, th), base = cv2.getTextSize(text, font, scale, thickness)
+
+        pad = thickness + 1
+        mask = np.zeros((th + base + 2*pad, tw + 2*pad), dtype=np.uint8)
+        cv2.putText(mask, text, (pad, pad + th), font, scale, 255, thickness, _LINE_AA)
+
+        ox = int(round(px)) - pad
+        oy = int(round(py)) - th - pad
+        ix0 = max(cx0, ox)
+        iy0 = max(cy0, oy)
+        ix1 = min(cx1, ox + mask.shape[1])
+        iy1 = min(cy1, oy + mask.shape[0])
+        if ix1 <= ix0 or iy1 <= iy0:
+            return
+
+        rgb, a = _rgb_alpha(color_rgba)
+        alpha = mask[iy0-oy:iy1-oy, ix0-ox:ix1-ox] * (a/255.0)
+        self._blend((slice(iy0,iy1), slice(ix0,ix1)), rgb, alpha)
+
+def test_raster_canvas():
+    canv = RasterCanvas('/dev/null', 40, 30)
+
+    im = np.arange(20*10, dtype=np.uint8).reshape(10,20)
+    canv.imshow(im, 5, 5)
+    assert np.all(canv.get_image()[5:15,5:25,0] == im)
+    assert np.all(canv.get_image()[5:15,5:25,2] == im)
+    assert canv.get_image()[:5].sum() == 0
+
+    #a half size panel at (20,10), drawn with nearest neighbour scaling
+    canv.reset('/dev/null')
+    panel = dict(width=20, height=10, device_x0=20, device_x1=30, device_y0=10, device_y1=15)
+    with canv.set_user_coords_from_panel(panel):
+        canv.imshow(im, 0, 0, filter='nearest')
+        #clipped to the panel
+        canv.poly([-100,100,100,-100,-100], [8,8,100,100,8], color_rgba=(1,0,0,1))
+    img = canv.get_image()
+    assert np.all(img[10:14,20:30,1] == im[1:8:2,1:20:2])
+    assert np.all(img[14,20:30] == (255,0,0))
+    assert img[:10].sum() == 0 and img[15:].sum() == 0 and img[:,:20].sum() == 0
+
+    canv.reset('/dev/null')
+    canv.scatter([10.5, np.nan], [10.5, 0], color_rgba=(0,1,0,1), radius=5)
+    img = canv.get_image()
+    assert np.all(img[10,15] == (0,255,0)) and np.all(img[15,10] == (0,255,0))
+    assert img[10,10].sum() == 0
+    canv.scatter([10.5], [10.5], color_rgba=(0,0,1,0.5), radius=1, fill=True)
+    assert np.all(img[10,10] == (0,0,128))
+
+    canv.reset('/dev/null')
+    canv.plot([0, 39], [0, 29], color_rgba=(1,1,1,1))
+    img = canv.get_image()
+    assert np.all(img[0,0] == 255) and np.all(img[29,39] == 255)
+    assert (img[...,0] > 0).sum() == 40
+
+    canv.reset('/dev/null')
+    canv.poly([0,20,0,0], [0,0,20,0], color_rgba=(1,1,1,1))
+    img = canv.get_image()
+    assert img[2,2,0] == 255 and img[18,18,0] == 0
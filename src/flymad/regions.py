@@ -0,0 +1,106 @@
+import collections
+
+import numpy as np
+import matplotlib.path
+
+def _polygon_parts(geom):
+    #a shapely Polygon, or the parts of a MultiPolygon/GeometryCollection
+    #(which is what an intersection can return)
+    if geom is None or geom.is_empty:
+        return []
+    if hasattr(geom, 'exterior'):
+        return [geom]
+    parts = []
+    for g in getattr(geom, 'geoms', []):
+        parts.extend(_polygon_parts(g))
+    return parts
+
+def _ring_path(ring):
+    return matplotlib.path.Path(np.asarray(ring.coords, dtype=np.float64))
+
+def contains(geom, x, y):
+    """
+    returns a boolean array, True where the point (x[i],y[i]) lies inside
+    the shapely polygon geom. NaN points are never inside.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    inside = np.zeros(x.shape, dtype=bool)
+
+    valid = np.isfinite(x) & np.isfinite(y)
+    if not valid.any():
+        return inside
+    pts = np.column_stack((x[valid], y[valid]))
+
+    vinside = np.zeros(len(pts), dtype=bool)
+    for poly in _polygon_parts(geom):
+        pinside = _ring_path(poly.exterior).contains_points(pts)
+        for hole in poly.interiors:
+            pinside &= ~_ring_path(hole).contains_points(pts)
+        vinside |= pinside
+
+    inside[valid] = vinside
+    return inside
+
+class RegionClassifier:
+    """
+    classifies whole x,y columns against any number of named regions
+    (shapely polygons) at once
+    """
+
+    def __init__(self, regions=None):
+        self._regions = collections.OrderedDict()
+        if regions:
+            for name in regions:
+                self.add_region(name, regions[name])
+
+    def add_region(self, name, geom):
+        self._regions[name] = geom
+
+    @property
+    def names(self):
+        return list(self._regions.keys())
+
+    def contains(self, name, x, y):
+        return contains(self._regions[name], x, y)
+
+    def classify(self, df, xcol='x', ycol='y'):
+        """returns a dict of region name -> boolean array aligned with df"""
+        x = df[xcol].values
+        y = df[ycol].values
+        return collections.OrderedDict(
+                    (name,contains(geom,x,y)) for name,geom in self._regions.iteritems())
+
+    def add_columns(self, df, xcol='x', ycol='y'):
+        """adds one boolean column per region to df"""
+        for name,inside in self.classify(df, xcol, ycol).iteritems():
+            df[name] = inside
+        return df
+
+    def label(self, df, xcol='x', ycol='y', outside=''):
+        """
+        returns an array of the name of the (first added) region each point
+        lies in, or outside
+        """
+        labels = np.empty(len(df), dtype=object)
+        labels.fill(outside)
+        unlabeled = np.ones(len(df), dtype=bool)
+        for name,inside in self.classify(df, xcol, ycol).iteritems():
+            m = inside & unlabeled
+            labels[m] = name
+            unlabeled &= ~m
+        return labels
+
+def test_contains():
+    import shapely.geometry as sg
+
+    sq = sg.Polygon([(0,0),(10,0),(10,10),(0,10)],
+                    [[(4,4),(6,4),(6,6),(4,6)]])
+    x = np.array([1, 5, 11, np.nan, 9])
+    y = np.array([1, 5, 5,  1,      9])
+    assert list(contains(sq, x, y)) == [True, False, False, False, True]
+    assert not contains(None, x, y).any()
+
+    circ = sg.Point(0,0).buffer(5)
+    both = sq.intersection(circ).union(sg.Point(20,20).buffer(1))
+    assert list(contains(both, [1, 20, -1], [1, 20, -1])) == [True, True, False]
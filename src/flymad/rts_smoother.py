@@ -0,0 +1,207 @@
+import numpy as np
+import scipy.signal
+import adskalman.adskalman
+
+class SteadyStateRTSSmoother:
+    """
+    Rauch-Tung-Striebel smoother for a fixed (A,C,Q,R) model, giving the same
+    result as adskalman.kalman_smoother.
+
+    For a fixed model and initial covariance the filter and smoother gains do
+    not depend on the data, they are computed once until they converge. The
+    transient is then applied step by step (batched over all trajectories) and
+    the rest of each trajectory is a linear recursion with constant gains,
+    which is run as a set of first order IIR filters (one per mode).
+    """
+
+    def __init__(self, A, C, Q, R, initV, max_transient=20000):
+        self.A = np.asarray(A, dtype=np.float64)
+        self.C = np.asarray(C, dtype=np.float64)
+        self.Q = np.asarray(Q, dtype=np.float64)
+        self.R = np.asarray(R, dtype=np.float64)
+        self.initV = np.asarray(initV, dtype=np.float64)
+        self.ss = len(self.A)
+
+        self._K, self._J, self.converged = self._compute_gains(max_transient)
+        #the number of steps before the gains reach steady state
+        self.M = len(self._K)
+
+        I = np.eye(self.ss)
+        self.K = self._K[-1]
+        self.J = self._J[-1]
+        self._fwd_modes = self._get_modes(np.dot(I - np.dot(self.K, self.C), self.A))
+        self._bwd_modes = self._get_modes(self.J)
+        self._bwd_w = I - np.dot(self.J, self.A)
+
+    def _compute_gains(self, max_transient):
+        #keep in sync with adskalman.kalman_filter, the first step uses the
+        #initial state and covariance without applying the process model
+        A,C,Q,R = self.A,self.C,self.Q,self.R
+        I = np.eye(self.ss)
+
+        Ks = []
+        Js = []
+        P = self.initV
+        for t in range(max_transient):
+            if t == 0:
+                Pm = P
+            else:
+                Pm = np.dot(np.dot(A, P), A.T) + Q
+            K = np.dot(np.dot(Pm, C.T), np.linalg.inv(np.dot(np.dot(C, Pm), C.T) + R))
+            P = np.dot(I - np.dot(K, C), Pm)
+            J = np.dot(np.dot(P, A.T), np.linalg.inv(np.dot(np.dot(A, P), A.T) + Q))
+
+            Ks.append(K)
+            Js.append(J)
+
+            if (t > 1) and \
+               (np.abs(K - Ks[-2]).max() <= 1e-15*np.abs(K).max()) and \
+               (np.abs(J - Js[-2]).max() <= 1e-15*np.abs(J).max()):
+                return np.array(Ks), np.array(Js), True
+
+        return np.array(Ks), np.array(Js), False
+
+    def _get_modes(self, F):
+        lam, V = np.linalg.eig(F)
+        if np.linalg.cond(V) > 1e6:
+            #not (safely) diagonalizable
+            return None
+        return lam, V, np.linalg.inv(V)
+
+    @staticmethod
+    def _run_modes(modes, u):
+        #x[t] = F x[t-1] + u[t], x[-1] = 0, as one first order filter per
+        #eigenvalue of F
+        lam, V, Vi = modes
+        w = np.dot(Vi, u.T)
+        z = np.empty(w.shape, dtype=np.result_type(w, lam))
+        for k in range(len(lam)):
+            z[k] = scipy.signal.lfilter([1.0], [1.0, -lam[k]], w[k])
+        return np.dot(V, z).real.T
+
+    @property
+    def usable(self):
+        return self.converged and \
+               (self._fwd_modes is not None) and \
+               (self._bwd_modes is not None)
+
+    def smooth(self, y, initx):
+        """y is (T x os), returns xsmooth (T x ss)"""
+        return self.smooth_many([y], [initx])[0]
+
+    def smooth_many(self, ys, initxs):
+        """
+        smooth a list of trajectories (each T_i x os) with the corresponding
+        initial states. returns a list of xsmooth (each T_i x ss)
+        """
+        ys = [np.asarray(y, dtype=np.float64) for y in ys]
+        initxs = [np.asarray(x, dtype=np.float64) for x in initxs]
+
+        results = [None]*len(ys)
+        batch = []
+        for i,y in enumerate(ys):
+            if (not self.usable) or np.isnan(y).any() or len(y) == 0:
+                #missing observations make the gains data dependent
+                results[i] = adskalman.adskalman.kalman_smoother(y,
+                                self.A,self.C,self.Q,self.R,
+                                initxs[i],self.initV)[0]
+            else:
+                batch.append(i)
+
+        if batch:
+            for i,xs in zip(batch, self._smooth_batch([ys[i] for i in batch],
+                                                      [initxs[i] for i in batch])):
+                results[i] = xs
+
+        return results
+
+    def _smooth_batch(self, ys, initxs):
+        A,C = self.A,self.C
+        M = self.M
+        N = len(ys)
+        Ts = np.array([len(y) for y in ys])
+        m = min(Ts.max(), M)
+
+        #transient forward pass, all trajectories at once. rows shorter
+        #than m are zero padded, the padding is never used
+        Yt = np.zeros((N, m, C.shape[0]))
+        for i,y in enumerate(ys):
+            Yt[i,:min(len(y),m)] = y[:m]
+
+        XF = np.empty((N, m, self.ss))
+        x = np.array(initxs)
+        for t in range(m):
+            if t > 0:
+                x = np.dot(x, A.T)
+            x = x + np.dot(Yt[:,t] - np.dot(x, C.T), self._K[t].T)
+            XF[:,t] = x
+
+        #steady state forward and backward pass of the long trajectories
+        xs_next = np.zeros((N, self.ss))
+        steady_xs = {}
+        for i,y in enumerate(ys):
+            T = Ts[i]
+            if T <= M:
+                continue
+
+            u = np.empty((T-M+1, self.ss))
+            u[0] = XF[i,M-1]
+            u[1:] = np.dot(y[M:], self.K.T)
+            xf = np.concatenate((XF[i,:M-1], self._run_modes(self._fwd_modes, u)))
+
+            #backwards from the last sample to M, run in reversed time
+            w = np.dot(xf[M:][::-1], self._bwd_w.T)
+            w[0] = xf[T-1]
+            xs = self._run_modes(self._bwd_modes, w)[::-1]
+            steady_xs[i] = xs
+            xs_next[i] = xs[0]
+
+        #transient backward pass, all trajectories at once
+        XS = np.empty((N, m, self.ss))
+        for t in range(m-1, -1, -1):
+            xs = XF[:,t] + np.dot(xs_next - np.dot(XF[:,t], A.T), self._J[t].T)
+            last = (Ts - 1) == t
+            xs[last] = XF[last,t]
+            XS[:,t] = xs
+            xs_next = xs
+
+        results = []
+        for i in range(N):
+            T = Ts[i]
+            if T <= M:
+                results.append(XS[i,:T].copy())
+            else:
+                results.append(np.concatenate((XS[i], steady_xs[i])))
+        return results
+
+_SMOOTHERS = {}
+
+def get_smoother(A, C, Q, R, initV):
+    """returns a (cached) SteadyStateRTSSmoother for this model"""
+    key = tuple(np.asarray(m, dtype=np.float64).tostring() for m in (A,C,Q,R,initV))
+    try:
+        return _SMOOTHERS[key]
+    except KeyError:
+        s = _SMOOTHERS[key] = SteadyStateRTSSmoother(A, C, Q, R, initV)
+        return s
+
+def test_steady_state_smoother():
+    import trackingparams
+    kf = trackingparams.Kalman
+    initV = 0*np.eye(4)
+    s = SteadyStateRTSSmoother(kf.A, kf.C, kf.Q, kf.R, initV)
+    assert s.usable
+
+    np.random.seed(1)
+    ys = []
+    initxs = []
+    for T in (1, 2, 50, s.M, s.M+1, 3*s.M):
+        y = np.cumsum(np.random.randn(T,2), axis=0) + 300
+        ys.append(y)
+        initxs.append(np.array([y[0,0],y[0,1],0,0]))
+    #missing data falls back to adskalman
+    ys[2][10] = np.nan
+
+    for y,initx,xs in zip(ys, initxs, s.smooth_many(ys, initxs)):
+        expected,_ = adskalman.adskalman.kalman_smoother(y, kf.A, kf.C, kf.Q, kf.R, initx, initV)
+        assert np.allclose(xs, expected, rtol=0, atol=1e-8)
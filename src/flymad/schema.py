@@ -0,0 +1,88 @@
+import numpy as np
+
+#the column types of the tables returned by madplot.load_bagfile. positions,
+#velocities and other measurements are float32 (plenty for pixels and mm),
+#ids and framenumbers are integers, with INT_SENTINEL in place of NaN. The
+#controller mode and ttm target type are small integer codes.
+#
+#timestamps (t_ts) must remain float64, float32 has only ~100s resolution at
+#the current epoch.
+
+INT_SENTINEL = -1
+
+F32 = np.float32
+F64 = np.float64
+
+TARGETED = {
+    "lobj_id":np.int64,
+    "fly_x":F32, "fly_y":F32, "laser_x":F32, "laser_y":F32,
+    "fly_x_px":F32, "fly_y_px":F32, "laser_x_px":F32, "laser_y_px":F32,
+    "laser_power":np.int32,
+    "mode":np.int8,
+    "laser_state":np.int8,
+}
+
+TRACKED = {
+    "tobj_id":np.int64,
+    "t_framenumber":np.int64,
+    "t_ts":F64,
+    "x_px":F32, "y_px":F32, "vx_px":F32, "vy_px":F32, "v_px":F32,
+    "x":F32, "y":F32, "vx":F32, "vy":F32, "v":F32,
+    "t_dt":F32,
+    "theta":F32,
+    "in_area":np.bool_,
+    "experiment":np.int16,
+}
+
+TTM = {
+    "head_x":F32, "head_y":F32, "body_x":F32, "body_y":F32,
+    "target_x":F32, "target_y":F32,
+    "target_type":np.int8,
+    "h_framenumber":np.int64,
+    "h_processing_time":F32,
+}
+
+SCHEMAS = {
+    "targeted":TARGETED,
+    "tracked":TRACKED,
+    "ttm":TTM,
+}
+
+def apply_schema(df, schema):
+    """
+    casts the columns of df named in schema to their compact type, in place.
+    NaN in integer columns becomes INT_SENTINEL, in boolean columns False.
+    """
+    if df is None:
+        return df
+    for col,dtype in schema.iteritems():
+        if col not in df.columns:
+            continue
+        s = df[col]
+        if s.dtype == dtype:
+            continue
+        if np.issubdtype(dtype, np.integer):
+            s = s.fillna(INT_SENTINEL)
+        elif dtype is np.bool_:
+            s = s.fillna(False)
+        df[col] = s.values.astype(dtype)
+    return df
+
+def apply_schemas(dfs):
+    """applies the schema of each table in a load_bagfile results dict"""
+    for name,schema in SCHEMAS.iteritems():
+        apply_schema(dfs.get(name), schema)
+    return dfs
+
+def test_apply_schema():
+    import pandas as pd
+    df = pd.DataFrame({'tobj_id':[1.0, np.nan],
+                       'in_area':[True, np.nan],
+                       'x':[1.5, 2.5],
+                       'other':[1.0, 2.0]})
+    apply_schema(df, TRACKED)
+    assert df['tobj_id'].dtype == np.int64
+    assert list(df['tobj_id']) == [1, INT_SENTINEL]
+    assert list(df['in_area']) == [True, False]
+    assert df['x'].dtype == np.float32
+    assert df['other'].dtype == np.float64
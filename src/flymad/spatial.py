@@ -0,0 +1,207 @@
+import numpy as np
+import scipy.spatial
+
+import flymad.regions as regions
+import flymad.orientation as orientation
+
+#with at least this many points, the nearest is found using a kd-tree
+KDTREE_MIN_POINTS = 32
+
+def _as_xy(x, y):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    return x, y, np.isfinite(x) & np.isfinite(y)
+
+def distance_to_points(x, y, points, kdtree_min_points=KDTREE_MIN_POINTS):
+    """
+    returns (distance, index), the distance from each (x[i],y[i]) to the
+    nearest of points (a sequence of (x,y)) and its index in points. x and
+    y can be any shape (e.g. flies x frames). NaN positions have distance
+    NaN and index -1.
+    """
+    x, y, valid = _as_xy(x, y)
+    points = np.asarray(points, dtype=np.float64).reshape(-1,2)
+
+    dist = np.empty(x.shape)
+    dist.fill(np.nan)
+    idx = np.empty(x.shape, dtype=int)
+    idx.fill(-1)
+    if not len(points) or not valid.any():
+        return dist, idx
+
+    px = x[valid]
+    py = y[valid]
+    if len(points) >= kdtree_min_points:
+        d, i = scipy.spatial.cKDTree(points).query(np.column_stack((px,py)))
+    else:
+        #one point at a time, so there is no (frames x points) temporary
+        d = np.empty(len(px))
+        d.fill(np.inf)
+        i = np.zeros(len(px), dtype=int)
+        for j,(ox,oy) in enumerate(points):
+            dj = np.hypot(px - ox, py - oy)
+            closer = dj < d
+            d[closer] = dj[closer]
+            i[closer] = j
+
+    dist[valid] = d
+    idx[valid] = i
+    return dist, idx
+
+def distance_to_wall(x, y, arena):
+    """
+    returns the distance from each point to the arena wall (Arena.circ, so
+    x and y should be in the same units as the arena, e.g. df['x'] and
+    df['y']), positive inside the arena and negative outside it
+    """
+    x, y, _ = _as_xy(x, y)
+    (cx,cy),r = arena.circ
+    return r - np.hypot(x - cx, y - cy)
+
+def _ring_distance(px, py, ring, d):
+    #min of d and the distance to each segment of the ring, in place
+    coords = np.asarray(ring.coords, dtype=np.float64)
+    for (ax,ay),(bx,by) in zip(coords[:-1], coords[1:]):
+        dx = bx - ax
+        dy = by - ay
+        l2 = dx*dx + dy*dy
+        if l2 > 0:
+            u = np.clip(((px - ax)*dx + (py - ay)*dy) / l2, 0, 1)
+        else:
+            u = 0.0
+        np.minimum(d, np.hypot(px - ax - u*dx, py - ay - u*dy), d)
+
+def distance_to_region(geom, x, y):
+    """
+    returns the distance from each point to the shapely polygon geom, 0
+    inside it. NaN points have distance NaN, and every point is infinitely
+    far from an empty geom.
+    """
+    x, y, valid = _as_xy(x, y)
+    dist = np.empty(x.shape)
+    dist.fill(np.nan)
+
+    px = x[valid]
+    py = y[valid]
+    d = np.empty(len(px))
+    d.fill(np.inf)
+    for poly in regions._polygon_parts(geom):
+        _ring_distance(px, py, poly.exterior, d)
+        for hole in poly.interiors:
+            _ring_distance(px, py, hole, d)
+
+    d[regions.contains(geom, px, py)] = 0
+    dist[valid] = d
+    return dist
+
+def nearest_region(named_regions, x, y, maxdist=np.inf, outside=''):
+    """
+    returns (labels, distance), the name of the nearest of named_regions
+    (name -> shapely polygon, ties go to the first) to each point and the
+    distance to it (see distance_to_region). points further than maxdist
+    from every region (and NaN points) are labelled outside.
+    """
+    x, y, valid = _as_xy(x, y)
+    names = list(named_regions.keys())
+
+    labels = np.empty(x.shape, dtype=object)
+    labels.fill(outside)
+    if not names:
+        dist = np.empty(x.shape)
+        dist.fill(np.nan)
+        return labels, dist
+
+    dists = np.array([distance_to_region(named_regions[n], x, y) for n in names])
+    best = np.argmin(np.where(np.isnan(dists), np.inf, dists), axis=0)
+    dist = np.choose(best, dists)
+
+    near = valid.copy()
+    near[valid] = dist[valid] <= maxdist
+    labels[near] = np.array(names, dtype=object)[best[near]]
+    return labels, dist
+
+def heading_to_target(x, y, theta, tx, ty):
+    """
+    returns the angle (radians, -pi to pi) from the orientation theta
+    to the direction of the target (tx,ty) from each point. the target can
+    be fixed or move (i.e. tx and ty can be arrays like x and y). 0 means
+    the fly is facing the target.
+    """
+    x, y, _ = _as_xy(x, y)
+    bearing = np.arctan2(np.asarray(ty, dtype=np.float64) - y,
+                         np.asarray(tx, dtype=np.float64) - x)
+    return orientation.wrap_plus_minus(bearing - np.asarray(theta, dtype=np.float64))
+
+def add_spatial_features(df, arena=None, points=None, named_regions=None, xcol='x', ycol='y', thetacol='theta'):
+    """
+    adds the spatial features of the trajectories in df (one or many flies)
+    as columns, computed directly from the x and y columns:
+
+      arena         -> dwall
+      points        -> dtarget, target_idx (the nearest point) and, if
+                       df has a thetacol, target_heading
+      named_regions -> region, dregion (the nearest region)
+    """
+    x = df[xcol].values
+    y = df[ycol].values
+
+    if arena is not None:
+        df['dwall'] = distance_to_wall(x, y, arena)
+
+    if points is not None:
+        points = np.asarray(points, dtype=np.float64).reshape(-1,2)
+        dist, idx = distance_to_points(x, y, points)
+        df['dtarget'] = dist
+        df['target_idx'] = idx
+        if thetacol in df:
+            ok = idx >= 0
+            heading = np.empty(len(df))
+            heading.fill(np.nan)
+            heading[ok] = heading_to_target(x[ok], y[ok], df[thetacol].values[ok],
+                                            points[idx[ok],0], points[idx[ok],1])
+            df['target_heading'] = heading
+
+    if named_regions is not None:
+        labels, dist = nearest_region(named_regions, x, y)
+        df['region'] = labels
+        df['dregion'] = dist
+
+    return df
+
+def test_spatial():
+    import shapely.geometry as sg
+
+    np.random.seed(1)
+    x = np.random.uniform(-10, 10, 500)
+    y = np.random.uniform(-10, 10, 500)
+    x[3] = np.nan
+
+    for n in (4, 100):
+        pts = np.random.uniform(-10, 10, (n,2))
+        d, i = distance_to_points(x, y, pts)
+        all_d = np.hypot(x[:,None] - pts[None,:,0], y[:,None] - pts[None,:,1])
+        ok = ~np.isnan(x)
+        assert np.allclose(d[ok], all_d[ok].min(axis=1))
+        assert (i[ok] == all_d[ok].argmin(axis=1)).all()
+        assert np.isnan(d[3]) and i[3] == -1
+
+    #many flies at once
+    d2, i2 = distance_to_points(x.reshape(5,100), y.reshape(5,100), pts)
+    assert d2.shape == (5,100)
+    assert (i2.ravel() == i).all()
+
+    sq = sg.Polygon([(0,0),(4,0),(4,4),(0,4)])
+    circ = sg.Point(8,0).buffer(1, 256)
+    d = distance_to_region(sq, [2, 5, 2, np.nan], [2, 2, -3, 0])
+    assert np.allclose(d[:3], [0, 1, 3]) and np.isnan(d[3])
+
+    labels, d = nearest_region(dict(sq=sq, circ=circ), [2, 8, 6.5, 50, np.nan], [2, 0, 0, 50, 0], maxdist=10)
+    assert list(labels) == ['sq', 'circ', 'circ', '', '']
+    assert np.allclose(d[:3], [0, 0, 0.5], atol=1e-3)
+
+    h = heading_to_target([0, 0, 0], [0, 0, 0], [0, np.pi/2, 3*np.pi/4], 1, 0)
+    assert np.allclose(h, [0, -np.pi/2, -3*np.pi/4])
+
+    class _Arena:
+        circ = (1,1), 5
+    assert np.allclose(distance_to_wall([1, 4, 7], [1, 5, 1], _Arena()), [5, 0, -1])
@@ -1,6 +1,6 @@
 import numpy as np
 
-import adskalman.adskalman
+import flymad.rts_smoother
 
 class Kalman:
     ### KEEP THESE IN SYNC WITH FLYMAD TRACKER
@@ -32,10 +32,19 @@ class Kalman:
         initx = np.array([y[0,0],y[0,1],0,0])
         initV = 0*np.eye(4)
 
-        xsmooth,Vsmooth = adskalman.adskalman.kalman_smoother(y,
-                                self.A,self.C,
-                                self.Q,self.R,
-                                initx,initV)
+        smoother = flymad.rts_smoother.get_smoother(self.A,self.C,
+                                                    self.Q,self.R,
+                                                    initV)
+        return smoother.smooth(y, initx)
 
-        return xsmooth
+    def smooth_many(self, xys):
+        """smooth a list of (x,y) trajectories in one batch"""
+        ys = [np.c_[x,y] for x,y in xys]
+        initxs = [np.array([y[0,0],y[0,1],0,0]) for y in ys]
+        initV = 0*np.eye(4)
+
+        smoother = flymad.rts_smoother.get_smoother(self.A,self.C,
+                                                    self.Q,self.R,
+                                                    initV)
+        return smoother.smooth_many(ys, initxs)
 